@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Benchmark the parser against a synthetic flash image.
+
+Generates a flash dump (see synthetic.flash_image), then times
+read_partition_table, dump_bytes, image2elf, parse_nvs_pages and
+read_nvs_pages on it. Each benchmark runs in a fresh worker process so its
+peak RSS can be reported on its own. Results go to stdout as a table, and
+as JSON with -json (use '-' for stdout) for tracking regressions.
+
+    python benchmarks/bench_flash.py -flash_mb 16 -app_kb 2048 -nvs_pages 64 -json results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import platform
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir))
+sys.path.insert(0, BENCH_DIR)
+
+import synthetic
+
+def peak_rss_kb():
+    # ru_maxrss is KB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def timed(func, repeat):
+    # best of repeat runs, plus the result of the last one
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def run_benchmark(name, image_path, work_dir, repeat):
+    """Runs in its own process. Returns the result record for one benchmark."""
+    from esp32_firmware_reader import flash_image, read_partition_table, dump_bytes
+    from esp32_image_parser import image2elf
+    from read_nvs import parse_nvs_pages, read_nvs_pages
+
+    record = {"name": name, "rss_before_kb": peak_rss_kb()}
+    with flash_image(image_path) as image:
+        part_table = read_partition_table(image)
+        app = part_table["ota_0"]
+        nvs = part_table["nvs"]
+        app_data = image[app["offset"]:app["offset"] + app["size"]]
+        nvs_data = image[nvs["offset"]:nvs["offset"] + nvs["size"]]
+
+        if name == "read_partition_table":
+            # too quick to time one call
+            calls = 1000
+            elapsed, _ = timed(lambda: [read_partition_table(image) for _ in range(calls)], repeat)
+            record.update(seconds=elapsed / calls, calls_per_s=calls / elapsed, partitions=len(part_table))
+        elif name == "dump_bytes":
+            out_file = os.path.join(work_dir, "dump.bin")
+            elapsed, _ = timed(lambda: dump_bytes(image, 0, len(image), out_file), repeat)
+            record.update(seconds=elapsed, bytes=len(image), mb_per_s=len(image) / elapsed / 1e6)
+        elif name == "image2elf":
+            out_file = os.path.join(work_dir, "app.elf")
+            elapsed, _ = timed(lambda: image2elf(app_data, out_file, quiet=True), repeat)
+            record.update(seconds=elapsed, bytes=len(app_data), mb_per_s=len(app_data) / elapsed / 1e6,
+                          elf_bytes=os.path.getsize(out_file))
+        elif name in ("parse_nvs_pages", "read_nvs_pages"):
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                parse = parse_nvs_pages if name == "parse_nvs_pages" else read_nvs_pages
+                elapsed, _ = timed(lambda: parse(nvs_data), repeat)
+            entries = sum(1 for page in parse_nvs_pages(nvs_data) for entry in page.entries if entry.written)
+            record.update(seconds=elapsed, bytes=len(nvs_data), mb_per_s=len(nvs_data) / elapsed / 1e6,
+                          entries=entries, entries_per_s=entries / elapsed)
+        else:
+            raise ValueError("unknown benchmark " + name)
+
+    record["peak_rss_kb"] = peak_rss_kb()
+    return record
+
+BENCHMARKS = ["read_partition_table", "dump_bytes", "image2elf", "parse_nvs_pages", "read_nvs_pages"]
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Flash image parser benchmark')
+    arg_parser.add_argument('-flash_mb', help='Flash image size in MB', type=int, default=4)
+    arg_parser.add_argument('-app_kb', help='App image size in KB', type=int, default=512)
+    arg_parser.add_argument('-segments', help='Segments per app image (at least 4)', type=int, default=5)
+    arg_parser.add_argument('-nvs_pages', help='Pages per NVS partition', type=int, default=16)
+    arg_parser.add_argument('-blob_ratio', help='Share of NVS entries that are blobs', type=float, default=0.3)
+    arg_parser.add_argument('-str_ratio', help='Share of NVS entries that are strings', type=float, default=0.3)
+    arg_parser.add_argument('-repeat', help='Runs per benchmark (best is reported)', type=int, default=3)
+    arg_parser.add_argument('-only', help='Run only these benchmarks', nargs='+', choices=BENCHMARKS)
+    arg_parser.add_argument('-json', help="Write results as JSON to this file ('-' for stdout)")
+    args = arg_parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="esp32_bench_")
+    try:
+        image, partitions = synthetic.flash_image(args.flash_mb << 20, args.app_kb << 10, 2, args.segments,
+                                                  args.nvs_pages, 1, args.blob_ratio, args.str_ratio)
+        image_path = os.path.join(work_dir, "flash.bin")
+        with open(image_path, 'wb') as fh:
+            fh.write(image)
+        del image
+
+        results = []
+        for name in args.only or BENCHMARKS:
+            # a fresh process per benchmark keeps peak RSS attributable
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                results.append(pool.submit(run_benchmark, name, image_path, work_dir, args.repeat).result())
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {k: v for k, v in vars(args).items() if k not in ("only", "json")},
+        "results": results,
+    }
+
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+        return
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+    print("flash %d MB, app %d KB / %d segments, nvs %d pages" % (args.flash_mb, args.app_kb, args.segments, args.nvs_pages))
+    for r in results:
+        rate = ""
+        if "mb_per_s" in r:
+            rate = "%8.1f MB/s" % r["mb_per_s"]
+        if "entries_per_s" in r:
+            rate += "  %9.0f entries/s" % r["entries_per_s"]
+        if "calls_per_s" in r:
+            rate = "%8.0f calls/s" % r["calls_per_s"]
+        print("  %-22s %10.3f ms  %-32s peak RSS %6d KB" % (r["name"], r["seconds"] * 1000, rate, r["peak_rss_kb"]))
+
+if __name__ == '__main__':
+    main()
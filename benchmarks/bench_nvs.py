@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Time NVS page decoding: the old per-character bitmap loop and per-field
+unpacking against decode_nvs_pages() with and without NumPy, then the full
+parser on its own, with the JSON rendering and with the text rendering.
+
+    python benchmarks/bench_nvs.py -pages 512
+"""
+import os
+import sys
+import time
+import struct
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import read_nvs
+from synthetic import nvs_partition
+
+def legacy_decode(view):
+    # what read_nvs_pages() used to do per page, minus the printing
+    pages = []
+    for pos in range(0, len(view), 4096):
+        state = struct.unpack("<I", view[pos:pos + 4])[0]
+        seq_no = struct.unpack("<I", view[pos + 4:pos + 8])[0]
+        version = view[pos + 8]
+        crc_32 = struct.unpack("<I", view[pos + 28:pos + 32])[0]
+        bitmap = view[pos + 32:pos + 64]
+        decoded = ''
+        for entry_num in range(0, 126):
+            bitnum = entry_num * 2
+            decoded = decoded + str((bitmap[int(bitnum / 8)] >> (6 - (bitnum % 8))) & 3)
+        headers = []
+        for i in range(126):
+            entry = view[pos + 64 + i * 32:pos + 96 + i * 32]
+            headers.append((entry[0], entry[1], entry[2], entry[3], entry[8:24], entry[24:]))
+        pages.append((state, seq_no, version, crc_32, decoded, headers))
+    return pages
+
+def best_of(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='NVS decoding benchmark')
+    arg_parser.add_argument('-pages', help='NVS pages to generate', type=int, default=256)
+    arg_parser.add_argument('-repeat', help='Runs per measurement (best is reported)', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    data = memoryview(nvs_partition(args.pages))
+    # imported regardless of size, so both paths can be compared
+    numpy = read_nvs.load_numpy()
+
+    timings = [("legacy loop", best_of(lambda: legacy_decode(data), args.repeat))]
+    read_nvs.numpy = None
+    timings.append(("decode_nvs_pages (struct)", best_of(lambda: read_nvs.decode_nvs_pages(data), args.repeat)))
+    if numpy is not None:
+        read_nvs.numpy = numpy
+        timings.append(("decode_nvs_pages (numpy)", best_of(lambda: read_nvs.decode_nvs_pages(data), args.repeat)))
+
+    timings.append(("parse_nvs_pages", best_of(lambda: read_nvs.parse_nvs_pages(data), args.repeat)))
+    timings.append(("parse + JSON dicts", best_of(lambda: read_nvs.nvs_pages_to_dicts(read_nvs.parse_nvs_pages(data)), args.repeat)))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        timings.append(("read_nvs_pages (text)", best_of(lambda: read_nvs.read_nvs_pages(data), args.repeat)))
+
+    baseline = timings[0][1]
+    print("%d pages (%d KB)" % (args.pages, len(data) // 1024))
+    for name, elapsed in timings:
+        print("  %-28s %9.2f ms  %10.0f pages/s  %6.1fx" % (name, elapsed * 1000, args.pages / elapsed, baseline / elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""Synthetic ESP32 flash contents for benchmarking.
+
+Everything here is deterministic for a given seed, so timings from two runs
+are comparable."""
+import struct
+import random
+import hashlib
+import zlib
+
+NVS_PAGE_SIZE = 4096
+NVS_ENTRY_COUNT = 126
+
+def nvs_crc32(data):
+    return zlib.crc32(data, 0xFFFFFFFF)
+
+def nvs_entry(ns, entry_type, span, chunk_index, key, data):
+    head = struct.pack("<BBBB", ns, entry_type, span, chunk_index)
+    tail = key.encode('ascii').ljust(16, b'\x00') + data.ljust(8, b'\xff')
+    return head + struct.pack("<I", nvs_crc32(head + tail)) + tail
+
+def nvs_span(ns, entry_type, chunk_index, key, payload):
+    # a STR / BLOB_DATA header entry followed by its payload entries
+    span = 1 + (len(payload) + 31) // 32
+    header = nvs_entry(ns, entry_type, span, chunk_index, key,
+                       struct.pack("<HHI", len(payload), 0xffff, nvs_crc32(payload)))
+    payload = payload.ljust((span - 1) * 32, b'\xff')
+    return [header] + [payload[i:i + 32] for i in range(0, len(payload), 32)]
+
+def nvs_page(seq_no, entries, state=0xFFFFFFFC):
+    assert len(entries) <= NVS_ENTRY_COUNT
+    bitmap = bytearray(b'\xff' * 32)
+    for i in range(len(entries)):
+        # written = 0b10, first entry in the low bits
+        shift = (i * 2) % 8
+        bitmap[i // 4] &= ~(1 << shift) & 0xff
+    header = struct.pack("<II", state, seq_no) + b'\xfe' + b'\xff' * 19
+    header += struct.pack("<I", nvs_crc32(header[4:28]))
+    body = b''.join(entries) + b'\xff' * (32 * (NVS_ENTRY_COUNT - len(entries)))
+    return header + bytes(bitmap) + body
+
+def nvs_partition(page_count, blob_ratio=0.3, str_ratio=0.3, max_blob=100, seed=1):
+    """Full NVS pages with a namespace entry each and a mix of U32, STR and
+    BLOB_DATA/BLOB_IDX entries."""
+    rnd = random.Random(seed)
+    pages = []
+    for page_num in range(page_count):
+        ns = page_num % 254 + 1
+        entries = [nvs_entry(0, 0x01, 1, 0xff, "ns%d" % page_num, bytes([ns]))]
+        while True:
+            key = "k%d" % len(entries)
+            pick = rnd.random()
+            if pick < blob_ratio:
+                blob = bytes(rnd.getrandbits(8) for _ in range(rnd.randint(1, max_blob)))
+                new = nvs_span(ns, 0x42, 0, key, blob)
+                new.append(nvs_entry(ns, 0x48, 1, 0xff, key, struct.pack("<IBBH", len(blob), 1, 0, 0xffff)))
+            elif pick < blob_ratio + str_ratio:
+                new = nvs_span(ns, 0x21, 0xff, key, b"value-%d\x00" % rnd.getrandbits(40))
+            else:
+                new = [nvs_entry(ns, 0x04, 1, 0xff, key, struct.pack("<I", rnd.getrandbits(32)))]
+            if len(entries) + len(new) > NVS_ENTRY_COUNT:
+                break
+            entries += new
+        pages.append(nvs_page(page_num, entries))
+    return b''.join(pages)
+
+PARTITION_TABLE_OFFSET = 0x8000
+
+# where each kind of app segment gets loaded on an ESP32
+DROM_ADDR = 0x3F400020
+DRAM_ADDR = 0x3FFB0000
+IRAM_ADDR = 0x40080000
+IROM_ADDR = 0x400D0018
+
+def random_bytes(rnd, length):
+    return rnd.getrandbits(length * 8).to_bytes(length, 'little') if length else b''
+
+def app_image(segments, entrypoint=IRAM_ADDR + 0x400, chip_id=0):
+    """An app image: header, (addr, data) segments, checksum and the
+    appended SHA-256, the way esptool's elf2image lays it out. chip_id
+    goes into the extended header (0 for the ESP32)."""
+    image = bytearray(struct.pack("<BBBBI", 0xE9, len(segments), 2, 0x20, entrypoint))
+    # extended header: wp pin, drive settings, chip id, min rev, reserved, hash appended
+    image += struct.pack("<BBBBHB8sB", 0xEE, 0, 0, 0, chip_id, 0, b'\x00' * 8, 1)
+    checksum = 0xEF
+    for addr, data in segments:
+        image += struct.pack("<II", addr, len(data)) + data
+        for b in data:
+            checksum ^= b
+    image += b'\x00' * (15 - len(image) % 16) + bytes([checksum])
+    image += hashlib.sha256(image).digest()
+    return bytes(image)
+
+def app_segments(app_size, segment_count=5, seed=1):
+    """segment_count (at least 4) segments adding up to roughly app_size bytes:
+    flash rodata and text take most of it, the rest is split over DRAM and
+    IRAM segments (first IRAM one being the vectors)."""
+    rnd = random.Random(seed)
+    segment_count = max(4, segment_count)
+    drom = (app_size // 3) & ~3
+    irom = (app_size // 2) & ~3
+    ram_count = segment_count - 2
+    ram_size = max(4, ((app_size - drom - irom) // ram_count) & ~3)
+
+    segments = [(DROM_ADDR, random_bytes(rnd, drom))]
+    # the first RAM segment is DRAM, the rest consecutive IRAM
+    segments.append((DRAM_ADDR, random_bytes(rnd, ram_size)))
+    iram_addr = IRAM_ADDR
+    for _ in range(ram_count - 1):
+        segments.append((iram_addr, random_bytes(rnd, ram_size)))
+        iram_addr += ram_size
+    segments.append((IROM_ADDR, random_bytes(rnd, irom)))
+    return segments
+
+def partition_entry(label, part_type, subtype, offset, size, flags=0):
+    return struct.pack("<2sBBII16sI", b'\xaa\x50', part_type, subtype, offset, size,
+                       label.encode('ascii'), flags)
+
+def partition_table(partitions):
+    # entries, then the MD5 entry over them, then 0xff padding
+    table = b''.join(partition_entry(*part) for part in partitions)
+    table += b'\xeb\xeb' + b'\xff' * 14 + hashlib.md5(table).digest()
+    return table.ljust(0xC00, b'\xff')
+
+def align_up(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+def flash_image(flash_size=4 << 20, app_size=512 << 10, app_count=2, segment_count=5,
+                nvs_pages=6, nvs_count=1, blob_ratio=0.3, str_ratio=0.3, seed=1):
+    """A complete flash dump: partition table at 0x8000, nvs_count NVS
+    partitions of nvs_pages pages each, otadata, phy_init and app_count OTA
+    slots each holding the same app image. Unused space is erased (0xff).
+
+    Returns (image bytes, partitions) with partitions as
+    (label, type, subtype, offset, size) tuples."""
+    app = app_image(app_segments(app_size, segment_count, seed))
+    nvs = nvs_partition(nvs_pages, blob_ratio, str_ratio, seed=seed)
+
+    partitions = []
+    offset = 0x9000
+    for i in range(nvs_count):
+        partitions.append(("nvs" if i == 0 else "nvs%d" % i, 1, 2, offset, len(nvs)))
+        offset += len(nvs)
+    partitions.append(("otadata", 1, 0, offset, 0x2000))
+    offset += 0x2000
+    partitions.append(("phy_init", 1, 1, offset, 0x1000))
+    offset += 0x1000
+
+    # app partitions are 64 KB aligned
+    slot_size = align_up(len(app), 0x10000)
+    offset = align_up(offset, 0x10000)
+    for i in range(app_count):
+        partitions.append(("ota_%d" % i, 0, 0x10 | i, offset, slot_size))
+        offset += slot_size
+
+    if offset > flash_size:
+        raise ValueError("%d bytes of partitions don't fit in a %d byte flash" % (offset, flash_size))
+
+    image = bytearray(b'\xff' * flash_size)
+    image[PARTITION_TABLE_OFFSET:PARTITION_TABLE_OFFSET + 0xC00] = partition_table(partitions)
+    for label, part_type, subtype, part_offset, size in partitions:
+        if part_type == 0:
+            image[part_offset:part_offset + len(app)] = app
+        elif subtype == 2:
+            image[part_offset:part_offset + len(nvs)] = nvs
+    return bytes(image), partitions
@@ -0,0 +1,120 @@
+import os
+import glob
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from esp32_symbols import DEFAULT_SYMBOLS
+from esp32_sources import list_source_members, split_source
+from esp32_image_parser import image_base_name
+from esp32_extract import extract_image, image_failed, load_manifest
+import esp32_timings
+
+def find_images(spec):
+    # a directory means every regular file in it, anything else is a glob;
+    # tar and zip archives stand for every file in them, as archive:member
+    if os.path.isdir(spec):
+        paths = [os.path.join(spec, name) for name in os.listdir(spec)]
+    else:
+        paths = glob.glob(spec)
+    images = []
+    for path in sorted(p for p in paths if os.path.isfile(p)):
+        members = list_source_members(path)
+        images += [path] if members is None else members
+    return images
+
+def output_dirs(images, out_root):
+    # one output tree per image, de-duplicating identical base names
+    seen = {}
+    dirs = []
+    for path in images:
+        name = image_base_name(path)
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        if count:
+            name = "%s_%d" % (name, count)
+        dirs.append(os.path.join(out_root, name))
+    return dirs
+
+def process_image(path, out_dir, symbols=DEFAULT_SYMBOLS, cache=None, timings=False, previous=None, verify=False, dump_format="plain", keys=None):
+    """Run every applicable action on every partition of one flash dump.
+
+    Runs inside a pool worker, one partition at a time; returns the
+    manifest record for the image, and with timings the worker's phase
+    timings under "timings" for the parent to collect. previous is the
+    image's record from an earlier batch manifest, if any; verify adds
+    integrity checks to the record. dump_format is how raw partitions are
+    written, see dump_bytes(); keys decrypt flash encrypted dumps.
+
+    An archive member that isn't a flash image, say a README next to the
+    dump, is skipped rather than failed: the record says why under
+    "skipped". A file on its own that isn't one is still an error."""
+    if timings:
+        esp32_timings.enable()
+    with esp32_timings.phase("process_image"):
+        result = extract_image(path, out_dir, 1, symbols, raw_always=True, cache=cache, previous=previous, verify=verify, dump_format=dump_format, keys=keys)
+    if result.get("not_image") and split_source(path)[1] is not None:
+        result["skipped"] = "not a flash image"
+        result["errors"] = []
+        try:
+            os.rmdir(out_dir)
+        except OSError:
+            pass
+    if timings:
+        result["timings"] = esp32_timings.drain()
+    return result
+
+def image_status(result):
+    # ok / FAILED, plus failed integrity checks and how much changed when there was an earlier run to compare with
+    if image_failed(result):
+        return "FAILED " + "; ".join(result["errors"]) if result["errors"] else "FAILED"
+    if "skipped" in result:
+        return "skipped, " + result["skipped"]
+    status = "ok"
+    if result.get("integrity_ok") is False:
+        status += ", integrity FAILED"
+    if "changed_regions" in result:
+        changed = [p["label"] for p in result["partitions"] if p.get("status") != "unchanged"]
+        status += ", changed: " + ", ".join(changed) if changed else ", unchanged"
+    return status
+
+def run_batch(spec, out_root, jobs=None, symbols=DEFAULT_SYMBOLS, cache=None, timings=False, previous=None, verify=False, dump_format="plain", keys=None):
+    # previous: manifest.json of an earlier batch run, matched up by image path
+    images = find_images(spec)
+    if not images:
+        print("No images found for '" + spec + "'")
+        return None
+
+    os.makedirs(out_root, exist_ok=True)
+    dirs = output_dirs(images, out_root)
+    results = [None] * len(images)
+    previous_images = {}
+    if previous:
+        previous_images = {r["image"]: r for r in load_manifest(previous)["images"]}
+
+    print("Processing %d images with %d workers" % (len(images), jobs or os.cpu_count()))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(process_image, path, out_dir, symbols, cache, timings, previous_images.get(path, {}) if previous else None, verify, dump_format, keys): i for i, (path, out_dir) in enumerate(zip(images, dirs))}
+        done = 0
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+                esp32_timings.events.extend(results[i].pop("timings", []))
+            except Exception as e:
+                # the worker itself died, not just one of its actions
+                results[i] = {"image": images[i], "output_dir": dirs[i], "partitions": [], "errors": ["%s: %s" % (type(e).__name__, e)]}
+            done += 1
+            print("[%d/%d] %s %s" % (done, len(images), images[i], image_status(results[i])))
+
+    manifest = {
+        "images": results,
+        "image_count": len(results),
+        "failed": [r["image"] for r in results if image_failed(r)],
+        "skipped": [r["image"] for r in results if "skipped" in r],
+    }
+    if verify:
+        manifest["integrity_failed"] = [r["image"] for r in results if not r.get("integrity_ok")]
+    manifest_file = os.path.join(out_root, "manifest.json")
+    with open(manifest_file, 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    print("Wrote manifest to " + manifest_file)
+    return manifest
@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import hashlib
+from collections import OrderedDict
+
+# bump whenever the ELF or NVS JSON this tool writes changes, so stale
+# cache entries stop matching
+TOOL_VERSION = "2"
+
+DEFAULT_CACHE_MAX_MB = 1024
+
+# an entry's warnings are kept in a file next to it
+WARNINGS_SUFFIX = ".warnings.json"
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".cache", "esp32_image_parser", "results")
+
+def result_key(kind, data, *parts, digest=None):
+    """Content address of one output: what it is, which tool/symbol version
+    made it, and the bytes of the partition it was made from. digest, the
+    sha256 hex digest of data, saves hashing data again when the caller
+    already has it."""
+    if digest is None:
+        digest = hashlib.sha256(data).hexdigest()
+    key = "%s\0%s\0%s\0%s" % (kind, TOOL_VERSION, "\0".join(parts), digest)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+class ResultCache(object):
+    """On-disk cache of built outputs, keyed by result_key().
+
+    Entries are plain files under directory/<2 hex>/<key>; an entry's mtime
+    is bumped on every hit and the least recently used ones are evicted once
+    the cache grows past max_bytes. Safe to share between processes: entries
+    appear atomically and a vanished entry is simply rebuilt."""
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_CACHE_MAX_MB << 20):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def lookup(self, key):
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def warnings(self, path):
+        # the warnings stored with an entry; FileNotFoundError if it has none on record
+        with open(path + WARNINGS_SUFFIX) as fh:
+            return json.load(fh)
+
+    def store(self, key, build, warnings=None):
+        """Add an entry: build(filename) writes the output and returns the
+        warnings about it (None for none), unless warnings are given. The
+        entry lands in the cache atomically, after its warnings."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        warnings_tmp = "%s%s.%d.tmp" % (path, WARNINGS_SUFFIX, os.getpid())
+        try:
+            built = build(tmp)
+            with open(warnings_tmp, 'w') as fh:
+                json.dump(list(built or []) if warnings is None else list(warnings), fh)
+            os.replace(warnings_tmp, path + WARNINGS_SUFFIX)
+            os.replace(tmp, path)
+        finally:
+            for name in (tmp, warnings_tmp):
+                if os.path.exists(name):
+                    os.remove(name)
+        self.evict()
+        return path
+
+    def entries(self):
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.is_file() and not entry.name.endswith((".tmp", WARNINGS_SUFFIX)):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, stat.st_mtime, stat.st_size
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            for name in (path, path + WARNINGS_SUFFIX):
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+def cached_build(cache, key, dest, build):
+    """Produce an output through the cache.
+
+    build(filename) writes the output and returns the warnings about it
+    (None for none); dest is a filename or None for stdout. The warnings
+    are kept with the cache entry, so a hit hands back what the build said.
+    Returns (True when the output came from the cache, warnings)."""
+    if cache is None:
+        return False, list(build(dest) or [])
+
+    path = cache.lookup(key)
+    if path is not None:
+        try:
+            warnings = cache.warnings(path)
+            copy_out(path, dest)
+            return True, warnings
+        except FileNotFoundError:
+            # evicted by another process in between, or stored without its
+            # warnings: build it again
+            pass
+
+    # built outside the cache, which may evict the new entry straight away
+    out = dest
+    if dest is None:
+        fd, out = tempfile.mkstemp(suffix=".tmp")
+        os.close(fd)
+    try:
+        warnings = list(build(out) or [])
+        cache.store(key, lambda filename: shutil.copyfile(out, filename), warnings)
+        if dest is None:
+            copy_out(out, None)
+    finally:
+        if dest is None:
+            os.remove(out)
+    return False, warnings
+
+def copy_out(path, dest):
+    if dest is None:
+        with open(path, 'rb') as fh:
+            sys.stdout.flush()
+            shutil.copyfileobj(fh, sys.stdout.buffer)
+            sys.stdout.buffer.flush()
+    else:
+        shutil.copyfile(path, dest)
+
+class MemoryCache(object):
+    """In-memory LRU of byte strings (built outputs keyed by result_key(),
+    decompressed image blocks), holding at most max_bytes of them."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.size -= len(old)
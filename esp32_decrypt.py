@@ -0,0 +1,388 @@
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from esp32_firmware_reader import PARTITION_TABLE_OFFSET, erased_extents, read_partition_table
+from esp32_sources import RandomAccessImage
+from read_nvs import NVS_PAGE_SIZE, NVS_ENTRY_COUNT, nvs_crc32
+
+# flash encryption covers the bootloader and partition table sectors, app
+# partitions and partitions flagged encrypted; NVS has its own encryption
+FLASH_ENCRYPTED_END = PARTITION_TABLE_OFFSET + 0x1000
+PART_FLAG_ENCRYPTED = 0x1
+PART_SUBTYPE_NVS_KEYS = 0x04
+PARTITION_TABLE_MAGIC = b'\xaa\x50'
+
+# ESP32: AES-256, each 32 byte block with its own key, the flash key XORed
+# with bits of the block's offset. FLASH_CRYPT_CONFIG picks which key bits
+# get tweaked; the multipliers spread offset bits over the key the way the
+# hardware does (see espsecure.py)
+ESP32_BLOCK_SIZE = 32
+DEFAULT_FLASH_CRYPT_CONF = 0xF
+ESP32_TWEAK_RANGES = (
+    0xFFFFFFFFFFFFFFFFE00000000000000000000000000000000000000000000000,
+    0x00000000000000001FFFFFFFFFFFFFFFF0000000000000000000000000000000,
+    0x000000000000000000000000000000000FFFFFFFFFFFFFFFE000000000000000,
+    0x0000000000000000000000000000000000000000000000001FFFFFFFFFFFFFFF,
+)
+ESP32_TWEAK_MUL1 = 0x0000200004000080000004000080001000000200004000080000040000800010
+ESP32_TWEAK_MUL2 = 0x0000000000000000200000000000000010000000000000002000000000000001
+ESP32_TWEAK_MUL2_MASK = 0x000000000000007FE00000000000000FF000000000000007E00000000000000F
+
+# ESP32-S2 / S3 / C3: XTS-AES-128 (32 byte key) or XTS-AES-256 (64 byte
+# key) over 128 byte data units tweaked with the unit's flash offset
+XTS_UNIT_SIZE = 0x80
+# NVS encryption: XTS-AES-256 over each 32 byte entry, tweaked with the
+# entry's offset in the partition; keys from the nvs_keys partition
+NVS_XTS_UNIT_SIZE = 32
+NVS_KEYS_SIZE = 64
+
+# flash decryption runs DECRYPT_CHUNK_SIZE at a time, reads of at least
+# DECRYPT_PARALLEL_MIN_BYTES spread over the worker processes
+DECRYPT_CHUNK_SIZE = 1 << 20
+DECRYPT_PARALLEL_MIN_BYTES = 4 << 20
+
+numpy = None
+numpy_checked = False
+aes_tables = None
+
+def load_numpy():
+    global numpy, numpy_checked
+    if not numpy_checked:
+        numpy_checked = True
+        try:
+            import numpy
+        except ImportError:
+            pass
+    return numpy
+
+def aes_ecb(key, data, decrypt=False):
+    # one ECB pass over all of data
+    try:
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    except ImportError:
+        raise RuntimeError("flash decryption needs the cryptography package (pip install cryptography)")
+    cipher = Cipher(algorithms.AES(key), modes.ECB())
+    op = cipher.decryptor() if decrypt else cipher.encryptor()
+    return op.update(data) + op.finalize()
+
+class FlashKeys(object):
+    """What it takes to read an encrypted flash dump: the flash encryption
+    key (and on the ESP32 the FLASH_CRYPT_CONFIG efuse), the NVS
+    encryption keys, and how many worker processes decrypt large reads.
+    Either key may be None; without nvs_key the keys are read from the
+    nvs_keys partition."""
+
+    def __init__(self, flash_key=None, nvs_key=None, flash_crypt_conf=DEFAULT_FLASH_CRYPT_CONF, jobs=1):
+        self.flash_key = flash_key
+        self.nvs_key = nvs_key
+        self.flash_crypt_conf = flash_crypt_conf
+        self.jobs = jobs
+
+def load_flash_keys(flash_key_file=None, nvs_key_file=None, jobs=1):
+    """FlashKeys from key files, None if neither is given. A 24 byte ESP32
+    key (3/4 coding scheme) is extended the way the hardware does it. The
+    NVS key file is an nvs_keys partition image, or its first 64 bytes."""
+    if flash_key_file is None and nvs_key_file is None:
+        return None
+    flash_key = nvs_key = None
+    if flash_key_file is not None:
+        with open(flash_key_file, 'rb') as fh:
+            flash_key = fh.read()
+        if len(flash_key) == 24:
+            flash_key += flash_key[8:16]
+        if len(flash_key) not in (32, 64):
+            raise ValueError("%s: flash encryption key of %d bytes, expected 24, 32 or 64" % (flash_key_file, len(flash_key)))
+    if nvs_key_file is not None:
+        with open(nvs_key_file, 'rb') as fh:
+            nvs_key = fh.read(NVS_KEYS_SIZE)
+        if len(nvs_key) != NVS_KEYS_SIZE:
+            raise ValueError("%s: NVS keys of %d bytes, expected %d" % (nvs_key_file, len(nvs_key), NVS_KEYS_SIZE))
+    return FlashKeys(flash_key, nvs_key, jobs=jobs)
+
+def xtime(b):
+    return ((b << 1) ^ (0x1B if b & 0x80 else 0)) & 0xFF
+
+def load_aes_tables(np):
+    # S-box and the four encryption T-tables as NumPy arrays, built once
+    global aes_tables
+    if aes_tables is not None:
+        return aes_tables
+    sbox = [0x63] * 256
+    p = q = 1
+    while True:
+        # p steps through GF(2^8) multiplying by 3 while q = 1/p divides by 3
+        p ^= xtime(p)
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xFF
+        if q & 0x80:
+            q ^= 0x09
+        rotated = q ^ ((q << 1) | (q >> 7)) ^ ((q << 2) | (q >> 6)) ^ ((q << 3) | (q >> 5)) ^ ((q << 4) | (q >> 4))
+        sbox[p] = (rotated & 0xFF) ^ 0x63
+        if p == 1:
+            break
+    t0 = [(xtime(s) << 24) | (s << 16) | (s << 8) | (xtime(s) ^ s) for s in sbox]
+    tables = [t0] + [[(t >> shift) | ((t << (32 - shift)) & 0xFFFFFFFF) for t in t0] for shift in (8, 16, 24)]
+    aes_tables = (np.array(sbox, dtype=np.uint32), [np.array(t, dtype=np.uint32) for t in tables])
+    return aes_tables
+
+def aes256_encrypt_batch(np, keys, blocks):
+    """AES-256 encryption where every 32 byte key in keys encrypts its own
+    run of 16 byte blocks (len(blocks) // len(keys) * 32 bytes each). All
+    key schedules and all rounds are NumPy operations over the whole batch,
+    not a cipher object per key."""
+    sbox, (t0, t1, t2, t3) = load_aes_tables(np)
+
+    def sub_word(w):
+        return (sbox[w >> 24] << 24) | (sbox[(w >> 16) & 0xFF] << 16) | (sbox[(w >> 8) & 0xFF] << 8) | sbox[w & 0xFF]
+
+    k = np.frombuffer(keys, dtype='>u4').reshape(-1, 8).astype(np.uint32)
+    w = np.empty((60, len(k)), dtype=np.uint32)
+    w[:8] = k.T
+    rcon = 1
+    for i in range(8, 60):
+        t = w[i - 1]
+        if i % 8 == 0:
+            t = sub_word((t << 8) | (t >> 24)) ^ np.uint32(rcon << 24)
+            rcon = xtime(rcon)
+        elif i % 8 == 4:
+            t = sub_word(t)
+        w[i] = w[i - 8] ^ t
+
+    words = np.frombuffer(blocks, dtype='>u4').reshape(len(k), -1, 4).astype(np.uint32)
+    s = [words[:, :, c] ^ w[c][:, None] for c in range(4)]
+    for r in range(1, 14):
+        s = [t0[s[c] >> 24] ^ t1[(s[(c + 1) % 4] >> 16) & 0xFF] ^ t2[(s[(c + 2) % 4] >> 8) & 0xFF]
+             ^ t3[s[(c + 3) % 4] & 0xFF] ^ w[4 * r + c][:, None] for c in range(4)]
+    s = [((sbox[s[c] >> 24] << 24) | (sbox[(s[(c + 1) % 4] >> 16) & 0xFF] << 16)
+          | (sbox[(s[(c + 2) % 4] >> 8) & 0xFF] << 8) | sbox[s[(c + 3) % 4] & 0xFF]) ^ w[56 + c][:, None] for c in range(4)]
+    return np.stack(s, axis=-1).astype('>u4').tobytes()
+
+def esp32_block_keys(key, offset, count, flash_crypt_conf=DEFAULT_FLASH_CRYPT_CONF):
+    # the tweaked keys of count 32 byte blocks from offset on, concatenated
+    tweak_range = 0
+    for bit, mask in enumerate(ESP32_TWEAK_RANGES):
+        if flash_crypt_conf & (1 << bit):
+            tweak_range |= mask
+    key = int.from_bytes(key, 'big')
+    keys = []
+    for addr in range(offset >> 5, (offset >> 5) + count):
+        tweak = ((ESP32_TWEAK_MUL1 * addr) | ((ESP32_TWEAK_MUL2 * addr) & ESP32_TWEAK_MUL2_MASK)) & tweak_range
+        keys.append((key ^ tweak).to_bytes(32, 'big'))
+    return b''.join(keys)
+
+def esp32_decrypt(data, offset, key, flash_crypt_conf=DEFAULT_FLASH_CRYPT_CONF):
+    """Decrypt ESP32 flash: data (a multiple of 32 bytes) read from offset.
+    The hardware runs AES backwards, so decryption is AES encryption, of
+    each 16 byte block byte-reversed."""
+    count = len(data) // ESP32_BLOCK_SIZE
+    keys = esp32_block_keys(key, offset, count, flash_crypt_conf)
+    np = load_numpy()
+    if np is not None:
+        blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, 16)[:, ::-1].tobytes()
+        plain = aes256_encrypt_batch(np, keys, blocks)
+        return np.frombuffer(plain, dtype=np.uint8).reshape(-1, 16)[:, ::-1].tobytes()
+    # without NumPy every block needs a cipher of its own
+    out = []
+    for i in range(count):
+        block = data[i * ESP32_BLOCK_SIZE:(i + 1) * ESP32_BLOCK_SIZE]
+        reversed_block = bytes(block[15::-1]) + bytes(block[:15:-1])
+        plain = aes_ecb(keys[i * 32:(i + 1) * 32], reversed_block)
+        out.append(plain[15::-1] + plain[:15:-1])
+    return b''.join(out)
+
+def xts_decrypt(data, key, tweaks, unit):
+    """XTS-AES decryption of len(tweaks) data units of unit bytes, unit i
+    tweaked with the little-endian 128 bit number tweaks[i].
+
+    Batched: the tweaks of all units are encrypted in one ECB pass, their
+    multiples for each 16 byte block are worked out for all units at once
+    on big integers (a lane per unit), and the data goes through one more
+    ECB pass between two XORs with those masks."""
+    count = len(tweaks)
+    lanes = unit // 16
+    half = len(key) // 2
+    tweak = int.from_bytes(aes_ecb(key[half:], b''.join(t.to_bytes(16, 'little') for t in tweaks)), 'little')
+    top_bits = int.from_bytes((b'\0' * 15 + b'\x80') * count, 'little')
+
+    mask = bytearray(len(data))
+    words = memoryview(mask).cast('Q')
+    for j in range(lanes):
+        lane_words = memoryview(tweak.to_bytes(count * 16, 'little')).cast('Q')
+        words[2 * j::2 * lanes] = lane_words[0::2]
+        words[2 * j + 1::2 * lanes] = lane_words[1::2]
+        # multiply every lane by x in GF(2^128)
+        top = tweak & top_bits
+        tweak = ((tweak ^ top) << 1) ^ ((top >> 127) * 0x87)
+    mask = int.from_bytes(mask, 'little')
+
+    data = (int.from_bytes(data, 'little') ^ mask).to_bytes(len(data), 'little')
+    plain = aes_ecb(key[:half], data, decrypt=True)
+    return (int.from_bytes(plain, 'little') ^ mask).to_bytes(len(data), 'little')
+
+def xts_flash_decrypt(data, offset, key):
+    # each 128 byte unit is byte-reversed around the cipher; reversing the
+    # whole buffer does that but also puts the units backwards, so do the tweaks
+    count = len(data) // XTS_UNIT_SIZE
+    tweaks = [offset + XTS_UNIT_SIZE * i for i in reversed(range(count))]
+    return xts_decrypt(bytes(data)[::-1], key, tweaks, XTS_UNIT_SIZE)[::-1]
+
+def flash_decrypt(data, offset, scheme, key, flash_crypt_conf=DEFAULT_FLASH_CRYPT_CONF):
+    """Decrypt data read from flash offset with scheme "esp32" or "xts".
+    Erased units come back as they are: they were never written, and
+    0xff keeps them recognisable as empty."""
+    unit = ESP32_BLOCK_SIZE if scheme == "esp32" else XTS_UNIT_SIZE
+    if scheme == "esp32":
+        plain = esp32_decrypt(data, offset, key, flash_crypt_conf)
+    else:
+        plain = xts_flash_decrypt(data, offset, key)
+    erased = erased_extents(memoryview(data), unit)
+    if not erased:
+        return plain
+    plain = bytearray(plain)
+    for start, end in erased:
+        plain[start:end] = data[start:end]
+    return bytes(plain)
+
+def decrypt_chunk(args):
+    # runs in a pool worker: flash_decrypt() of one chunk
+    return flash_decrypt(*args)
+
+def nvs_entry_crc_ok(entry):
+    return nvs_crc32(bytes(entry[0:4]) + bytes(entry[8:32])) == struct.unpack_from("<I", entry, 4)[0]
+
+def nvs_decrypt_pages(data, base, key):
+    """Decrypt the entries of whole NVS pages, the first one at byte base
+    of the partition. Page headers and entry state bitmaps are stored in
+    the clear, and so are entries never written, all 0xff."""
+    pages = [start for start in range(0, len(data), NVS_PAGE_SIZE)
+             if data[start:start + 4] != b'\xff\xff\xff\xff']
+    if not pages:
+        return data
+    entries_size = NVS_ENTRY_COUNT * NVS_XTS_UNIT_SIZE
+    first_entry = NVS_PAGE_SIZE - entries_size
+    tweaks = [base + start + first_entry + NVS_XTS_UNIT_SIZE * i for start in pages for i in range(NVS_ENTRY_COUNT)]
+    plain = xts_decrypt(b''.join(data[start + first_entry:start + NVS_PAGE_SIZE] for start in pages), key, tweaks, NVS_XTS_UNIT_SIZE)
+
+    out = bytearray(data)
+    for n, start in enumerate(pages):
+        out[start + first_entry:start + NVS_PAGE_SIZE] = plain[n * entries_size:(n + 1) * entries_size]
+        for entry in range(start + first_entry, start + NVS_PAGE_SIZE, NVS_XTS_UNIT_SIZE):
+            if data[entry:entry + NVS_XTS_UNIT_SIZE] == b'\xff' * NVS_XTS_UNIT_SIZE:
+                out[entry:entry + NVS_XTS_UNIT_SIZE] = data[entry:entry + NVS_XTS_UNIT_SIZE]
+    return bytes(out)
+
+def nvs_encrypted(data, key):
+    # whether an NVS partition is encrypted with key: the first written
+    # entry passes its CRC either as it is or decrypted (or neither, corrupt)
+    first_entry = NVS_PAGE_SIZE - NVS_ENTRY_COUNT * NVS_XTS_UNIT_SIZE
+    for start in range(0, len(data) - NVS_PAGE_SIZE + 1, NVS_PAGE_SIZE):
+        if data[start:start + 4] == b'\xff\xff\xff\xff':
+            continue
+        for entry in range(start + first_entry, start + NVS_PAGE_SIZE, NVS_XTS_UNIT_SIZE):
+            raw = bytes(data[entry:entry + NVS_XTS_UNIT_SIZE])
+            if raw == b'\xff' * NVS_XTS_UNIT_SIZE:
+                continue
+            if nvs_entry_crc_ok(raw):
+                return False
+            if nvs_entry_crc_ok(xts_decrypt(raw, key, [entry], NVS_XTS_UNIT_SIZE)):
+                return True
+    return False
+
+def flash_scheme(image, key, flash_crypt_conf=DEFAULT_FLASH_CRYPT_CONF):
+    # "esp32" or "xts", whichever turns the partition table into one; None if it isn't encrypted
+    table = image[PARTITION_TABLE_OFFSET:PARTITION_TABLE_OFFSET + XTS_UNIT_SIZE].tobytes()
+    if table[:2] == PARTITION_TABLE_MAGIC:
+        return None
+    for scheme in (("esp32", "xts") if len(key) == 32 else ("xts",)):
+        if flash_decrypt(table, PARTITION_TABLE_OFFSET, scheme, key, flash_crypt_conf)[:2] == PARTITION_TABLE_MAGIC:
+            return scheme
+    raise ValueError("the flash encryption key doesn't decrypt the partition table")
+
+class DecryptedImage(RandomAccessImage):
+    """A flash encrypted image the way the chip reads it. Slices of the
+    bootloader, partition table, app partitions and partitions flagged
+    encrypted are decrypted with the flash key (ESP32 or XTS scheme, told
+    apart by which one yields a partition table), NVS partitions encrypted
+    with the NVS keys are decrypted page by page, everything else reads
+    through.
+
+    Nothing is decrypted ahead of time: each slice decrypts the range it
+    covers, whole partitions in one batch, large ones by keys.jobs worker
+    processes DECRYPT_CHUNK_SIZE at a time."""
+
+    def __init__(self, base, keys):
+        self.base = base
+        self.keys = keys
+        self.pool = None
+        self.lock = threading.Lock()
+        self.regions = []
+        self.scheme = None
+        if keys.flash_key is not None:
+            self.scheme = flash_scheme(base, keys.flash_key, keys.flash_crypt_conf)
+        if self.scheme is not None:
+            self.regions.append((0, FLASH_ENCRYPTED_END, "flash"))
+
+        part_table = read_partition_table(self)
+        if self.scheme is not None:
+            for part in part_table.values():
+                if part["type"] == 0 or part["flags"][0] & PART_FLAG_ENCRYPTED:
+                    self.regions.append((part["offset"], part["offset"] + part["size"], "flash"))
+
+        self.nvs_key = keys.nvs_key
+        if self.nvs_key is None:
+            for part in part_table.find(type=1, subtype=PART_SUBTYPE_NVS_KEYS):
+                self.nvs_key = self.read_nvs_keys(part)
+                break
+        if self.nvs_key is not None:
+            for part in part_table.find(type=1, subtype=2):
+                if nvs_encrypted(self[part["offset"]:part["offset"] + part["size"]], self.nvs_key):
+                    self.regions.append((part["offset"], part["offset"] + part["size"], "nvs"))
+
+    def read_nvs_keys(self, part):
+        # the keys at the start of the nvs_keys partition, followed by their CRC32; None if it's erased
+        data = self[part["offset"]:part["offset"] + NVS_KEYS_SIZE + 4].tobytes()
+        if data[:NVS_KEYS_SIZE] == b'\xff' * NVS_KEYS_SIZE:
+            return None
+        if nvs_crc32(data[:NVS_KEYS_SIZE]) != struct.unpack_from("<I", data, NVS_KEYS_SIZE)[0]:
+            raise ValueError("nvs_keys partition '%s' fails its CRC, pass the NVS keys instead" % part["label"])
+        return data[:NVS_KEYS_SIZE]
+
+    def size(self):
+        return len(self.base)
+
+    def read_range(self, start, stop):
+        raw = self.base[start:stop]
+        stop = start + len(raw)
+        out = None
+        for region_start, region_end, kind in self.regions:
+            first, last = max(start, region_start), min(stop, region_end)
+            if first >= last:
+                continue
+            # decrypt whole units (pages for NVS), counted from the region start
+            unit = XTS_UNIT_SIZE if kind == "flash" else NVS_PAGE_SIZE
+            aligned_start = region_start + (first - region_start) // unit * unit
+            aligned_end = min(region_end, region_start + -(-(last - region_start) // unit) * unit)
+            plain = self.decrypt(kind, region_start, aligned_start, aligned_end)
+            if out is None:
+                out = bytearray(raw)
+            out[first - start:last - start] = plain[first - aligned_start:last - aligned_start]
+        return raw if out is None else memoryview(out).toreadonly()
+
+    def decrypt(self, kind, region_start, start, end):
+        data = self.base[start:end].tobytes()
+        if kind == "nvs":
+            return nvs_decrypt_pages(data, start - region_start, self.nvs_key)
+        chunks = [(data[i:i + DECRYPT_CHUNK_SIZE], start + i, self.scheme, self.keys.flash_key, self.keys.flash_crypt_conf)
+                  for i in range(0, len(data), DECRYPT_CHUNK_SIZE)]
+        if self.keys.jobs > 1 and len(data) >= DECRYPT_PARALLEL_MIN_BYTES:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ProcessPoolExecutor(max_workers=self.keys.jobs)
+            return b''.join(self.pool.map(decrypt_chunk, chunks))
+        return b''.join(decrypt_chunk(chunk) for chunk in chunks)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
@@ -0,0 +1,314 @@
+import os
+import json
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from esp32_firmware_reader import *
+from read_nvs import *
+from esp32_symbols import DEFAULT_SYMBOLS, symbols_version
+from esp32_cache import TOOL_VERSION, result_key, cached_build
+from esp32_image_parser import image2elf
+from esp32_verify import verify_partition, verify_bootloader, check_summary
+from esp32_timings import phase
+
+def is_nvs_partition(part):
+    # Wifi NVS partition (4 is for encryption key)
+    return part["type"] == 1 and part["subtype"] == 2
+
+def partition_outputs(part, raw_always=False):
+    # app partitions become ELFs, NVS partitions JSON, everything else a raw dump
+    if part["type"] == 0:
+        outputs = ["elf"]
+    elif is_nvs_partition(part):
+        outputs = ["nvs"]
+    else:
+        outputs = []
+    if raw_always or not outputs:
+        outputs.insert(0, "raw")
+    return outputs
+
+def output_names(part_table):
+    # file name stem per partition; a repeated label gets _1, _2, ...
+    seen = {}
+    names = []
+    for label, part in part_table.items():
+        count = seen.get(label, 0)
+        seen[label] = count + 1
+        names.append("%s_%d" % (label, count) if count else label)
+    return names
+
+# granularity of the change tracking between runs, one flash sector
+PAGE_SIZE = 0x1000
+
+def partition_hashes(part_data):
+    # sha256 of the whole partition, plus a short digest per 4 KB page
+    page_hashes = [hashlib.blake2b(part_data[start:start + PAGE_SIZE], digest_size=8).hexdigest()
+                   for start in range(0, len(part_data), PAGE_SIZE)]
+    return hashlib.sha256(part_data).hexdigest(), page_hashes
+
+def changed_pages(previous, part_result):
+    """Indexes of the pages that differ from the previous run's record of
+    the same partition, or None when there is nothing to compare against."""
+    if previous is None or "page_hashes" not in previous:
+        return None
+    old_hashes = previous["page_hashes"]
+    return [i for i, page_hash in enumerate(part_result["page_hashes"])
+            if i >= len(old_hashes) or old_hashes[i] != page_hash]
+
+def page_regions(pages, base, size):
+    # merge runs of page indexes into [start, end) flash offsets
+    regions = []
+    for i in pages:
+        start = base + i * PAGE_SIZE
+        end = min(start + PAGE_SIZE, base + size)
+        if regions and regions[-1][1] == start:
+            regions[-1][1] = end
+        else:
+            regions.append([start, end])
+    return regions
+
+# the part_result fields an output depends on besides the partition's bytes;
+# an earlier output is only reused when they all match
+OUTPUT_PRODUCERS = {
+    "raw": ("dump_format",),
+    "extents": ("dump_format",),
+    "elf": ("tool_version", "symbols_version"),
+    "nvs": ("tool_version",),
+}
+
+def same_producer(previous, kind, part_result):
+    # whether the previous run made its `kind` output the way this one would
+    return all(previous.get(field) == part_result.get(field) for field in OUTPUT_PRODUCERS[kind])
+
+def carry_output(previous, kind, dest, part_result):
+    """Reuse the previous run's output of an unchanged partition: copy it
+    to dest, or leave it if it is already there. Returns True if it did."""
+    if previous is None or part_result.get("status") != "unchanged":
+        return False
+    if not same_producer(previous, kind, part_result):
+        return False
+    old = previous.get("outputs", {}).get(kind)
+    if old is None or not os.path.isfile(old):
+        return False
+    if os.path.abspath(old) != os.path.abspath(dest):
+        shutil.copyfile(old, dest)
+    part_result["carried"].append(kind)
+    return True
+
+def carry_raw_output(previous, raw_file, part_result, dump_format):
+    # carry_output() for the raw dump and its extents sidecar; a copy of a
+    # sparse file would fill its holes in, so those are written again instead
+    if dump_format == "sparse":
+        return False
+    if not carry_output(previous, "raw", raw_file, part_result):
+        return False
+    if dump_format != "plain" and not carry_output(previous, "extents", raw_file + EXTENTS_SUFFIX, part_result):
+        part_result["carried"].remove("raw")
+        return False
+    return True
+
+def update_nvs_json(part_data, nvs_file, previous, part_result, pages):
+    """Write the NVS JSON by re-decoding only the changed pages on top of the
+    previous run's document. Returns False (and writes nothing) if that
+    can't be trusted: no previous document, one written by another tool
+    version, a different page count or a namespace that changed, which
+    would rename entries on other pages."""
+    if previous is None or previous.get("nvs_namespaces") != part_result["nvs_namespaces"]:
+        return False
+    if not same_producer(previous, "nvs", part_result):
+        return False
+    old = previous.get("outputs", {}).get("nvs")
+    if old is None or not os.path.isfile(old):
+        return False
+    with open(old) as fh:
+        old_pages = json.load(fh)
+    if len(old_pages) != len(part_data) // NVS_PAGE_SIZE:
+        return False
+    with open(nvs_file, 'w') as out:
+        write_nvs_json_update(part_data, out, old_pages, pages)
+    part_result["nvs_pages_decoded"] = len(pages)
+    return True
+
+def extract_partition(image, label, part, out_dir, outputs, symbols=DEFAULT_SYMBOLS, cache=None, name=None, previous=None, verify=False, dump_format="plain"):
+    """Write the requested outputs ("raw", "elf", "nvs") for one partition,
+    to files named after name (default: the label).
+
+    ELF and NVS JSON go through cache (a ResultCache) when one is given.
+    previous is this partition's record from an earlier run's manifest:
+    when its page hashes all match, the earlier outputs are carried forward
+    instead of being rebuilt, and a changed NVS partition only has its
+    changed pages decoded again; either only if the earlier output was
+    made by the same TOOL_VERSION, symbol set and dump format. With verify the record gets an
+    "integrity" entry, see esp32_verify.verify_partition(). dump_format is
+    how the raw output is written, see dump_bytes().
+    Returns the partition's manifest record; failures are recorded in it
+    rather than raised, so one bad partition doesn't sink the image."""
+    part_result = {"label": label, "type": part["type"], "subtype": part["subtype"],
+                   "offset": part["offset"], "size": part["size"], "outputs": {}, "cached": [], "carried": [], "errors": [], "warnings": [],
+                   "tool_version": TOOL_VERSION, "dump_format": dump_format}
+    part_data = image[part["offset"]:part["offset"] + part["size"]]
+    name = name or label
+    try:
+        with phase("hash_partition", len(part_data)):
+            part_result["sha256"], part_result["page_hashes"] = partition_hashes(part_data)
+        if verify:
+            with phase("verify_partition", len(part_data)):
+                integrity = verify_partition(part, part_data, hash_partition=False)
+            part_result["integrity"] = {k: integrity[k] for k in ("checks", "errors", "ok")}
+        pages = changed_pages(previous, part_result)
+        if previous is None:
+            pass
+        elif pages is None:
+            part_result["status"] = "new"
+            part_result["changed_regions"] = [[part["offset"], part["offset"] + part["size"]]]
+        else:
+            part_result["status"] = "changed" if pages or previous.get("sha256") != part_result["sha256"] else "unchanged"
+            part_result["changed_regions"] = page_regions(pages, part["offset"], part["size"])
+        if "elf" in outputs:
+            part_result["symbols_version"] = symbols_version(symbols)
+        if "nvs" in outputs:
+            part_result["nvs_namespaces"] = {str(k): v for k, v in sorted(nvs_namespaces(part_data).items())}
+
+        if "raw" in outputs:
+            raw_file = part_result["outputs"]["raw"] = os.path.join(out_dir, name + ".bin" + DUMP_FORMATS[dump_format])
+            if dump_format != "plain":
+                part_result["outputs"]["extents"] = raw_file + EXTENTS_SUFFIX
+            if not carry_raw_output(previous, raw_file, part_result, dump_format):
+                with phase("dump_bytes", len(part_data)):
+                    dump_bytes(part_data, 0, len(part_data), os.path.join(out_dir, name + ".bin"), dump_format=dump_format)
+        if "elf" in outputs and (not len(part_data) or part_data[0] == 0xFF):
+            # an erased OTA slot has no app image to build an ELF from
+            part_result["empty"] = True
+        elif "elf" in outputs:
+            elf_file = part_result["outputs"]["elf"] = os.path.join(out_dir, name + ".elf")
+            key = result_key("elf", part_data, part_result["symbols_version"], digest=part_result["sha256"]) if cache else None
+            if carry_output(previous, "elf", elf_file, part_result):
+                part_result["warnings"].extend(previous.get("warnings", []))
+            else:
+                with phase("image2elf", len(part_data)):
+                    build = lambda filename: image2elf(part_data, filename, False, label, symbols, quiet=True)
+                    hit, warnings = cached_build(cache, key, elf_file, build)
+                    part_result["warnings"].extend(warnings)
+                    if hit:
+                        part_result["cached"].append("elf")
+        if "nvs" in outputs:
+            nvs_file = part_result["outputs"]["nvs"] = os.path.join(out_dir, name + ".json")
+            key = result_key("nvs-json", part_data, digest=part_result["sha256"]) if cache else None
+            if not carry_output(previous, "nvs", nvs_file, part_result):
+                with phase("nvs_json", len(part_data)):
+                    if part_result.get("status") != "changed" or not update_nvs_json(part_data, nvs_file, previous, part_result, pages):
+                        if cached_build(cache, key, nvs_file, lambda filename: write_nvs_json_file(part_data, filename))[0]:
+                            part_result["cached"].append("nvs")
+    except Exception as e:
+        part_result["errors"].append("%s: %s" % (type(e).__name__, e))
+    return part_result
+
+def previous_partitions(previous):
+    # an earlier run's image record, as (label, offset, size) -> partition record
+    if previous is None:
+        return {}
+    return {(p["label"], p["offset"], p["size"]): p for p in previous.get("partitions", [])}
+
+def extract_image(path, out_dir, jobs=None, symbols=DEFAULT_SYMBOLS, raw_always=False, cache=None, previous=None, verify=False, dump_format="plain", keys=None):
+    """Parse the partition table of one flash dump once and extract every
+    partition from it, jobs partitions at a time. previous is the image's
+    record from an earlier run, see extract_partition(). With verify the
+    bootloader and every partition are integrity checked on the way and
+    integrity_ok sums it up.
+
+    Returns the image's manifest record. A file without a partition table
+    is an error, and the record gets not_image."""
+    result = {"image": path, "output_dir": out_dir, "partitions": [], "errors": []}
+    os.makedirs(out_dir, exist_ok=True)
+    previous_parts = previous_partitions(previous)
+
+    try:
+        with flash_image(path, keys) as image:
+            with phase("read_partition_table"):
+                part_table = read_partition_table(image)
+            if not len(part_table):
+                result["not_image"] = True
+                raise ValueError("no partition table at 0x%x, not a flash image" % PARTITION_TABLE_OFFSET)
+            result["table_md5_ok"] = part_table.md5_ok
+            if verify:
+                result["bootloader"] = verify_bootloader(image)
+
+            table_file = os.path.join(out_dir, "partitions.json")
+            with open(table_file, 'w') as fh:
+                json.dump([dict(part, label=label, flags=part["flags"].hex()) for label, part in part_table.items()], fh, indent=2)
+
+            work = [(image, label, part, out_dir, partition_outputs(part, raw_always), symbols, cache, name,
+                     previous_parts.get((label, part["offset"], part["size"]), {}) if previous is not None else None, verify, dump_format)
+                    for (label, part), name in zip(part_table.items(), output_names(part_table))]
+            if jobs == 1:
+                result["partitions"] = [extract_partition(*args) for args in work]
+            else:
+                # file writes release the GIL, so threads overlap the I/O
+                with ThreadPoolExecutor(max_workers=jobs) as pool:
+                    result["partitions"] = list(pool.map(lambda args: extract_partition(*args), work))
+    except Exception as e:
+        result["errors"].append("%s: %s" % (type(e).__name__, e))
+
+    if verify:
+        result["integrity_ok"] = (result.get("table_md5_ok") is not False
+                                  and (result.get("bootloader") is None or result["bootloader"]["ok"])
+                                  and all(p.get("integrity", {}).get("ok", False) for p in result["partitions"]))
+    if previous is not None:
+        result["changed_regions"] = [region for p in result["partitions"] for region in p.get("changed_regions", [])]
+    return result
+
+def load_manifest(filename):
+    with open(filename) as fh:
+        return json.load(fh)
+
+def partition_summary(part):
+    # one line of the extract_all / batch report
+    if part["errors"]:
+        return "FAILED " + "; ".join(part["errors"])
+    if not part["outputs"]:
+        return "empty" if part.get("empty") else "no outputs"
+    line = "-> " + ", ".join(part["outputs"].values())
+    if part.get("empty"):
+        line += " (empty)"
+    if "integrity" in part and not part["integrity"]["ok"]:
+        line += " (integrity " + check_summary(part["integrity"]) + ")"
+    if part.get("warnings"):
+        line += " (" + "; ".join(part["warnings"]) + ")"
+    if part["cached"]:
+        line += " (cached)"
+    status = part.get("status")
+    if status == "unchanged":
+        line += " (unchanged)"
+    elif status == "new":
+        line += " (new)"
+    elif status == "changed":
+        regions = ", ".join("%s-%s" % (hex(start), hex(end)) for start, end in part["changed_regions"])
+        line += " (changed: %s)" % (regions or "partition moved or resized")
+        if "nvs_pages_decoded" in part:
+            line += " (%d NVS pages decoded)" % part["nvs_pages_decoded"]
+    return line
+
+def image_failed(result):
+    return bool(result["errors"]) or any(p["errors"] for p in result["partitions"])
+
+def extract_all(path, out_dir, jobs=None, symbols=DEFAULT_SYMBOLS, cache=None, previous=None, verify=False, dump_format="plain", keys=None):
+    # previous: manifest.json of an earlier extract_all run on a dump of the same device
+    result = extract_image(path, out_dir, jobs, symbols, cache=cache,
+                           previous=load_manifest(previous) if previous else None, verify=verify, dump_format=dump_format, keys=keys)
+
+    for error in result["errors"]:
+        print("Error: " + error)
+    if result.get("table_md5_ok") is False:
+        print("Warning: partition table MD5 mismatch")
+    if result.get("bootloader") is not None:
+        print("  %-16s %s" % ("bootloader", check_summary(result["bootloader"])))
+    for part in result["partitions"]:
+        print("  %-16s %s" % (part["label"], partition_summary(part)))
+    if verify:
+        print("Integrity " + ("OK" if result["integrity_ok"] else "FAILED"))
+
+    manifest_file = os.path.join(out_dir, "manifest.json")
+    with open(manifest_file, 'w') as fh:
+        json.dump(result, fh, indent=2)
+    print("Wrote manifest to " + manifest_file)
+    return result
@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from esp32_firmware_reader import APP_IMAGE_MAGIC, flash_image, read_partition_table, read_app_image
+
+# content-defined chunking: a chunk ends where the top CHUNK_BITS bits of a
+# gear rolling hash over the last 64 bytes are all zero, so chunks average
+# 2 ** CHUNK_BITS bytes and an insertion only changes the chunks around it
+CHUNK_BITS = 8
+CHUNK_MASK = ((1 << CHUNK_BITS) - 1) << (64 - CHUNK_BITS)
+MASK64 = (1 << 64) - 1
+GEAR = [int.from_bytes(hashlib.blake2b(bytes([b]), digest_size=8).digest(), 'little') for b in range(256)]
+
+# one-permutation MinHash: chunk hashes are spread over SKETCH_BINS bins by
+# their top bits and each bin keeps its smallest value
+SKETCH_BINS = 128
+SKETCH_BIN_SHIFT = 64 - (SKETCH_BINS.bit_length() - 1)
+# LSH: two apps become candidates when all bins of one band match
+LSH_BAND_SIZE = 4
+
+DEFAULT_FINGERPRINTS = "fingerprints.json"
+DEFAULT_SIMILARITY = 0.8
+
+# below this many bytes the pure Python rolling hash is quicker than importing NumPy
+FINGERPRINT_NUMPY_MIN_BYTES = 512 << 10
+numpy = None
+numpy_checked = False
+
+def load_numpy(size):
+    global numpy, numpy_checked
+    if numpy_checked:
+        return numpy
+    if size < FINGERPRINT_NUMPY_MIN_BYTES and 'numpy' not in sys.modules:
+        return None
+    numpy_checked = True
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def chunk_ends(data):
+    # end offsets of the content-defined chunks of data, the last one included
+    ends = []
+    h = 0
+    for i, b in enumerate(data):
+        h = ((h << 1) + GEAR[b]) & MASK64
+        if not h & CHUNK_MASK:
+            ends.append(i + 1)
+    if not ends or ends[-1] != len(data):
+        ends.append(len(data))
+    return ends
+
+def chunk_ends_numpy(data, np):
+    # same as chunk_ends(): h[i] = sum(GEAR[data[i - j]] << j for j < 64),
+    # built up by doubling the window, 6 passes instead of one per byte
+    h = np.array(GEAR, dtype=np.uint64)[np.frombuffer(data, dtype=np.uint8)]
+    width = 1
+    while width < 64:
+        shifted = np.zeros_like(h)
+        shifted[width:] = h[:-width] << np.uint64(width)
+        h += shifted
+        width *= 2
+    ends = (np.flatnonzero((h & np.uint64(CHUNK_MASK)) == 0) + 1).tolist()
+    if not ends or ends[-1] != len(data):
+        ends.append(len(data))
+    return ends
+
+def sketch_update(sketch, data, np=None):
+    # fold the chunks of one segment into the sketch; returns the chunk count
+    ends = chunk_ends_numpy(data, np) if np is not None and len(data) else chunk_ends(data)
+    start = 0
+    for end in ends:
+        h = int.from_bytes(hashlib.blake2b(data[start:end], digest_size=8).digest(), 'little')
+        b = h >> SKETCH_BIN_SHIFT
+        if sketch[b] is None or h < sketch[b]:
+            sketch[b] = h
+        start = end
+    return len(ends)
+
+def similarity(a, b):
+    # estimated Jaccard similarity of the chunk sets behind two sketches
+    filled = [(x, y) for x, y in zip(a, b) if x is not None or y is not None]
+    if not filled:
+        return 1.0
+    return sum(1 for x, y in filled if x == y) / len(filled)
+
+def fingerprint_app(data):
+    """Per-segment SHA-256 digests and a MinHash sketch of one app partition.
+
+    Segments are parsed the way image2elf parses them. app_sha256 covers the
+    segment addresses and contents only, so the same build padded into
+    different sized slots fingerprints the same."""
+    image = read_app_image(data)
+    np = load_numpy(sum(len(seg.data) for seg in image.segments))
+
+    segments = []
+    sketch = [None] * SKETCH_BINS
+    chunks = 0
+    app_digest = hashlib.sha256()
+    for seg in sorted(image.segments, key=lambda s: s.addr):
+        digest = hashlib.sha256(seg.data).hexdigest()
+        segments.append({"addr": seg.addr, "size": len(seg.data), "name": seg.name, "sha256": digest})
+        app_digest.update(b"%08x%08x" % (seg.addr, len(seg.data)) + bytes.fromhex(digest))
+        chunks += sketch_update(sketch, seg.data, np)
+    return {
+        "chip": image.chip,
+        "entrypoint": image.entrypoint,
+        "checksum_ok": image.checksum_ok,
+        "sha256_ok": image.sha256_ok,
+        "app_sha256": app_digest.hexdigest(),
+        "segments": segments,
+        "chunks": chunks,
+        "sketch": sketch,
+    }
+
+def fingerprint_image(path, keys=None):
+    """Runs in a pool worker: fingerprints of every app partition of one
+    flash dump. Erased slots are skipped, unparseable ones get an error."""
+    apps = []
+    try:
+        with flash_image(path, keys) as image:
+            for part in read_partition_table(image).find(type=0):
+                data = image[part["offset"]:part["offset"] + part["size"]]
+                if not len(data) or data[0] != APP_IMAGE_MAGIC:
+                    continue
+                app = {"label": part["label"], "offset": part["offset"], "size": part["size"]}
+                try:
+                    app.update(fingerprint_app(data))
+                except Exception as e:
+                    app["error"] = "%s: %s" % (type(e).__name__, e)
+                apps.append(app)
+    except Exception as e:
+        return {"image": path, "apps": apps, "error": "%s: %s" % (type(e).__name__, e)}
+    return {"image": path, "apps": apps}
+
+def cluster_apps(apps, threshold=DEFAULT_SIMILARITY):
+    """Group app fingerprints whose estimated similarity is at least
+    threshold. Candidate pairs come from LSH over sketch bands, so only
+    apps sharing a whole band are ever compared. Returns lists of indices
+    into apps, largest cluster first.
+
+    Apps with the same build or sketch are merged up front and only one
+    of them goes through LSH. Within a bucket each app is compared with
+    the cluster roots of the members before it rather than with every
+    member, so the work grows with the number of apps times the clusters
+    a bucket spans, not with bucket size squared. That makes it an
+    approximation of single linkage: an app close to some member of a
+    cluster but not to its root can be left out of it."""
+    parent = list(range(len(apps)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        # the lower index stays the root
+        i, j = root(i), root(j)
+        if i != j:
+            parent[max(i, j)] = min(i, j)
+
+    by_build = {}
+    by_sketch = {}
+    representatives = []
+    for i, app in enumerate(apps):
+        sketch = tuple(app["sketch"])
+        same = by_build.get(app["app_sha256"], by_sketch.get(sketch))
+        if same is not None:
+            union(same, i)
+            continue
+        by_build[app["app_sha256"]] = by_sketch[sketch] = i
+        representatives.append(i)
+
+    buckets = {}
+    for i in representatives:
+        sketch = apps[i]["sketch"]
+        for band in range(0, SKETCH_BINS, LSH_BAND_SIZE):
+            rows = tuple(sketch[band:band + LSH_BAND_SIZE])
+            if None not in rows:
+                buckets.setdefault((band, rows), []).append(i)
+
+    for members in buckets.values():
+        roots = set()
+        for j in members:
+            roots = set(root(r) for r in roots)
+            for r in sorted(roots):
+                if root(r) != root(j) and similarity(apps[r]["sketch"], apps[j]["sketch"]) >= threshold:
+                    union(r, j)
+            roots.add(root(j))
+
+    clusters = {}
+    for i in range(len(apps)):
+        clusters.setdefault(root(i), []).append(i)
+    return sorted(clusters.values(), key=lambda c: (-len(c), c[0]))
+
+def fingerprint_images(spec, output=DEFAULT_FINGERPRINTS, jobs=None, threshold=DEFAULT_SIMILARITY, keys=None):
+    """Fingerprint every app partition of every image in a directory (or
+    glob), cluster near-identical builds and write both to output as JSON.
+
+    Images are handed to `jobs` worker processes in batches."""
+    from esp32_batch import find_images
+    images = find_images(spec)
+    if not images:
+        print("No images found for '" + spec + "'")
+        return None
+
+    jobs = jobs or os.cpu_count()
+    print("Fingerprinting %d images with %d workers" % (len(images), jobs))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(fingerprint_image, images, [keys] * len(images), chunksize=max(1, len(images) // (jobs * 4))))
+
+    apps = [dict(app, image=result["image"]) for result in results for app in result["apps"] if "sketch" in app]
+    clusters = []
+    for members in cluster_apps(apps, threshold):
+        builds = sorted(set(apps[i]["app_sha256"] for i in members))
+        clusters.append({
+            "apps": [{"image": apps[i]["image"], "label": apps[i]["label"], "app_sha256": apps[i]["app_sha256"]} for i in members],
+            "builds": builds,
+        })
+
+    report = {"similarity": threshold, "images": results, "clusters": clusters}
+    with open(output, 'w') as fh:
+        json.dump(report, fh, indent=2)
+
+    failed = [r["image"] for r in results if "error" in r or any("error" in app for app in r["apps"])]
+    for i, cluster in enumerate(clusters):
+        print("cluster %d: %d apps, %d distinct builds" % (i, len(cluster["apps"]), len(cluster["builds"])))
+    print("%d apps in %d clusters, %d images with errors" % (len(apps), len(clusters), len(failed)))
+    print("Wrote fingerprints to " + output)
+    return report
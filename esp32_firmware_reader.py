@@ -1,7 +1,10 @@
+import os
+import mmap
 import struct
-import sys
-import argparse
-from makeelf.elf import *
+import bisect
+import hashlib
+import contextlib
+from esp32_sources import RandomAccessImage, split_source, open_source
 
 PART_TYPES = {
   0x00: "APP",
@@ -27,61 +30,561 @@ def print_verbose(verbose, value):
     if verbose:
         print(value)
 
-def read_partition_table(fh, verbose=False):
-    fh.seek(0x8000)
-    partition_table = {}
+@contextlib.contextmanager
+def map_file(filename):
+    """Map a file read-only and yield a memoryview over all of it."""
+    with open(filename, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            # mmap refuses empty files
+            yield memoryview(b'')
+            return
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    try:
+        yield view
+    finally:
+        view.release()
+        try:
+            mm.close()
+        except BufferError:
+            # a caller still holds a slice; the mapping goes away with it
+            pass
+
+@contextlib.contextmanager
+def flash_image(filename, keys=None):
+    """Map a flash dump read-only and yield a memoryview over the whole file.
+
+    Every reader below takes slices of this view, so a partition is never
+    copied into Python memory just to be looked at or written back out.
+
+    A .gz / .xz dump, or a member of a tar or zip archive (filename written
+    archive:member), yields a RandomAccessImage instead: it slices the same
+    way, decompressing no more than a slice needs.
+
+    With keys (esp32_decrypt.FlashKeys) a flash encrypted dump reads
+    decrypted, see DecryptedImage."""
+    path, member = split_source(filename)
+    with map_file(path) as view:
+        image = open_source(view, member, path)
+        if keys is None:
+            yield image
+            return
+        from esp32_decrypt import DecryptedImage
+        image = DecryptedImage(image, keys)
+        try:
+            yield image
+        finally:
+            image.close()
+
+def image_view(src):
+    # accept a mapped image (or any buffer) as well as an open binary file
+    if isinstance(src, (memoryview, RandomAccessImage)):
+        return src
+    if not hasattr(src, 'read'):
+        return memoryview(src)
+    try:
+        if os.fstat(src.fileno()).st_size > 0:
+            return memoryview(mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ))
+    except (AttributeError, OSError, ValueError):
+        pass
+    src.seek(0)
+    return memoryview(src.read())
+
+class ImageReader(object):
+    """Read-only file object over a slice of a mapped image.
+
+    For readers that want a file, like zipfile and tarfile opening an
+    archived dump: they get the mapped bytes without a temporary file or
+    a full copy."""
+
+    def __init__(self, view):
+        self.view = image_view(view)
+        self.pos = 0
+
+    def read(self, size=-1):
+        # slicing stops at the end by itself; len() of a compressed image costs a full pass
+        end = len(self.view) if size is None or size < 0 else self.pos + size
+        data = self.view[self.pos:end].tobytes()
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+PARTITION_TABLE_OFFSET = 0x8000
+PARTITION_TABLE_SIZE = 0xC00
+PARTITION_TABLE_MAX_ENTRIES = 95
+# magic, type, subtype, offset, size, label, flags
+partition_entry = struct.Struct("<2sBBII16s4s")
+
+class PartitionTable(object):
+    """Entries of a partition table, in table order.
+
+    Looks up like the label -> record dict read_partition_table() always
+    returned, but nothing is lost to duplicate labels: table[label] is the
+    first entry with that label (what the bootloader would pick) and
+    find(label=...) returns them all. Also indexes entries by type/subtype
+    and by flash offset. md5_ok is True/False when the table carries an
+    MD5 entry, None when it doesn't."""
+
+    __slots__ = ("entries", "by_label", "by_type", "starts", "by_start", "md5", "md5_ok")
+
+    def __init__(self, entries, md5=None, md5_ok=None):
+        self.entries = entries
+        self.md5 = md5
+        self.md5_ok = md5_ok
+        self.by_label = {}
+        self.by_type = {}
+        for part in entries:
+            self.by_label.setdefault(part["label"], []).append(part)
+            self.by_type.setdefault((part["type"], part["subtype"]), []).append(part)
+        self.by_start = sorted(entries, key=lambda p: p["offset"])
+        self.starts = [p["offset"] for p in self.by_start]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.by_label)
+
+    def __contains__(self, label):
+        return label in self.by_label
+
+    def __getitem__(self, label):
+        return self.by_label[label][0]
+
+    def get(self, label, default=None):
+        parts = self.by_label.get(label)
+        return parts[0] if parts else default
+
+    def keys(self):
+        return self.by_label.keys()
+
+    def values(self):
+        return list(self.entries)
+
+    def items(self):
+        # every entry, duplicate labels included
+        return [(part["label"], part) for part in self.entries]
+
+    def find(self, label=None, type=None, subtype=None):
+        if label is not None:
+            parts = self.by_label.get(label, [])
+        elif type is not None and subtype is not None:
+            parts = self.by_type.get((type, subtype), [])
+        else:
+            parts = self.entries
+        return [p for p in parts if (type is None or p["type"] == type) and (subtype is None or p["subtype"] == subtype)]
+
+    def at(self, offset):
+        # the partition holding this flash offset, or None; that is the
+        # nearest one starting below it unless the table overlaps itself
+        for part in reversed(self.by_start[:bisect.bisect_right(self.starts, offset)]):
+            if offset < part["offset"] + part["size"]:
+                return part
+        return None
+
+    def overlapping(self, offset, size):
+        # partitions sharing at least one byte with [offset, offset + size)
+        end = bisect.bisect_left(self.starts, offset + size)
+        return [p for p in self.by_start[:end] if p["offset"] + p["size"] > offset]
+
+    def duplicate_labels(self):
+        return [label for label, parts in self.by_label.items() if len(parts) > 1]
+
+def print_partition(index, part_label, part_type, part_subtype, part_offset, part_size):
+    print("entry %d:" % (index))
+
+    part_type_label = "unknown"
+    if(part_type in PART_TYPES):
+        part_type_label = PART_TYPES[part_type]
+
+    part_subtype_label = "unknown"
+    if(part_type_label == "APP" and part_subtype in PART_SUBTYPES_APP):
+        part_subtype_label = PART_SUBTYPES_APP[part_subtype]
+    if(part_type_label == "DATA" and part_subtype in PART_SUBTYPES_DATA):
+        part_subtype_label = PART_SUBTYPES_DATA[part_subtype]
+
+    print("  label      : " + part_label)
+    print("  offset     : " + hex(part_offset))
+    print("  length     : " + str(part_size))
+    print("  type       : " + str(part_type) + " [" + part_type_label + "]")
+    print("  sub type   : " + str(part_subtype) + " [" + part_subtype_label + "]")
+    print("")
+
+def partition_table_bytes(image):
+    # the whole table in one read: a slice of a mapped image, or one read() on a file
+    if hasattr(image, 'read'):
+        image.seek(PARTITION_TABLE_OFFSET)
+        return image.read(PARTITION_TABLE_SIZE)
+    return image_view(image)[PARTITION_TABLE_OFFSET:PARTITION_TABLE_OFFSET + PARTITION_TABLE_SIZE]
+
+def read_partition_table(image, verbose=False):
+    table = partition_table_bytes(image)
+    table = table[:len(table) - len(table) % partition_entry.size]
+    entries = []
+    md5 = md5_ok = None
 
     print_verbose(verbose, "reading partition table...")
-    for i in range(0, 95): # max 95 partitions
-        magic = fh.read(2)
+    for i, (magic, part_type, part_subtype, part_offset, part_size, label, part_flags) in enumerate(partition_entry.iter_unpack(table)):
+        if i >= PARTITION_TABLE_MAX_ENTRIES:
+            break
         # end marker
         if(magic == b'\xff\xff'):
-            data = magic + fh.read(30)
-            if data == b'\xff'*32:
-                print_verbose(verbose,"Done")
-                return partition_table
-        # md5sum
+            if verbose and bytes(table[i * 32:(i + 1) * 32]) == b'\xff'*32:
+                print("Done")
+            break
+        # md5sum of all the entries before it
         elif(magic == b'\xeb\xeb'):
-            data = magic + fh.read(30)
+            md5 = label[4:] + part_flags
+            md5_ok = hashlib.md5(table[:i * 32]).digest() == md5
             print_verbose(verbose,"MD5sum: ")
-            print_verbose(verbose,data[16:].hex())
+            print_verbose(verbose,md5.hex() + (" (OK)" if md5_ok else " (MISMATCH)"))
             continue
         # is partition?
-        elif(magic[0] != 0xAA or magic[1] != 0x50):
-            return partition_table
-
-        print_verbose(verbose, "entry %d:" % (i))
-        part_type = ord(fh.read(1))
-        part_subtype = ord(fh.read(1))
-        part_offset = struct.unpack("<I", fh.read(4))[0]
-        part_size = struct.unpack("<I", fh.read(4))[0]
-        part_label = fh.read(16).decode('ascii').rstrip('\x00')
-        part_flags = fh.read(4)
-
-        part_type_label = "unknown"
-        if(part_type in PART_TYPES):
-            part_type_label = PART_TYPES[part_type]
-
-        part_subtype_label = "unknown"
-        if(part_type_label == "APP" and part_subtype in PART_SUBTYPES_APP):
-            part_subtype_label = PART_SUBTYPES_APP[part_subtype]
-        if(part_type_label == "DATA" and part_subtype in PART_SUBTYPES_DATA):
-            part_subtype_label = PART_SUBTYPES_DATA[part_subtype]
-
-        print_verbose(verbose, "  label      : " + part_label)
-        print_verbose(verbose, "  offset     : " + hex(part_offset))
-        print_verbose(verbose, "  length     : " + str(part_size))
-        print_verbose(verbose, "  type       : " + str(part_type) + " [" + part_type_label + "]")
-        print_verbose(verbose, "  sub type   : " + str(part_subtype) + " [" + part_subtype_label + "]")
-        print_verbose(verbose, "")
-
-        partition_table[part_label] = {"type":part_type, "subtype":part_subtype, "offset":part_offset, "size":part_size, "flags":part_flags}
-
-def dump_bytes(fh, offset, length, filename, verbose=False):
+        elif(magic != b'\xaa\x50'):
+            break
+
+        part_label = label.decode('ascii').rstrip('\x00')
+        if verbose:
+            print_partition(i, part_label, part_type, part_subtype, part_offset, part_size)
+
+        entries.append({"type":part_type, "subtype":part_subtype, "offset":part_offset, "size":part_size, "flags":part_flags, "label":part_label})
+    return PartitionTable(entries, md5, md5_ok)
+
+# erased flash reads back as 0xff; runs of it are found one sector at a time
+ERASED_BLOCK_SIZE = 0x1000
+ERASED_BLOCK = b'\xff' * ERASED_BLOCK_SIZE
+
+# dump_bytes() formats: how the bytes land on disk, and the suffix added to the file name
+DUMP_FORMATS = {"plain": "", "sparse": "", "gzip": ".gz", "xz": ".xz", "zstd": ".zst"}
+# sidecar next to a sparse or compressed dump, see erased_extents()
+EXTENTS_SUFFIX = ".extents.json"
+
+def erased_extents(data, block_size=ERASED_BLOCK_SIZE):
+    """[start, end) byte ranges of data that are erased (all 0xff), found
+    block_size bytes at a time; a short last block counts if it's all 0xff."""
+    extents = []
+    erased = ERASED_BLOCK if block_size == ERASED_BLOCK_SIZE else b'\xff' * block_size
+    for start in range(0, len(data), block_size):
+        block = data[start:start + block_size].tobytes()
+        if block != erased[:len(block)]:
+            continue
+        end = start + len(block)
+        if extents and extents[-1][1] == start:
+            extents[-1][1] = end
+        else:
+            extents.append([start, end])
+    return extents
+
+def open_compressed(filename, compression):
+    # a binary file object that compresses everything written to it
+    if compression == "gzip":
+        import gzip
+        return gzip.open(filename, 'wb', compresslevel=6)
+    if compression == "xz":
+        import lzma
+        return lzma.open(filename, 'wb')
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd output needs the zstandard package (pip install zstandard)")
+        return zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'), closefd=True)
+    raise ValueError("unknown compression " + compression)
+
+def write_extents(filename, size, extents, dump_format):
+    import json
+    with open(filename + EXTENTS_SUFFIX, 'w') as fh:
+        json.dump({"size": size, "format": dump_format, "erased": extents}, fh)
+
+def dump_bytes(image, offset, length, filename, verbose=False, dump_format="plain"):
+    """Write length bytes at offset to filename.
+
+    "plain" writes every byte. "sparse" seeks over erased sectors, leaving
+    holes that read back as zeros, and "gzip" / "xz" / "zstd" stream the
+    bytes through a compressor into filename plus the format's suffix. Both
+    write a sidecar <file>.extents.json listing the erased [start, end)
+    ranges, which is what restore_dump() puts the 0xff back from.
+    Returns (the file written, the bytes)."""
+    # slice of the mapping, written straight from the page cache
+    data = image_view(image)[offset:offset + length]
+    filename += DUMP_FORMATS[dump_format]
     print_verbose(verbose, "Dumping " + str(length) + " bytes to " + filename)
-    fh.seek(offset)
-    data = fh.read(length)
-    fh1 = open(filename, 'wb')
-    fh1.write(data)
-    fh1.close()
+    if dump_format == "plain":
+        with open(filename, 'wb') as fh1:
+            fh1.write(data)
+        return (filename, data)
+
+    extents = erased_extents(data)
+    if dump_format == "sparse":
+        with open(filename, 'wb') as fh1:
+            pos = 0
+            for start, end in extents:
+                fh1.write(data[pos:start])
+                fh1.seek(end)
+                pos = end
+            fh1.write(data[pos:])
+            # a trailing hole still counts towards the size
+            fh1.truncate(len(data))
+    else:
+        with open_compressed(filename, dump_format) as fh1:
+            for start in range(0, len(data), 1 << 20):
+                fh1.write(data[start:start + (1 << 20)])
+    write_extents(filename, len(data), extents, dump_format)
     return (filename, data)
+
+def restore_dump(filename, output):
+    """Turn a dump_bytes() output back into the exact partition bytes:
+    decompress it, or fill the holes of a sparse one with 0xff again,
+    according to its extents sidecar. Raises ValueError, leaving no
+    output behind, if the dump holds fewer bytes than the sidecar says."""
+    import json
+    with open(filename + EXTENTS_SUFFIX) as fh:
+        extents = json.load(fh)
+    dump_format = extents["format"]
+    if dump_format == "sparse":
+        src = open(filename, 'rb')
+    elif dump_format == "zstd":
+        import zstandard
+        src = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True)
+    else:
+        import gzip
+        import lzma
+        src = (gzip.open if dump_format == "gzip" else lzma.open)(filename, 'rb')
+    try:
+        with src, open(output, 'wb') as out:
+            pos = 0
+            for start, end in extents["erased"] + [[extents["size"], extents["size"]]]:
+                for chunk in read_chunks(src, start - pos):
+                    out.write(chunk)
+                # erased: 0xff rather than what the hole / stream holds
+                if dump_format == "sparse":
+                    src.seek(end)
+                else:
+                    for chunk in read_chunks(src, end - start):
+                        pass
+                out.write(b'\xff' * (end - start))
+                pos = end
+    except ValueError:
+        os.remove(output)
+        raise
+
+def read_chunks(src, size):
+    # exactly size bytes of src, a chunk at a time; read() of a decompressing
+    # reader may return less than asked for well before the end
+    while size > 0:
+        try:
+            chunk = src.read(min(size, 1 << 20))
+        except EOFError:
+            # gzip / xz streams cut off before their end marker
+            chunk = b''
+        if not chunk:
+            raise ValueError("dump is truncated, %d bytes short" % size)
+        size -= len(chunk)
+        yield chunk
+
+APP_IMAGE_MAGIC = 0xE9
+APP_CHECKSUM_SEED = 0xEF
+# magic, segment count, SPI mode, flash size/freq, entrypoint
+app_image_header = struct.Struct("<BBBBI")
+# WP pin, drive strengths (3), chip id, min revision, reserved, hash appended
+app_image_extended_header = struct.Struct("<BBBBHB8sB")
+# load address, length
+app_segment_header = struct.Struct("<II")
+
+# [start, end, name] regions of each chip's address space, as esptool lists
+# them; regions overlap, and an address is named after every region holding it
+MEMORY_MAPS = {
+    "esp32": [
+        [0x3F400000, 0x3F800000, "DROM"],
+        [0x3F800000, 0x3FC00000, "EXTRAM_DATA"],
+        [0x3FF80000, 0x3FF82000, "RTC_DRAM"],
+        [0x3FF90000, 0x40000000, "BYTE_ACCESSIBLE"],
+        [0x3FFAE000, 0x40000000, "DRAM"],
+        [0x3FFAE000, 0x40000000, "DMA"],
+        [0x3FFE0000, 0x3FFFFFFC, "DIRAM_DRAM"],
+        [0x40000000, 0x40070000, "IROM"],
+        [0x40070000, 0x40078000, "CACHE_PRO"],
+        [0x40078000, 0x40080000, "CACHE_APP"],
+        [0x40080000, 0x400A0000, "IRAM"],
+        [0x400A0000, 0x400BFFFC, "DIRAM_IRAM"],
+        [0x400C0000, 0x400C2000, "RTC_IRAM"],
+        [0x400D0000, 0x40400000, "IROM"],
+        [0x50000000, 0x50002000, "RTC_DATA"],
+    ],
+    "esp32s2": [
+        [0x3F000000, 0x3FF80000, "DROM"],
+        [0x3F500000, 0x3FF80000, "EXTRAM_DATA"],
+        [0x3FF9E000, 0x3FFA0000, "RTC_DRAM"],
+        [0x3FF9E000, 0x40000000, "BYTE_ACCESSIBLE"],
+        [0x3FF9E000, 0x40072000, "MEM_INTERNAL"],
+        [0x3FFB0000, 0x40000000, "DRAM"],
+        [0x40000000, 0x4001A100, "IROM_MASK"],
+        [0x40020000, 0x40070000, "IRAM"],
+        [0x40070000, 0x40072000, "RTC_IRAM"],
+        [0x40080000, 0x40800000, "IROM"],
+        [0x50000000, 0x50002000, "RTC_DATA"],
+    ],
+    "esp32s3": [
+        [0x3C000000, 0x3D000000, "DROM"],
+        [0x3D000000, 0x3E000000, "EXTRAM_DATA"],
+        [0x600FE000, 0x60100000, "RTC_DRAM"],
+        [0x3FC88000, 0x3FD00000, "BYTE_ACCESSIBLE"],
+        [0x3FC88000, 0x403E2000, "MEM_INTERNAL"],
+        [0x3FC88000, 0x3FD00000, "DRAM"],
+        [0x40000000, 0x4001A100, "IROM_MASK"],
+        [0x40370000, 0x403E0000, "IRAM"],
+        [0x600FE000, 0x60100000, "RTC_IRAM"],
+        [0x42000000, 0x42800000, "IROM"],
+        [0x50000000, 0x50002000, "RTC_DATA"],
+    ],
+    "esp32c3": [
+        [0x3C000000, 0x3C800000, "DROM"],
+        [0x3FC80000, 0x3FCE0000, "DRAM"],
+        [0x3FC88000, 0x3FD00000, "BYTE_ACCESSIBLE"],
+        [0x3FF00000, 0x3FF20000, "DROM_MASK"],
+        [0x40000000, 0x40060000, "IROM_MASK"],
+        [0x42000000, 0x42800000, "IROM"],
+        [0x4037C000, 0x403E0000, "IRAM"],
+        [0x50000000, 0x50002000, "RTC_IRAM"],
+        [0x50000000, 0x50002000, "RTC_DRAM"],
+        [0x600FE000, 0x60100000, "MEM_INTERNAL2"],
+    ],
+}
+
+# chip id in the extended header -> MEMORY_MAPS key
+APP_CHIP_IDS = {0: "esp32", 2: "esp32s2", 5: "esp32c3", 9: "esp32s3"}
+
+class MemoryMap(object):
+    """Region names of a chip's address space, looked up with bisect.
+
+    The overlapping regions are cut into disjoint intervals up front, each
+    carrying the names of every region that covers it, joined in map order
+    (e.g. 'BYTE_ACCESSIBLE, DRAM, DMA'), so name(addr) is one bisect
+    instead of a scan over the map."""
+
+    __slots__ = ("starts", "names")
+
+    def __init__(self, regions):
+        bounds = sorted(set(b for start, end, _ in regions for b in (start, end)))
+        self.starts = bounds
+        self.names = []
+        for start in bounds:
+            self.names.append(", ".join(name for lo, hi, name in regions if lo <= start < hi))
+
+    def name(self, addr):
+        # '' for an address outside every region
+        i = bisect.bisect_right(self.starts, addr) - 1
+        return self.names[i] if i >= 0 else ''
+
+memory_maps = {chip: MemoryMap(regions) for chip, regions in MEMORY_MAPS.items()}
+
+class AppSegment(object):
+    __slots__ = ("addr", "data", "offset", "name")
+
+    def __init__(self, addr, data, offset, name):
+        self.addr = addr
+        # a slice of the image, not a copy
+        self.data = data
+        self.offset = offset
+        self.name = name
+
+class AppImage(object):
+    """An app image as read by read_app_image().
+
+    checksum_ok tells whether the XOR checksum over the segment data
+    matches; sha256_ok whether the appended SHA-256 does (None when the
+    image doesn't carry one)."""
+
+    __slots__ = ("chip", "chip_id", "entrypoint", "segments", "checksum", "checksum_ok",
+                 "sha256", "sha256_ok", "size")
+
+    def __init__(self, chip, chip_id, entrypoint, segments):
+        self.chip = chip
+        self.chip_id = chip_id
+        self.entrypoint = entrypoint
+        self.segments = segments
+        self.checksum = self.checksum_ok = self.sha256 = self.sha256_ok = None
+        self.size = 0
+
+def xor_bytes(data):
+    # XOR of all bytes: fold the buffer as one big integer, halving it each step
+    width = (len(data) + 1) // 2
+    value = int.from_bytes(data[:width], 'little') ^ int.from_bytes(data[width:], 'little')
+    while width > 1:
+        half = (width + 1) // 2
+        value = (value & ((1 << (half * 8)) - 1)) ^ (value >> (half * 8))
+        width = half
+    return value
+
+def read_app_image(image, verify=True, digest=None):
+    """Parse an app image (header, extended header, segment table) straight
+    from a buffer, e.g. an app partition sliced out of a mapped flash dump.
+
+    Segment data are slices of the buffer. With verify, the checksum and the
+    appended SHA-256 are checked in the same walk over the segments.
+    digest, a hashlib sha256 object, is fed the image up to and including
+    the checksum byte and used for the SHA-256 check, so a caller hashing
+    the whole partition can carry on from there instead of hashing the
+    image twice. Raises ValueError for anything that isn't a well-formed
+    app image."""
+    view = image_view(image)
+    if len(view) < app_image_header.size + app_image_extended_header.size:
+        raise ValueError("app image too short")
+    magic, segment_count, _, _, entrypoint = app_image_header.unpack_from(view)
+    if magic != APP_IMAGE_MAGIC:
+        raise ValueError("invalid app image magic 0x%02x" % magic)
+    extended = app_image_extended_header.unpack_from(view, app_image_header.size)
+    chip_id, hash_appended = extended[4], extended[7]
+    chip = APP_CHIP_IDS.get(chip_id)
+    if chip is None:
+        raise ValueError("unsupported chip id %d" % chip_id)
+    memory_map = memory_maps[chip]
+
+    if digest is None and verify and hash_appended == 1:
+        digest = hashlib.sha256()
+    checksum = APP_CHECKSUM_SEED
+    segments = []
+    pos = app_image_header.size + app_image_extended_header.size
+    for _ in range(segment_count):
+        if pos + app_segment_header.size > len(view):
+            raise ValueError("app image truncated in segment table")
+        addr, length = app_segment_header.unpack_from(view, pos)
+        data_start = pos + app_segment_header.size
+        if data_start + length > len(view):
+            raise ValueError("segment at 0x%x runs past the end of the image" % addr)
+        data = view[data_start:data_start + length]
+        segments.append(AppSegment(addr, data, data_start, memory_map.name(addr)))
+        if verify:
+            checksum ^= xor_bytes(data)
+        pos = data_start + length
+
+    app = AppImage(chip, chip_id, entrypoint, segments)
+    # padded so that the checksum byte ends a 16 byte block
+    pos += 15 - pos % 16
+    if pos >= len(view):
+        raise ValueError("app image truncated before its checksum")
+    app.checksum = view[pos]
+    pos += 1
+    if digest is not None:
+        digest.update(view[:pos])
+    if hash_appended == 1:
+        if pos + 32 > len(view):
+            raise ValueError("app image truncated in its SHA-256")
+        app.sha256 = bytes(view[pos:pos + 32])
+        if verify:
+            app.sha256_ok = digest.copy().digest() == app.sha256
+        pos += 32
+    if verify:
+        app.checksum_ok = checksum == app.checksum
+    app.size = pos
+    return app
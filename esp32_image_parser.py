@@ -2,20 +2,34 @@
 
 # Convert an ESP 32 OTA partition into an ELF
 import sys
-import json
 import os, argparse
-from makeelf.elf import *
-from esptool import *
+import importlib.util
+# makeelf is imported by the functions that need it, so
+# show_partitions and dump_partition start without paying for them
 from esp32_firmware_reader import *
-from read_nvs import *
+from esp32_sources import COMPRESSED_SUFFIXES
+from esp32_symbols import DEFAULT_SYMBOLS, load_symbols, symbols_version
+from esp32_cache import DEFAULT_CACHE_MAX_MB, ResultCache, result_key, cached_build
+from esp32_timings import phase
+import esp32_timings
+
+# makeelf only knows Xtensa; RISC-V chips get their e_machine patched in by write_elf()
+EM_RISCV = 243
+RISCV_CHIPS = ("esp32c3",)
 
 def image_base_name(path):
-    filename_w_ext = os.path.basename(path)
+    # archive members are named after the member, compressed dumps without the .gz / .xz
+    path, member = split_source(path)
+    filename_w_ext = os.path.basename(member or path)
+    for suffix in COMPRESSED_SUFFIXES:
+        if filename_w_ext.endswith(suffix):
+            filename_w_ext = filename_w_ext[:-len(suffix)]
     filename, ext = os.path.splitext(filename_w_ext)
     return filename
 
 # section header flags
 def calcShFlg(flags):
+    from makeelf.elf import SHF
     mask = 0
     if 'W' in flags:
         mask |= SHF.SHF_WRITE
@@ -28,6 +42,7 @@ def calcShFlg(flags):
 
 # program header flags
 def calcPhFlg(flags):
+    from makeelf.elf import PF
     p_flags = 0
     if 'r' in flags:
         p_flags |= PF.PF_R
@@ -37,25 +52,49 @@ def calcPhFlg(flags):
         p_flags |= PF.PF_X
     return p_flags
 
-def image2elf(filename, output_file, verbose=False):
-    image = LoadFirmwareImage('esp32', filename)
-
-    # parse image name
-    # e.g. 'image.bin' turns to 'image'
-    image_name = image_base_name(filename)
+def image2elf(filename, output_file, verbose=False, image_name='image', symbols=DEFAULT_SYMBOLS, quiet=False):
+    """Build an ELF from an app image: a path, or a slice of an already
+    mapped flash image. Returns the warnings about the image, which are
+    also printed, along with progress, unless quiet."""
+    if isinstance(filename, str):
+        # parse image name
+        # e.g. 'image.bin' turns to 'image'
+        image_name = image_base_name(filename)
+        with flash_image(filename) as data:
+            return image2elf(data, output_file, verbose, image_name, symbols, quiet)
+
+    from makeelf.elf import ELF, EM, ELFDATA, SHT, PT, Elf32_Phdr
+
+    warnings = []
+    def warn(message):
+        warnings.append(message)
+        if not quiet:
+            print("Warning: " + message)
+
+    with phase("read_app_image", len(filename)):
+        image = read_app_image(filename)
+    if not image.checksum_ok:
+        warn("app image checksum mismatch")
+    if image.sha256_ok is False:
+        warn("app image SHA-256 mismatch")
 
     elf = ELF(e_machine=EM.EM_XTENSA, e_data=ELFDATA.ELFDATA2LSB)
     elf.Elf.Ehdr.e_entry = image.entrypoint
 
     print_verbose(verbose, "Entrypoint " + str(hex(image.entrypoint)))
 
-    # maps segment names to ELF sections
+    # maps segment names to ELF sections (ESP32, then S2 / S3 / C3 names)
     section_map = {
         'DROM'                      : '.flash.rodata',
         'BYTE_ACCESSIBLE, DRAM, DMA': '.dram0.data',
         'IROM'                      : '.flash.text',
         #'RTC_IRAM'                  : '.rtc.text' TODO
+        'BYTE_ACCESSIBLE, MEM_INTERNAL, DRAM': '.dram0.data',
+        'DRAM, BYTE_ACCESSIBLE'     : '.dram0.data',
+        'DRAM'                      : '.dram0.data',
     }
+    # IRAM segments, split into .iram0.vectors and .iram0.text below
+    iram_names = ('IRAM', 'MEM_INTERNAL, IRAM')
 
     # map to hold pre-defined ELF section header attributes
     # http://man7.org/linux/man-pages/man5/elf.5.html
@@ -77,40 +116,42 @@ def image2elf(filename, output_file, verbose=False):
 
     ##### build out the section data #####
     ######################################
-    iram_seen = False
-    for seg in sorted(image.segments, key=lambda s:s.addr):
-
-        # name from image
-        segment_name = ", ".join([seg_range[2] for seg_range in image.ROM_LOADER.MEMORY_MAP if seg_range[0] <= seg.addr < seg_range[1]])
-
-        # TODO when processing an image, there was an empty segment name?
-        if segment_name == '':
-            continue
-
-        section_name = ''
-        # handle special case
-        # iram is split into .vectors and .text
-        # .iram0.vectors seems to be the first one.
-        if segment_name == 'IRAM':
-            if iram_seen == False:
-                section_name = '.iram0.vectors'
+    with phase("merge_segments", sum(len(seg.data) for seg in image.segments)):
+        iram_seen = False
+        for seg in sorted(image.segments, key=lambda s:s.addr):
+
+            # name from the chip's memory map
+            segment_name = seg.name
+
+            # TODO when processing an image, there was an empty segment name?
+            if segment_name == '':
+                continue
+
+            section_name = ''
+            # handle special case
+            # iram is split into .vectors and .text
+            # .iram0.vectors seems to be the first one.
+            if segment_name in iram_names:
+                if iram_seen == False:
+                    section_name = '.iram0.vectors'
+                else:
+                    section_name = '.iram0.text'
+                iram_seen = True
             else:
-                section_name = '.iram0.text'
-            iram_seen = True
-        else:
-            if segment_name in section_map:
-                section_name = section_map[segment_name]
-            else:
-                print("Unsure what to do with segment: " + segment_name)
-
-        # if we have a mapped segment <-> section
-        # add the elf section
-        if section_name != '':
-            # might need to append to section (e.g. IRAM is split up due to alignment)
-            if section_name in section_data:
-                    section_data[section_name]['data'] += seg.data
-            else:
-                section_data[section_name] = {'addr':seg.addr, 'data':seg.data}
+                if segment_name in section_map:
+                    section_name = section_map[segment_name]
+                else:
+                    warn("Unsure what to do with segment: " + segment_name)
+
+            # if we have a mapped segment <-> section
+            # add the elf section
+            if section_name != '':
+                # might need to append to section (e.g. IRAM is split up due to alignment)
+                # bytearray so that appending doesn't copy what's already there
+                if section_name in section_data:
+                        section_data[section_name]['data'] += seg.data
+                else:
+                    section_data[section_name] = {'addr':seg.addr, 'data':bytearray(seg.data)}
 
     ##### append the sections #####
     ###############################
@@ -128,7 +169,8 @@ def image2elf(filename, output_file, verbose=False):
 
     elf.append_special_section('.strtab')
     elf.append_special_section('.symtab')
-    add_elf_symbols(elf)
+    with phase("add_elf_symbols"):
+        add_elf_symbols(elf, symbols)
 
     # segment flags
     # TODO rtc
@@ -142,17 +184,16 @@ def image2elf(filename, output_file, verbose=False):
     # there is an initial program header that we don't want...
     elf.Elf.Phdr_table.pop()
 
-    bytes(elf) # kind of a hack, but __bytes__() calculates offsets in elf object
-
-    # TODO this logic might change as we add support for rtc
-    size_of_phdrs = len(Elf32_Phdr()) * len(segments) # to pre-calculate program header offsets
-
     ##### add the segments ####
     ###########################
+    # offsets are filled in once the file layout is known
     print_verbose(verbose, "\nAdding program headers")
+    segment_sections = []
     for (name, flags) in segments.items():
+        if name not in section_data:
+            continue
 
-        if (name == '.iram0.vectors'):
+        if (name == '.iram0.vectors' and '.iram0.text' in section_data):
             # combine these
             size = len(section_data['.iram0.vectors']['data']) + len(section_data['.iram0.text']['data'])
         else:
@@ -161,77 +202,212 @@ def image2elf(filename, output_file, verbose=False):
         p_flags = calcPhFlg(flags)
         addr = section_data[name]['addr']
         align = 0x1000
-        p_type = PT.PT_LOAD
-
-        shstrtab_hdr, shstrtab = elf.get_section_by_name(name)
-        offset = shstrtab_hdr.sh_offset + size_of_phdrs # account for new offset
 
         # build program header
-        Phdr = Elf32_Phdr(PT.PT_LOAD, p_offset=offset, p_vaddr=addr,
+        Phdr = Elf32_Phdr(PT.PT_LOAD, p_offset=0, p_vaddr=addr,
                 p_paddr=addr, p_filesz=size, p_memsz=size,
                 p_flags=p_flags, p_align=align, little=elf.little)
 
-        print_verbose(verbose, name + ": " + str(Phdr))
         elf.Elf.Phdr_table.append(Phdr)
+        segment_sections.append(name)
+
+    with phase("layout_elf"):
+        elf_size = layout_elf(elf)
+    for Phdr, name in zip(elf.Elf.Phdr_table, segment_sections):
+        shdr, _ = elf.get_section_by_name(name)
+        Phdr.p_offset = shdr.sh_offset
+        print_verbose(verbose, name + ": " + str(Phdr))
 
     # write out elf file
     if output_file is not None:
         out_file = output_file
     else:
         out_file = image_name + '.elf'
-    print("\nWriting ELF to " + out_file + "...")
-    fd = os.open(out_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
-    os.write(fd, bytes(elf))
-    os.close(fd)
-
-def add_elf_symbols(elf):
+    if not quiet:
+        print("\nWriting ELF to " + out_file + "...")
+    with phase("write_elf", elf_size):
+        write_elf(elf, out_file, EM_RISCV if image.chip in RISCV_CHIPS else None)
+    return warnings
+
+def layout_elf(elf):
+    """Assign every file offset in one pass and return the file size.
+
+    Same layout as makeelf's ELF.__bytes__(): ELF header, program headers,
+    section headers, then section contents in section header order."""
+    Ehdr = elf.Elf.Ehdr
+    cursor = len(Ehdr)
+
+    if len(elf.Elf.Phdr_table) > 0:
+        Ehdr.e_phoff = cursor
+        Ehdr.e_phentsize = len(elf.Elf.Phdr_table[0])
+        Ehdr.e_phnum = len(elf.Elf.Phdr_table)
+        cursor += Ehdr.e_phentsize * Ehdr.e_phnum
+    else:
+        Ehdr.e_phoff = Ehdr.e_phentsize = Ehdr.e_phnum = 0
 
-    fh = open("symbols_dump.txt", "r")
-    lines = fh.readlines()
+    if len(elf.Elf.Shdr_table) > 0:
+        Ehdr.e_shoff = cursor
+        Ehdr.e_shentsize = len(elf.Elf.Shdr_table[0])
+        Ehdr.e_shnum = len(elf.Elf.Shdr_table)
+        cursor += Ehdr.e_shentsize * Ehdr.e_shnum
+    else:
+        Ehdr.e_shoff = Ehdr.e_shentsize = Ehdr.e_shnum = 0
 
-    bind_map = {"LOCAL" : STB.STB_LOCAL, "GLOBAL" : STB.STB_GLOBAL}
-    type_map = {"NOTYPE": STT.STT_NOTYPE, "OBJECT" : STT.STT_OBJECT, "FUNC" : STT.STT_FUNC, "FILE" : STT.STT_FILE}
+    for Shdr, section in zip(elf.Elf.Shdr_table, elf.Elf.sections):
+        Shdr.sh_offset = cursor
+        Shdr.sh_size = len(section)
+        cursor += Shdr.sh_size
+    return cursor
 
-    for line in lines:
-        line = line.split()
-        sym_binding = line[4]
-        sym_type = line[3]
-        sym_size = int(line[2])
-        sym_val = int(line[1], 16)
-        sym_name = line[7]
-                                    # ABS
-        elf.append_symbol(sym_name, 0xfff1, sym_val, sym_size, sym_binding=bind_map[sym_binding], sym_type=type_map[sym_type])
+def write_elf(elf, out_file, e_machine=None):
+    # stream headers and sections straight to the file, in layout_elf() order,
+    # instead of assembling the whole image in memory first
+    fd = os.open(out_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    with os.fdopen(fd, 'wb') as fh:
+        header = bytes(elf.Elf.Ehdr)
+        if e_machine is not None:
+            # a machine makeelf has no enum value for
+            header = header[:18] + e_machine.to_bytes(2, 'little') + header[20:]
+        fh.write(header)
+        for Phdr in elf.Elf.Phdr_table:
+            fh.write(bytes(Phdr))
+        for Shdr in elf.Elf.Shdr_table:
+            fh.write(bytes(Shdr))
+        for section in elf.Elf.sections:
+            # section contents are bytes-like, except makeelf's own string tables
+            if not isinstance(section, (bytes, bytearray, memoryview)):
+                section = bytes(section)
+            fh.write(section)
+
+def add_elf_symbols(elf, symbols=DEFAULT_SYMBOLS):
+    # the symbol set is pre-compiled into ready-made .strtab/.symtab
+    # contents, so this is a bulk swap rather than one append per symbol
+    from makeelf.elf import Elf32_Sym
+    strtab, symtab = load_symbols(symbols)
+
+    strtab_hdr, _ = elf.get_section_by_name('.strtab')
+    symtab_hdr, _ = elf.get_section_by_name('.symtab')
+    elf.Elf.sections[elf.Elf.Shdr_table.index(strtab_hdr)] = strtab
+    elf.Elf.sections[elf.Elf.Shdr_table.index(symtab_hdr)] = symtab
+
+    # one past the last symbol index, as append_symbol would leave it
+    symtab_hdr.sh_info = len(symtab) // len(Elf32_Sym())
 
 def flash_dump_to_elf(filename, partition):
-    fh = open(filename, 'rb')
-    part_table = read_partition_table(fh)
-    fh.close()
+    with flash_image(filename) as image:
+        part_table = read_partition_table(image)
     return part_table
 
-def dump_partition(fh, part_name, offset, size, dump_file):
-    print("Dumping partition '" + part_name + "' to " + dump_file)
-    dump_bytes(fh, offset, size, dump_file)
+def dump_partition(image, part_name, offset, size, dump_file, dump_format="plain"):
+    print("Dumping partition '" + part_name + "' to " + dump_file + DUMP_FORMATS[dump_format])
+    with phase("dump_bytes", size):
+        dump_bytes(image, offset, size, dump_file, dump_format=dump_format)
 
 def main():
     desc = 'ESP32 Firmware Image Parser Utility'
     arg_parser = argparse.ArgumentParser(description=desc)
-    arg_parser.add_argument('action', choices=['show_partitions', 'dump_partition', 'create_elf', 'dump_nvs'], help='Action to take')
-    arg_parser.add_argument('input', help='Firmware image input file')
-    arg_parser.add_argument('-output', help='Output file name')
-    arg_parser.add_argument('-nvs_output_type', help='output type for nvs dump', type=str, choices=["text","json"], default="text")
+    arg_parser.add_argument('action', choices=['show_partitions', 'dump_partition', 'create_elf', 'dump_nvs', 'extract_all', 'batch', 'serve', 'index', 'query', 'fingerprint', 'verify'], help='Action to take')
+    arg_parser.add_argument('input', help='Firmware image input file, .gz, .xz or archive:member (directory or glob for batch, index and fingerprint, [host:]port or socket path for serve, index file for query)')
+    arg_parser.add_argument('-output', help='Output file name (output directory for extract_all and batch, index file for index, report for fingerprint and verify)')
+    arg_parser.add_argument('-nvs_output_type', help='output type for nvs dump', type=str, choices=["text","json","ndjson","values"], default="text")
     arg_parser.add_argument('-partition', help='Partition name (e.g. ota_0)')
+    arg_parser.add_argument('-namespace', help='NVS namespace to look for (query)')
+    arg_parser.add_argument('-key', help='NVS key to look for (query)')
+    arg_parser.add_argument('-value', help='NVS value to look for, integers in decimal (query)')
+    arg_parser.add_argument('-similarity', help='Estimated share of content two apps must have in common to be clustered together by fingerprint (default: %(default)s)', type=float, default=0.8)
+    arg_parser.add_argument('-symbols', help='Symbol set name or symbols file for create_elf (default: %(default)s)', default=DEFAULT_SYMBOLS)
+    arg_parser.add_argument('-jobs', help='Number of worker processes for batch, index, fingerprint, serve (ELF builds) and dump_nvs -nvs_output_type values, threads for extract_all and verify (default: based on CPU count; in-process for dump_nvs)', type=int)
+    arg_parser.add_argument('-cache', default=False, help='Reuse previously built ELF / NVS JSON outputs for identical partitions', action='store_true')
+    arg_parser.add_argument('-cache_dir', help='Result cache directory (implies -cache, default: ~/.cache/esp32_image_parser/results)')
+    arg_parser.add_argument('-cache_max_mb', help='Result cache size limit in MB (default: %(default)s)', type=int, default=DEFAULT_CACHE_MAX_MB)
+    arg_parser.add_argument('-previous', help='manifest.json of an earlier extract_all / batch run: carry unchanged partitions forward, re-decode only changed NVS pages')
+    arg_parser.add_argument('-verify', default=False, help='Also check partition table MD5, app image checksums / SHA-256 and NVS CRC32s (reported by show_partitions and the partition actions, recorded in the extract_all / batch manifest)', action='store_true')
+    arg_parser.add_argument('-dump_format', help="How raw partitions are written by dump_partition, -dump_bin, extract_all and batch: every byte, sparse (erased sectors left as holes) or compressed; all but plain also write a <file>.extents.json map of the erased ranges (default: %(default)s)", choices=list(DUMP_FORMATS), default="plain")
+    arg_parser.add_argument('-flash_key', help='Flash encryption key file (32 bytes, 24 for an ESP32 using 3/4 coding, 64 for XTS-AES-256) to read flash encrypted dumps')
+    arg_parser.add_argument('-nvs_key', help='NVS encryption keys: an nvs_keys partition image or its first 64 bytes (default: read from the nvs_keys partition with -flash_key)')
+    arg_parser.add_argument('-dump_bin', default=False, help='Also write the raw partition to <partition>_out.bin for create_elf and dump_nvs', action='store_true')
+    arg_parser.add_argument('-timings', help="Write per-phase wall time, bytes and allocations to this file ('-' for stdout)")
+    arg_parser.add_argument('-timings_format', help='Format of the -timings report (default: %(default)s)', choices=["json", "chrome"], default="json")
+    arg_parser.add_argument('-profile', help='Dump cProfile stats to this file (or set ESP32_PARSER_PROFILE)', default=os.environ.get('ESP32_PARSER_PROFILE'))
     arg_parser.add_argument('-v', default=False, help='Verbose output', action='store_true')
 
     args = arg_parser.parse_args()
-
-    with open(args.input, 'rb') as fh:
+    if args.dump_format == "zstd" and importlib.util.find_spec("zstandard") is None:
+        arg_parser.error("-dump_format zstd needs the zstandard package (pip install zstandard)")
+    args.keys = None
+    if args.flash_key or args.nvs_key:
+        from esp32_decrypt import load_flash_keys
+        if importlib.util.find_spec("cryptography") is None:
+            arg_parser.error("-flash_key / -nvs_key need the cryptography package (pip install cryptography)")
+        # batch, index, fingerprint and serve already spread the work over worker processes
+        jobs = 1 if args.action in ('batch', 'index', 'fingerprint', 'serve') else args.jobs or os.cpu_count()
+        try:
+            args.keys = load_flash_keys(args.flash_key, args.nvs_key, jobs)
+        except (OSError, ValueError) as e:
+            arg_parser.error(str(e))
+
+    if args.timings:
+        esp32_timings.enable()
+    with esp32_timings.profiled(args.profile):
+        with phase(args.action):
+            ok = run_action(args)
+    if args.timings:
+        esp32_timings.write_report(args.timings, args.timings_format)
+    # integrity failures show in the exit status, for scripts
+    if ok is False:
+        sys.exit(1)
+
+def run_action(args):
+    cache = None
+    if args.cache or args.cache_dir:
+        cache = ResultCache(args.cache_dir, args.cache_max_mb << 20)
+
+    if args.action == 'batch':
+        from esp32_batch import run_batch
+        run_batch(args.input, args.output or 'batch_out', args.jobs, args.symbols, cache, esp32_timings.enabled, args.previous, args.verify, args.dump_format, args.keys)
+        return
+
+    if args.action == 'index':
+        from esp32_index import build_index, DEFAULT_INDEX
+        build_index(args.input, args.output or DEFAULT_INDEX, args.jobs, args.keys)
+        return
+
+    if args.action == 'query':
+        from esp32_index import query_index, print_query
+        if args.namespace is None and args.key is None and args.value is None:
+            print("Need -namespace, -key and/or -value")
+            return
+        print_query(query_index(args.input, args.namespace, args.key, args.value))
+        return
+
+    if args.action == 'fingerprint':
+        from esp32_fingerprint import fingerprint_images, DEFAULT_FINGERPRINTS
+        fingerprint_images(args.input, args.output or DEFAULT_FINGERPRINTS, args.jobs, args.similarity, args.keys)
+        return
+
+    if args.action == 'serve':
+        from esp32_serve import serve
+        serve(args.input, args.jobs, args.symbols, cache, args.keys)
+        return
+
+    if args.action == 'extract_all':
+        from esp32_extract import extract_all
+        result = extract_all(args.input, args.output or image_base_name(args.input) + '_extracted', args.jobs, args.symbols, cache, args.previous, args.verify, args.dump_format, args.keys)
+        return result.get("integrity_ok")
+
+    if args.action == 'verify':
+        from esp32_verify import verify_file
+        return verify_file(args.input, args.jobs, args.output, keys=args.keys)["ok"]
+
+    with flash_image(args.input, args.keys) as image:
         verbose = False
         # read_partition_table will show the partitions if verbose
         if args.action == 'show_partitions' or args.v is True:
             verbose = True
 
         # parse that ish
-        part_table = read_partition_table(fh, verbose)
+        with phase("read_partition_table"):
+            part_table = read_partition_table(image, verbose)
 
         if args.action in ['dump_partition', 'create_elf', 'dump_nvs']:
             if (args.partition is None):
@@ -247,9 +423,13 @@ def main():
 
             if part_name in part_table:
                 part = part_table[part_name]
+                if len(part_table.find(label=part_name)) > 1:
+                    print("Warning: more than one partition labelled '%s', using the one at %s" % (part_name, hex(part['offset'])))
+                # zero-copy view of the partition inside the mapped image
+                part_data = image[part['offset']:part['offset'] + part['size']]
             
                 if args.action == 'dump_partition':
-                    dump_partition(fh, part_name, part['offset'], part['size'], dump_file)
+                    dump_partition(image, part_name, part['offset'], part['size'], dump_file, args.dump_format)
                 if args.action == 'create_elf':
                     # can only generate elf from 'app' partition type
                     if part['type'] != 0:
@@ -258,24 +438,50 @@ def main():
                         if args.output is None:
                             print("Need output file name")
                         else:
-                            dump_partition(fh, part_name, part['offset'], part['size'], dump_file)
-                            # we have to load from a file
+                            # the ELF is built straight from the mapped partition,
+                            # the raw .bin is only written when asked for
+                            if args.dump_bin:
+                                dump_partition(image, part_name, part['offset'], part['size'], dump_file, args.dump_format)
                             output_file = args.output
-                            image2elf(dump_file, output_file, verbose)
+                            key = result_key("elf", part_data, symbols_version(args.symbols)) if cache else None
+                            with phase("image2elf", len(part_data)):
+                                hit, warnings = cached_build(cache, key, output_file, lambda filename: image2elf(part_data, filename, verbose, image_base_name(dump_file), args.symbols))
+                            if hit:
+                                # what image2elf printed when the entry was built
+                                for warning in warnings:
+                                    print("Warning: " + warning)
+                                print("\nWriting cached ELF to " + output_file + "...")
                 elif args.action == 'dump_nvs':
                     if part['type'] != 1 or part['subtype'] != 2: # Wifi NVS partition (4 is for encryption key)
                         print("Uh oh... bad partition type. Can only dump NVS partition type.")
                     else:
-                        dump_partition(fh, part_name, part['offset'], part['size'], dump_file)
-                        with open(dump_file, 'rb') as fh:
-                            if(args.nvs_output_type != "text"):
-                                sys.stdout = open(os.devnull, 'w') # block print()
-                            pages = read_nvs_pages(fh)
-                            sys.stdout = sys.stdout = sys.__stdout__ # re-enable print()
+                        from read_nvs import write_nvs_json, write_nvs_json_file, write_nvs_ndjson, write_nvs_values_json, print_nvs_pages, iter_nvs_pages
+                        if args.dump_bin:
+                            dump_partition(image, part_name, part['offset'], part['size'], dump_file, args.dump_format)
+                        with phase("nvs_" + args.nvs_output_type, len(part_data)):
                             if(args.nvs_output_type == "json"):
-                                print(json.dumps(pages))
+                                if cache is None:
+                                    write_nvs_json(part_data, sys.stdout)
+                                else:
+                                    cached_build(cache, result_key("nvs-json", part_data), None,
+                                                 lambda filename: write_nvs_json_file(part_data, filename))
+                                print("")
+                            elif(args.nvs_output_type == "ndjson"):
+                                write_nvs_ndjson(part_data, sys.stdout)
+                            elif(args.nvs_output_type == "values"):
+                                write_nvs_values_json(part_data, sys.stdout, args.jobs)
+                                print("")
+                            else:
+                                print_nvs_pages(iter_nvs_pages(part_data))
             else:
                 print("Partition '" + part_name + "' not found.")
 
+        if args.verify:
+            from esp32_verify import verify_image, print_verify_report
+            print("\nVerifying...")
+            report = verify_image(image, args.jobs, None if args.action == 'show_partitions' else [args.partition])
+            print_verify_report(report)
+            return report["ok"]
+
 if __name__ == '__main__':
     main()
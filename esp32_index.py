@@ -0,0 +1,188 @@
+import os
+import time
+import struct
+import sqlite3
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from esp32_firmware_reader import flash_image, read_partition_table
+from esp32_sources import source_file
+
+DEFAULT_INDEX = "nvs_index.db"
+
+# bump whenever what index_rows() records changes; an index written by an
+# older version is emptied, so the next run indexes every image again
+INDEX_VERSION = 2
+
+# parse_nvs_values() leaves 64-bit integers as their 8 raw bytes
+nvs_int64_formats = {"U64": "<Q", "I64": "<q"}
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    indexed_at REAL NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    image_id INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    partition TEXT NOT NULL,
+    namespace TEXT,
+    key TEXT NOT NULL,
+    type TEXT NOT NULL,
+    value_hash TEXT NOT NULL,
+    value TEXT,
+    size INTEGER,
+    page_seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_by_key ON entries (key, namespace);
+CREATE INDEX IF NOT EXISTS entries_by_value ON entries (value_hash);
+CREATE INDEX IF NOT EXISTS entries_by_image ON entries (image_id);
+"""
+
+def value_bytes(value):
+    # what a value hashes as: ints in decimal and strings as UTF-8, so a
+    # value typed on the command line hashes the same; blobs as they are
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+def value_hash(value):
+    return hashlib.blake2b(value_bytes(value), digest_size=16).hexdigest()
+
+def index_rows(path, keys=None):
+    """Runs in a pool worker: one row per key of every NVS partition in a
+    flash dump, (partition, namespace, key, type, value_hash, value, size,
+    page_seq). value is kept for integers and strings, blobs only get
+    their hash and size. 64-bit integers are decoded like the smaller
+    ones, so they show and match in decimal too."""
+    from read_nvs import parse_nvs_values
+    rows = []
+    with flash_image(path, keys) as image:
+        part_table = read_partition_table(image)
+        for part in part_table.find(type=1, subtype=2):
+            part_data = image[part["offset"]:part["offset"] + part["size"]]
+            for value in parse_nvs_values(part_data):
+                data = value["value"]
+                if value["type"] in nvs_int64_formats and len(data) == 8:
+                    data = struct.unpack(nvs_int64_formats[value["type"]], data)[0]
+                text = None if isinstance(data, bytes) else str(data)
+                rows.append((part["label"], value["namespace"], value["key"], value["type"],
+                             value_hash(data), text, value.get("size"), value["page_seq_no"]))
+    return rows
+
+def index_image(path, keys=None):
+    # (path, rows, error); errors are recorded, not raised, so one bad dump doesn't stop the run
+    try:
+        return path, index_rows(path, keys), None
+    except Exception as e:
+        return path, [], "%s: %s" % (type(e).__name__, e)
+
+def open_index(filename):
+    db = sqlite3.connect(filename)
+    db.execute("PRAGMA foreign_keys = ON")
+    db.execute("PRAGMA journal_mode = WAL")
+    db.executescript(INDEX_SCHEMA)
+    if db.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+        with db:
+            # entries go with their images
+            db.execute("DELETE FROM images")
+        db.execute("PRAGMA user_version = %d" % INDEX_VERSION)
+    return db
+
+def stale_images(db, images):
+    # images that are new, or have changed size or mtime since they were indexed
+    # (for archive members: the archive's)
+    indexed = {path: (size, mtime_ns) for path, size, mtime_ns in db.execute("SELECT path, size, mtime_ns FROM images")}
+    stale = []
+    for path in images:
+        stat = os.stat(source_file(path))
+        if indexed.get(path) != (stat.st_size, stat.st_mtime_ns):
+            stale.append((path, stat))
+    return stale
+
+def build_index(spec, filename=DEFAULT_INDEX, jobs=None, keys=None):
+    """Index every NVS key of every image in a directory (or glob) into the
+    SQLite database filename.
+
+    Incremental: images already indexed with the same size and mtime are
+    skipped, changed ones re-indexed and ones that no longer exist dropped.
+    Images are decoded by `jobs` worker processes; all writes happen here
+    in one transaction."""
+    from esp32_batch import find_images
+    images = [os.path.abspath(path) for path in find_images(spec)]
+    if not images:
+        print("No images found for '" + spec + "'")
+        return None
+
+    db = open_index(filename)
+    try:
+        gone = [(path,) for (path,) in db.execute("SELECT path FROM images") if not os.path.isfile(source_file(path))]
+        stale = stale_images(db, images)
+        print("Indexing %d of %d images (%d unchanged) with %d workers" % (
+            len(stale), len(images), len(images) - len(stale), jobs or os.cpu_count()))
+
+        stats = dict(stale)
+        failed = []
+        with db:
+            db.executemany("DELETE FROM images WHERE path = ?", gone)
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(index_image, path, keys) for path, _ in stale]
+                for done, future in enumerate(as_completed(futures), 1):
+                    path, rows, error = future.result()
+                    stat = stats[path]
+                    db.execute("DELETE FROM images WHERE path = ?", (path,))
+                    image_id = db.execute("INSERT INTO images (path, size, mtime_ns, indexed_at, error) VALUES (?, ?, ?, ?, ?)",
+                                          (path, stat.st_size, stat.st_mtime_ns, time.time(), error)).lastrowid
+                    db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   [(image_id,) + row for row in rows])
+                    if error:
+                        failed.append(path)
+                    print("[%d/%d] %s %s" % (done, len(stale), path, "FAILED: " + error if error else "%d keys" % len(rows)))
+
+        image_count, key_count = db.execute("SELECT (SELECT COUNT(*) FROM images), (SELECT COUNT(*) FROM entries)").fetchone()
+        print("Index %s: %d images, %d keys" % (filename, image_count, key_count))
+        return {"indexed": len(stale), "removed": len(gone), "failed": failed, "images": image_count, "keys": key_count}
+    finally:
+        db.close()
+
+def query_index(filename, namespace=None, key=None, value=None):
+    """Keys matching every given criterion, as (image, partition, namespace,
+    key, type, value, size, page_seq) tuples. value is compared by hash, so
+    it matches integers written in decimal, strings and (as bytes) blobs."""
+    if not os.path.isfile(filename):
+        raise FileNotFoundError("no index at " + filename)
+    where = []
+    params = []
+    if namespace is not None:
+        where.append("e.namespace = ?")
+        params.append(namespace)
+    if key is not None:
+        where.append("e.key = ?")
+        params.append(key)
+    if value is not None:
+        where.append("e.value_hash = ?")
+        params.append(value_hash(value))
+    sql = ("SELECT i.path, e.partition, e.namespace, e.key, e.type, e.value, e.size, e.page_seq "
+           "FROM entries e JOIN images i ON i.id = e.image_id")
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY i.path, e.partition, e.namespace, e.key"
+
+    db = sqlite3.connect(filename)
+    try:
+        return db.execute(sql, params).fetchall()
+    finally:
+        db.close()
+
+def print_query(rows):
+    for path, partition, namespace, key, entry_type, value, size, page_seq in rows:
+        if value is not None:
+            shown = value
+        elif size is not None:
+            shown = "<%d byte blob>" % size
+        else:
+            shown = "<%s value>" % entry_type
+        print("%s\t%s\t%s/%s\t%s\t%s\tseq %d" % (path, partition, namespace, key, entry_type, shown, page_seq))
+    print("%d matches in %d images" % (len(rows), len(set(row[0] for row in rows))))
@@ -0,0 +1,336 @@
+import os
+import io
+import sys
+import stat
+import json
+import socket
+import ipaddress
+import signal
+import asyncio
+import tempfile
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from esp32_firmware_reader import *
+from esp32_sources import source_file
+from esp32_symbols import DEFAULT_SYMBOLS, load_symbols, symbols_version, available_symbol_sets
+from esp32_cache import MemoryCache, result_key
+
+# largest image accepted as a request body
+DEFAULT_MAX_UPLOAD_MB = 64
+# built ELFs and NVS JSON kept in memory between requests
+DEFAULT_MEMORY_CACHE_MB = 256
+
+ROUTES = ("/partitions", "/elf", "/nvs")
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 500: "Internal Server Error"}
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+def build_elf(data, symbols=DEFAULT_SYMBOLS):
+    """Runs in a pool worker: the ELF for one app partition, as bytes.
+    Workers live as long as the server, so their symbol tables stay loaded."""
+    from esp32_image_parser import image2elf
+    fd, filename = tempfile.mkstemp(suffix=".elf")
+    os.close(fd)
+    try:
+        image2elf(data, filename, False, "image", symbols, quiet=True)
+        with open(filename, 'rb') as fh:
+            return fh.read()
+    finally:
+        os.remove(filename)
+
+def render_nvs(part_data, output_type):
+    # NVS JSON in one of the dump_nvs layouts, as bytes
+    from read_nvs import write_nvs_json, write_nvs_ndjson, write_nvs_values_json
+    out = io.StringIO()
+    if output_type == "json":
+        write_nvs_json(part_data, out)
+    elif output_type == "ndjson":
+        write_nvs_ndjson(part_data, out)
+    else:
+        write_nvs_values_json(part_data, out)
+    return out.getvalue().encode('utf-8')
+
+def partition_table_json(part_table):
+    return json.dumps({
+        "md5_ok": part_table.md5_ok,
+        "partitions": [dict(part, flags=part["flags"].hex()) for part in part_table.values()],
+    }).encode('utf-8')
+
+async def read_request(reader, max_upload):
+    """One HTTP/1.1 request: (method, path, query, headers, body), or None
+    once the client has closed the connection."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, version = request_line.decode('latin-1').split()
+    except ValueError:
+        raise RequestError(400, "malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise RequestError(400, "malformed Content-Length")
+    if length < 0:
+        raise RequestError(400, "negative Content-Length")
+    if length > max_upload:
+        raise RequestError(413, "image larger than %d bytes" % max_upload)
+    body = await reader.readexactly(length) if length else b''
+
+    url = urlsplit(target)
+    query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+    return method, url.path, query, headers, body
+
+def write_response(writer, status, content_type, body, keep_alive):
+    head = "HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % (
+        status, HTTP_REASONS.get(status, ""), content_type, len(body), "keep-alive" if keep_alive else "close")
+    writer.write(head.encode('latin-1'))
+    writer.write(body)
+
+class ParserService(object):
+    """The parser as a long-running local service.
+
+    Symbol tables and built outputs stay warm between requests: ELF and
+    NVS JSON in an in-memory LRU (and the on-disk ResultCache, if given),
+    partition tables of images given by path until the file changes. ELF
+    builds go to a pool of `jobs` worker processes and at most that many
+    run at once; NVS decoding, and slicing and hashing partitions (which
+    decrypts / decompresses them), run on the event loop's thread pool."""
+
+    def __init__(self, jobs=None, symbols=DEFAULT_SYMBOLS, cache=None,
+                 max_upload=DEFAULT_MAX_UPLOAD_MB << 20, memory_bytes=DEFAULT_MEMORY_CACHE_MB << 20, keys=None):
+        self.jobs = jobs or os.cpu_count()
+        self.symbols = symbols
+        self.cache = cache
+        self.max_upload = max_upload
+        self.results = MemoryCache(memory_bytes)
+        self.tables = OrderedDict()
+        self.keys = keys
+        self.pool = None
+        self.elf_slots = None
+        self.symbol_versions = {}
+
+    def start(self):
+        # compile / load the default symbol set before the first request needs it,
+        # and hash every set a request can pick once, not per request
+        load_symbols(self.symbols)
+        for name in set(available_symbol_sets()) | {self.symbols}:
+            self.symbol_versions[name] = symbols_version(name)
+        self.pool = ProcessPoolExecutor(max_workers=self.jobs)
+        self.elf_slots = asyncio.Semaphore(self.jobs)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    @contextlib.contextmanager
+    def image(self, query, body):
+        # the flash image of a request: uploaded in the body, or a local path
+        if body:
+            image = memoryview(body)
+            if self.keys is None:
+                yield image
+                return
+            from esp32_decrypt import DecryptedImage
+            image = DecryptedImage(image, self.keys)
+            try:
+                yield image
+            finally:
+                image.close()
+            return
+        path = query.get("path")
+        if not path:
+            raise RequestError(400, "pass an image path (?path=...) or upload the image as the request body")
+        if not os.path.isfile(source_file(path)):
+            raise RequestError(404, "no such image: " + path)
+        with flash_image(path, self.keys) as image:
+            yield image
+
+    def partition_table(self, query, image):
+        # partition tables of images given by path are kept until the file changes
+        path = query.get("path")
+        if path is None:
+            return read_partition_table(image)
+        info = os.stat(source_file(path))
+        key = (os.path.abspath(path), info.st_mtime_ns, info.st_size)
+        part_table = self.tables.get(key)
+        if part_table is None:
+            part_table = self.tables[key] = read_partition_table(image)
+            if len(self.tables) > 256:
+                self.tables.popitem(last=False)
+        return part_table
+
+    def find_partition(self, query, image, check):
+        part_table = self.partition_table(query, image)
+        label = query.get("partition")
+        if not label:
+            raise RequestError(400, "missing ?partition=<label>")
+        if label not in part_table:
+            raise RequestError(404, "partition '%s' not found" % label)
+        part = part_table[label]
+        if not check(part):
+            raise RequestError(400, "partition '%s' has the wrong type for this request" % label)
+        return part
+
+    async def partition(self, image, part, kind, *parts):
+        # (partition bytes, result_key()); slicing an encrypted or compressed
+        # image reads the whole partition and the key hashes all of it, so
+        # both happen on the thread pool rather than stalling other clients
+        def read():
+            data = image[part["offset"]:part["offset"] + part["size"]]
+            return data, result_key(kind, data, *parts)
+        return await asyncio.get_running_loop().run_in_executor(None, read)
+
+    async def cached(self, key, build):
+        # memory, then the on-disk cache, then build() (a coroutine)
+        data = self.results.get(key)
+        if data is not None:
+            return data
+        path = self.cache.lookup(key) if self.cache is not None else None
+        if path is not None:
+            try:
+                with open(path, 'rb') as fh:
+                    data = fh.read()
+            except FileNotFoundError:
+                data = None
+        if data is None:
+            data = await build()
+            if self.cache is not None:
+                def write(filename):
+                    with open(filename, 'wb') as fh:
+                        fh.write(data)
+                await asyncio.get_running_loop().run_in_executor(None, self.cache.store, key, write)
+        self.results.put(key, data)
+        return data
+
+    async def elf(self, query, image):
+        symbols = query.get("symbols", self.symbols)
+        # a client picks from the packaged sets; a name is never taken as a path
+        if "symbols" in query and symbols not in available_symbol_sets():
+            raise RequestError(400, "unknown symbol set '%s', use one of: %s" % (symbols, ", ".join(available_symbol_sets())))
+        part = self.find_partition(query, image, lambda part: part["type"] == 0)
+        part_data, key = await self.partition(image, part, "elf", self.symbol_versions[symbols])
+
+        async def build():
+            async with self.elf_slots:
+                return await asyncio.get_running_loop().run_in_executor(self.pool, build_elf, part_data.tobytes(), symbols)
+        return 200, "application/octet-stream", await self.cached(key, build)
+
+    async def nvs(self, query, image):
+        output_type = query.get("format", "json")
+        if output_type not in ("json", "ndjson", "values"):
+            raise RequestError(400, "format must be json, ndjson or values")
+        part = self.find_partition(query, image, lambda part: part["type"] == 1 and part["subtype"] == 2)
+        part_data, key = await self.partition(image, part, "nvs-" + output_type)
+
+        async def build():
+            return await asyncio.get_running_loop().run_in_executor(None, render_nvs, part_data, output_type)
+        content_type = "application/x-ndjson" if output_type == "ndjson" else "application/json"
+        return 200, content_type, await self.cached(key, build)
+
+    async def dispatch(self, method, path, query, body):
+        if method not in ("GET", "POST"):
+            raise RequestError(405, "use GET with ?path=... or POST the image")
+        if path == "/health":
+            return 200, "application/json", b'{"ok": true}'
+        if path not in ROUTES:
+            raise RequestError(404, "unknown endpoint " + path)
+        with self.image(query, body) as image:
+            if path == "/partitions":
+                return 200, "application/json", partition_table_json(self.partition_table(query, image))
+            if path == "/elf":
+                return await self.elf(query, image)
+            return await self.nvs(query, image)
+
+    async def handle(self, reader, writer):
+        # one connection, any number of keep-alive requests
+        try:
+            while True:
+                keep_alive = True
+                try:
+                    request = await read_request(reader, self.max_upload)
+                    if request is None:
+                        break
+                    method, path, query, headers, body = request
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                    status, content_type, response = await self.dispatch(method, path, query, body)
+                except RequestError as e:
+                    status, content_type, response = e.status, "application/json", json.dumps({"error": str(e)}).encode('utf-8')
+                    keep_alive = keep_alive and e.status not in (400, 413)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    break
+                except Exception as e:
+                    status, content_type, response = 500, "application/json", json.dumps({"error": "%s: %s" % (type(e).__name__, e)}).encode('utf-8')
+                write_response(writer, status, content_type, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+def is_loopback(host):
+    # every address host resolves to is a loopback one
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(info[4][0].split('%')[0]).is_loopback for info in infos)
+
+async def run_server(address, service):
+    """Listen on address: a filesystem path for a Unix socket, otherwise
+    [host:]port (host defaults to 127.0.0.1). ?path= opens any file the
+    server can, so only loopback hosts are accepted."""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    service.start()
+    try:
+        if os.sep in address:
+            # a socket file left behind by a server that didn't shut down cleanly
+            if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+                os.remove(address)
+            server = await asyncio.start_unix_server(service.handle, path=address)
+        else:
+            host, _, port = address.rpartition(':')
+            host = host.strip('[]') or "127.0.0.1"
+            if not is_loopback(host):
+                raise ValueError("%s is not a loopback address: the service reads any file it is given a path to, so it only listens locally" % host)
+            server = await asyncio.start_server(service.handle, host, int(port))
+        print("Serving on " + address)
+        sys.stdout.flush()
+        async with server:
+            await stop.wait()
+    finally:
+        service.close()
+        if os.sep in address and os.path.exists(address):
+            os.remove(address)
+
+def serve(address, jobs=None, symbols=DEFAULT_SYMBOLS, cache=None, keys=None):
+    try:
+        asyncio.run(run_server(address, ParserService(jobs, symbols, cache, keys=keys)))
+    except KeyboardInterrupt:
+        pass
+    except ValueError as e:
+        print("Error: " + str(e))
@@ -0,0 +1,383 @@
+import os
+import lzma
+import zlib
+import bisect
+import struct
+import threading
+from esp32_cache import MemoryCache
+
+# compressed / archived flash dumps, told apart by their first bytes
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+ZIP_MAGIC = b'PK\x03\x04'
+TAR_MAGIC_OFFSET = 257
+TAR_MAGIC = b'ustar'
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.xz", ".txz", ".zip")
+COMPRESSED_SUFFIXES = (".gz", ".xz")
+
+# gzip / deflate streams can only be entered where decompression left off:
+# the decompressor state is kept every SOURCE_BLOCK_SIZE output bytes
+SOURCE_BLOCK_SIZE = 1 << 20
+SOURCE_READ_SIZE = 256 << 10
+# decompressed blocks kept per image
+DEFAULT_SOURCE_CACHE_MB = 64
+
+XZ_HEADER_SIZE = 12
+XZ_FOOTER_SIZE = 12
+
+def split_source(spec):
+    """(path, member) of an image source: a file, or a member of a tar or
+    zip archive written archive:member. member is None for plain files."""
+    if os.path.exists(spec) or ':' not in spec:
+        return spec, None
+    path, member = spec.rsplit(':', 1)
+    if os.path.isfile(path):
+        return path, member
+    return spec, None
+
+def source_file(spec):
+    # the file on disk behind an image source, for stat() and friends
+    return split_source(spec)[0]
+
+class RandomAccessImage(object):
+    """A flash image that isn't one mapped file, sliced like the memoryview
+    flash_image() yields for those. Slices come back as memoryviews, so
+    everything downstream of the partition table works unchanged.
+
+    Subclasses provide size() and read_range(start, stop); read_range may
+    return less than asked for at the end of the image. Plain slices don't
+    need the size, which for a compressed stream costs a full pass."""
+
+    def size(self):
+        raise NotImplementedError
+
+    def read_range(self, start, stop):
+        raise NotImplementedError
+
+    def __len__(self):
+        return self.size()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                raise ValueError("image slices must be contiguous")
+            start = 0 if key.start is None else key.start
+            stop = key.stop
+            if start < 0 or stop is None or stop < 0:
+                start, stop, _ = key.indices(len(self))
+            return self.read_range(start, max(start, stop))
+        if key < 0:
+            key += len(self)
+        data = self.read_range(key, key + 1)
+        if not len(data):
+            raise IndexError("image index out of range")
+        return data[0]
+
+class SliceImage(RandomAccessImage):
+    # length bytes of another image from offset on: a tar member inside a compressed tarball
+
+    def __init__(self, base, offset, length):
+        self.base = base
+        self.offset = offset
+        self.length = length
+
+    def size(self):
+        return self.length
+
+    def read_range(self, start, stop):
+        stop = min(stop, self.length)
+        if start >= stop:
+            return memoryview(b'')
+        return self.base.read_range(self.offset + start, self.offset + stop)
+
+class BlockImage(RandomAccessImage):
+    """An image decompressed a block at a time. Blocks are kept in a
+    MemoryCache of cache_bytes, the last one read always, so walking a
+    partition decompresses each block once.
+
+    Subclasses provide block_at(offset), (index, start) of the block
+    holding offset or None past the end, and load_block(index)."""
+
+    def __init__(self, cache_bytes):
+        self.blocks = MemoryCache(cache_bytes)
+        self.last = None
+        # extract_all reads partitions from several threads
+        self.lock = threading.RLock()
+
+    def block(self, index):
+        if self.last is not None and self.last[0] == index:
+            return self.last[1]
+        data = self.blocks.get(index)
+        if data is None:
+            data = self.load_block(index)
+            self.blocks.put(index, data)
+        self.last = (index, data)
+        return data
+
+    def read_range(self, start, stop):
+        pieces = []
+        with self.lock:
+            while start < stop:
+                found = self.block_at(start)
+                if found is None:
+                    break
+                index, block_start = found
+                piece = memoryview(self.block(index))[start - block_start:stop - block_start]
+                if not len(piece):
+                    break
+                pieces.append(piece)
+                start += len(piece)
+        if len(pieces) == 1:
+            return pieces[0]
+        return memoryview(b''.join(pieces))
+
+class DeflateImage(BlockImage):
+    """A gzip file (wbits=31, any number of members) or raw deflate stream
+    (wbits=-15, a zip member) read in SOURCE_BLOCK_SIZE blocks.
+
+    Deflate has no index to seek with, so one is built on the way: each
+    block loaded leaves a copy of the decompressor, and where in the
+    compressed data it stopped, as the checkpoint the next block starts
+    from. Reaching offset n decompresses everything before it once; after
+    that any block is one block's work away. size is the decompressed size,
+    if it is known up front (zip members)."""
+
+    def __init__(self, data, wbits=31, size=None, cache_bytes=DEFAULT_SOURCE_CACHE_MB << 20):
+        BlockImage.__init__(self, cache_bytes)
+        self.data = data
+        self.wbits = wbits
+        self.end = size
+        self.checkpoints = [(0, zlib.decompressobj(wbits))]
+
+    def size(self):
+        with self.lock:
+            while self.end is None:
+                self.block(len(self.checkpoints) - 1)
+        return self.end
+
+    def block_at(self, offset):
+        index = offset // SOURCE_BLOCK_SIZE
+        while index >= len(self.checkpoints) and (self.end is None or offset < self.end):
+            # loading the last block reached leaves the next checkpoint, or finds the end
+            self.block(len(self.checkpoints) - 1)
+        if self.end is not None and offset >= self.end:
+            return None
+        return index, index * SOURCE_BLOCK_SIZE
+
+    def next_member(self, pending, pos):
+        # gzip files may hold several members back to back
+        if self.wbits != 31:
+            return False
+        head = bytes(pending[:2]) + self.data[pos:pos + 2].tobytes()
+        return head[:2] == GZIP_MAGIC
+
+    def load_block(self, index):
+        pos, decompressor = self.checkpoints[index]
+        decompressor = decompressor.copy()
+        out = []
+        produced = 0
+        pending = b''
+        finished = False
+        while produced < SOURCE_BLOCK_SIZE:
+            if not pending and pos < len(self.data):
+                pending = self.data[pos:pos + SOURCE_READ_SIZE]
+                pos += len(pending)
+            piece = decompressor.decompress(pending, SOURCE_BLOCK_SIZE - produced)
+            out.append(piece)
+            produced += len(piece)
+            pending = decompressor.unconsumed_tail
+            if decompressor.eof:
+                pending = decompressor.unused_data
+                if not self.next_member(pending, pos):
+                    finished = True
+                    break
+                decompressor = zlib.decompressobj(self.wbits)
+            elif not piece and not pending and pos >= len(self.data):
+                # truncated stream: keep what there is
+                finished = True
+                break
+
+        data = b''.join(out)
+        if finished:
+            self.end = index * SOURCE_BLOCK_SIZE + len(data)
+        elif index + 1 == len(self.checkpoints):
+            self.checkpoints.append((pos - len(pending), decompressor))
+        return data
+
+def xz_varint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def xz_blocks(data):
+    """Blocks of a single stream .xz file from its index, as (compressed
+    offset, compressed size, decompressed offset, decompressed size)."""
+    end = len(data)
+    while end > XZ_HEADER_SIZE + XZ_FOOTER_SIZE and data[end - 4:end] == b'\0\0\0\0':
+        # stream padding
+        end -= 4
+    footer = data[end - XZ_FOOTER_SIZE:end]
+    if footer[10:12] != b'YZ':
+        raise ValueError("no xz stream footer")
+    index_size = (struct.unpack_from("<I", footer, 4)[0] + 1) * 4
+    index_start = end - XZ_FOOTER_SIZE - index_size
+    index = data[index_start:end - XZ_FOOTER_SIZE]
+    if index_start < XZ_HEADER_SIZE or index[0] != 0:
+        raise ValueError("no xz index")
+
+    count, pos = xz_varint(index, 1)
+    blocks = []
+    offset = XZ_HEADER_SIZE
+    start = 0
+    for _ in range(count):
+        unpadded, pos = xz_varint(index, pos)
+        size, pos = xz_varint(index, pos)
+        blocks.append((offset, unpadded, start, size))
+        offset += (unpadded + 3) & ~3
+        start += size
+    if offset != index_start:
+        raise ValueError("more than one xz stream")
+    return blocks
+
+class XzImage(BlockImage):
+    """An .xz file read one xz block at a time, found through the index at
+    the end of the file. A block decompresses on its own behind a copy of
+    the stream header, so only the blocks a slice touches are read. xz
+    writes one block per file unless told otherwise (xz -T0 or
+    --block-size=1MiB); such files, and concatenated streams, are one big
+    block."""
+
+    def __init__(self, data, cache_bytes=DEFAULT_SOURCE_CACHE_MB << 20):
+        BlockImage.__init__(self, cache_bytes)
+        self.data = data
+        try:
+            self.index = xz_blocks(data)
+        except (ValueError, IndexError, struct.error):
+            self.index = None
+        if self.index is not None:
+            self.starts = [block[2] for block in self.index]
+            self.end = sum(block[3] for block in self.index)
+        else:
+            self.starts = [0]
+            self.end = None
+
+    def size(self):
+        with self.lock:
+            if self.end is None:
+                self.block(0)
+        return self.end
+
+    def block_at(self, offset):
+        if offset >= self.size():
+            return None
+        index = bisect.bisect_right(self.starts, offset) - 1
+        return index, self.starts[index]
+
+    def load_block(self, index):
+        if self.index is None:
+            data = lzma.decompress(self.data)
+            self.end = len(data)
+            return data
+        offset, unpadded, _, size = self.index[index]
+        decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+        # the stream header says which check the block carries; the decompressor
+        # hands the block out as soon as the check passes, never needing the index
+        decompressor.decompress(self.data[:XZ_HEADER_SIZE])
+        data = decompressor.decompress(self.data[offset:offset + ((unpadded + 3) & ~3)])
+        if len(data) != size:
+            raise ValueError("xz block %d: %d bytes instead of %d" % (index, len(data), size))
+        return data
+
+def archive_members(image, member=None):
+    # (name, info) of the regular files in a tar or zip archive image, None if it is neither;
+    # a tarball is only read as far as member, if given
+    from esp32_firmware_reader import ImageReader
+    if isinstance(image, memoryview) and image[:4] == ZIP_MAGIC:
+        import zipfile
+        archive = zipfile.ZipFile(ImageReader(image))
+        return [(info.filename, info) for info in archive.infolist() if not info.is_dir()]
+    if image[TAR_MAGIC_OFFSET:TAR_MAGIC_OFFSET + len(TAR_MAGIC)] == TAR_MAGIC:
+        import tarfile
+        members = []
+        with tarfile.open(fileobj=ImageReader(image), mode='r:') as archive:
+            for info in archive:
+                if info.isfile():
+                    members.append((info.name, info))
+                    if info.name == member:
+                        break
+        return members
+    return None
+
+def pick_member(members, member, spec):
+    # the member asked for, or the only (.bin) file when none is named
+    if member is not None:
+        for name, info in members:
+            if name == member:
+                return info
+        raise FileNotFoundError("no %s in %s" % (member, spec))
+    if len(members) != 1:
+        members = [(name, info) for name, info in members if name.endswith(".bin")]
+    if len(members) != 1:
+        raise ValueError("%s holds %d images, name one as %s:<member>" % (spec, len(members), spec))
+    return members[0][1]
+
+def member_image(image, info):
+    if not hasattr(info, 'compress_type'):
+        # tar member: a stretch of the (decompressed) tarball
+        if isinstance(image, memoryview):
+            return image[info.offset_data:info.offset_data + info.size]
+        return SliceImage(image, info.offset_data, info.size)
+
+    import zipfile
+    from esp32_firmware_reader import ImageReader
+    if info.flag_bits & 0x1:
+        raise ValueError("%s is encrypted" % info.filename)
+    # the data follows the local header, whose name / extra lengths can differ from the central directory's
+    name_len, extra_len = struct.unpack_from("<HH", image, info.header_offset + 26)
+    start = info.header_offset + 30 + name_len + extra_len
+    data = image[start:start + info.compress_size]
+    if info.compress_type == zipfile.ZIP_STORED:
+        return data
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        return DeflateImage(data, -15, info.file_size)
+    # bzip2 / lzma members have no use for an index, read them whole
+    with zipfile.ZipFile(ImageReader(image)) as archive:
+        return memoryview(archive.read(info))
+
+def decompressed(view):
+    # a gzip / xz file's contents, anything else as it is
+    if view[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return DeflateImage(view)
+    if view[:len(XZ_MAGIC)] == XZ_MAGIC:
+        return XzImage(view)
+    return view
+
+def open_source(view, member=None, spec=""):
+    """The flash image in a mapped file: the file itself, its gzip / xz
+    decompressed contents, or a member of a (compressed) tar or zip
+    archive; member names it, and can be left out when the archive holds
+    a single image. spec only goes into error messages."""
+    image = decompressed(view)
+    members = archive_members(image, member)
+    if members is None:
+        if member is not None:
+            raise ValueError("%s is not a tar or zip archive" % spec)
+        return image
+    return member_image(image, pick_member(members, member, spec))
+
+def list_source_members(path):
+    # archive:member specs of every regular file in a tar or zip archive at path, None if it isn't one
+    from esp32_firmware_reader import map_file
+    if not path.endswith(ARCHIVE_SUFFIXES):
+        return None
+    with map_file(path) as view:
+        members = archive_members(decompressed(view))
+    if members is None:
+        return None
+    return ["%s:%s" % (path, name) for name, _ in members]
@@ -0,0 +1,131 @@
+import os
+import struct
+import hashlib
+
+# symbol sets live next to this file, not in the current directory
+SYMBOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# named ROM/IDF symbol sets, each a `readelf -s` listing
+# anything else given as a name is looked up as symbols_<name>.txt, then as a path
+SYMBOL_SETS = {
+    'esp32': 'symbols_dump.txt',
+}
+DEFAULT_SYMBOLS = 'esp32'
+
+# compiled database: header, then .strtab and .symtab exactly as they go into the ELF
+SYMDB_MAGIC = b'ESYM'
+SYMDB_VERSION = 1
+SYMDB_HEADER = struct.Struct("<4sIII") # magic, version, symbol count, strtab length
+ELF32_SYM = struct.Struct("<IIIBBH")   # st_name, st_value, st_size, st_info, st_other, st_shndx
+
+SHN_ABS = 0xfff1
+STB_MAP = {"LOCAL": 0, "GLOBAL": 1}
+STT_MAP = {"NOTYPE": 0, "OBJECT": 1, "FUNC": 2, "FILE": 4}
+
+# cache of loaded databases, keyed by source path
+_loaded = {}
+
+def symbols_path(name):
+    if name in SYMBOL_SETS:
+        return os.path.join(SYMBOLS_DIR, SYMBOL_SETS[name])
+    path = os.path.join(SYMBOLS_DIR, "symbols_" + name + ".txt")
+    if os.path.isfile(path):
+        return path
+    return name
+
+def available_symbol_sets():
+    names = set(SYMBOL_SETS)
+    for filename in os.listdir(SYMBOLS_DIR):
+        if filename.startswith("symbols_") and filename.endswith(".txt") and filename not in SYMBOL_SETS.values():
+            names.add(filename[len("symbols_"):-len(".txt")])
+    return sorted(names)
+
+def compile_symbols(text):
+    """Turn a `readelf -s` listing into (strtab, symtab) bytes.
+
+    The symbols are all absolute, little-endian Elf32_Sym entries; the
+    symtab starts with the mandatory null symbol."""
+    strtab = bytearray(b'\0')
+    symtab = bytearray(ELF32_SYM.size)
+    for line in text.splitlines():
+        line = line.split()
+        if len(line) < 8:
+            continue
+        sym_binding = line[4]
+        sym_type = line[3]
+        sym_size = int(line[2])
+        sym_val = int(line[1], 16)
+        sym_name = line[7]
+
+        name_off = len(strtab)
+        strtab += sym_name.encode('utf-8') + b'\0'
+        st_info = (STT_MAP[sym_type] & 0xf) | (STB_MAP[sym_binding] << 4)
+        symtab += ELF32_SYM.pack(name_off, sym_val, sym_size, st_info, 0, SHN_ABS)
+    return bytes(strtab), bytes(symtab)
+
+def symdb_cache_dirs():
+    yield os.path.join(SYMBOLS_DIR, "__pycache__")
+    yield os.path.join(os.path.expanduser("~"), ".cache", "esp32_image_parser")
+
+def read_symdb(path):
+    with open(path, 'rb') as fh:
+        blob = fh.read()
+    if len(blob) < SYMDB_HEADER.size:
+        return None
+    magic, version, count, strtab_len = SYMDB_HEADER.unpack_from(blob)
+    if magic != SYMDB_MAGIC or version != SYMDB_VERSION:
+        return None
+    view = memoryview(blob)
+    start = SYMDB_HEADER.size
+    strtab = view[start:start + strtab_len]
+    symtab = view[start + strtab_len:]
+    if len(symtab) != count * ELF32_SYM.size:
+        return None
+    return strtab, symtab
+
+def write_symdb(path, strtab, symtab):
+    tmp = path + ".%d.tmp" % os.getpid()
+    with open(tmp, 'wb') as fh:
+        fh.write(SYMDB_HEADER.pack(SYMDB_MAGIC, SYMDB_VERSION, len(symtab) // ELF32_SYM.size, len(strtab)))
+        fh.write(strtab)
+        fh.write(symtab)
+    os.replace(tmp, path)
+
+def symbols_version(name=DEFAULT_SYMBOLS):
+    # identifies the content of a symbol set, e.g. for keying cached ELFs
+    with open(symbols_path(name), 'rb') as fh:
+        return hashlib.sha1(fh.read()).hexdigest()
+
+def load_symbols(name=DEFAULT_SYMBOLS):
+    """Return (strtab, symtab) for a symbol set, compiling it on first use.
+
+    The compiled database is keyed by a hash of the text listing, so editing
+    the listing (or adding a new set) just produces a new cache entry."""
+    path = symbols_path(name)
+    with open(path, 'rb') as fh:
+        text = fh.read()
+    digest = hashlib.sha1(text).hexdigest()
+
+    key = (os.path.abspath(path), digest)
+    if key in _loaded:
+        return _loaded[key]
+
+    db_name = "%s-%s.symdb" % (os.path.splitext(os.path.basename(path))[0], digest[:16])
+    for cache_dir in symdb_cache_dirs():
+        db_path = os.path.join(cache_dir, db_name)
+        if os.path.isfile(db_path):
+            tables = read_symdb(db_path)
+            if tables is not None:
+                _loaded[key] = tables
+                return tables
+
+    tables = compile_symbols(text.decode('utf-8'))
+    for cache_dir in symdb_cache_dirs():
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            write_symdb(os.path.join(cache_dir, db_name), *tables)
+            break
+        except OSError:
+            continue
+    _loaded[key] = tables
+    return tables
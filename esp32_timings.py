@@ -0,0 +1,114 @@
+import os
+import sys
+import time
+import threading
+import contextlib
+
+# phase timings, off unless -timings asks for them
+enabled = False
+events = []
+_local = threading.local()
+
+def enable():
+    global enabled
+    enabled = True
+
+@contextlib.contextmanager
+def phase(name, nbytes=None):
+    """Record wall time, bytes processed and allocations of a block.
+
+    Allocations are the net change in allocated memory blocks; with
+    tracemalloc running (e.g. PYTHONTRACEMALLOC=1) the net bytes too.
+    Costs next to nothing while timings are disabled."""
+    if not enabled:
+        yield
+        return
+
+    import tracemalloc
+    stack = _local.__dict__.setdefault("stack", [])
+    stack.append(name)
+    tracing = tracemalloc.is_tracing()
+    blocks = sys.getallocatedblocks()
+    traced = tracemalloc.get_traced_memory()[0] if tracing else 0
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        stack.pop()
+        event = {
+            "name": name,
+            "parent": stack[-1] if stack else None,
+            "start": start,
+            "seconds": end - start,
+            "alloc_blocks": sys.getallocatedblocks() - blocks,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        if nbytes is not None:
+            event["bytes"] = nbytes
+        if tracing:
+            event["alloc_bytes"] = tracemalloc.get_traced_memory()[0] - traced
+        events.append(event)
+
+def drain():
+    # hand this process's events over, e.g. from a batch worker to the parent
+    drained = events[:]
+    del events[:]
+    return drained
+
+def summary(all_events):
+    # total time, bytes and calls per phase name
+    totals = {}
+    for event in all_events:
+        total = totals.setdefault(event["name"], {"calls": 0, "seconds": 0.0, "bytes": 0, "alloc_blocks": 0})
+        total["calls"] += 1
+        total["seconds"] += event["seconds"]
+        total["bytes"] += event.get("bytes", 0)
+        total["alloc_blocks"] += event["alloc_blocks"]
+    for total in totals.values():
+        if total["bytes"] and total["seconds"]:
+            total["mb_per_s"] = total["bytes"] / total["seconds"] / 1e6
+    return totals
+
+def chrome_trace(all_events):
+    # complete ("X") events; perf_counter is system wide, so pool workers line up
+    trace = []
+    for event in all_events:
+        args = {k: event[k] for k in ("bytes", "alloc_blocks", "alloc_bytes") if k in event}
+        trace.append({"name": event["name"], "ph": "X", "ts": event["start"] * 1e6, "dur": event["seconds"] * 1e6,
+                      "pid": event["pid"], "tid": event["tid"], "args": args})
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+def write_report(filename, fmt="json"):
+    import json
+    all_events = sorted(events, key=lambda e: e["start"])
+    if fmt == "chrome":
+        report = chrome_trace(all_events)
+    else:
+        origin = all_events[0]["start"] if all_events else 0
+        report = {
+            "phases": [dict(e, start=e["start"] - origin) for e in all_events],
+            "summary": summary(all_events),
+        }
+    if filename == '-':
+        print(json.dumps(report, indent=2))
+        return
+    with open(filename, 'w') as fh:
+        json.dump(report, fh, indent=2)
+
+@contextlib.contextmanager
+def profiled(filename):
+    """Run the block under cProfile and dump the stats to filename
+    (inspect with `python -m pstats`). No-op when filename is empty."""
+    if not filename:
+        yield
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
@@ -0,0 +1,152 @@
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from esp32_firmware_reader import (APP_IMAGE_MAGIC, APP_CHIP_IDS, PARTITION_TABLE_OFFSET, flash_image,
+                                   read_partition_table, read_app_image, app_image_header, app_image_extended_header)
+
+# the chips whose ROM loads the second stage bootloader from 0x1000; the
+# later ones (S3, C3, ...) load it from 0x0
+BOOTLOADER_AT_0x1000 = ("esp32", "esp32s2")
+
+def verify_app(data, digest=None):
+    """Checks of one app partition: image checksum and appended SHA-256.
+    An erased slot passes with "empty": True. Returns (checks, hashed) with
+    hashed the number of leading bytes already fed to digest."""
+    if not len(data) or data[0] == 0xFF:
+        return {"empty": True}, 0
+    app = read_app_image(data, True, digest)
+    checks = {"chip": app.chip, "image_size": app.size, "checksum_ok": app.checksum_ok, "sha256_ok": app.sha256_ok}
+    return checks, app.size - (32 if app.sha256 is not None else 0)
+
+def verify_nvs(data, digest=None):
+    # page header and entry CRC32s, feeding digest page by page as they are checked
+    from read_nvs import NVS_PAGE_SIZE, verify_nvs_page
+    bad_pages = []
+    bad_entries = []
+    page_count = len(data) // NVS_PAGE_SIZE
+    for page_num in range(page_count):
+        page = data[page_num * NVS_PAGE_SIZE:(page_num + 1) * NVS_PAGE_SIZE]
+        if digest is not None:
+            digest.update(page)
+        header_ok, entries = verify_nvs_page(page)
+        if not header_ok:
+            bad_pages.append(page_num)
+        bad_entries += [[page_num, entry] for entry in entries]
+    checks = {"pages": page_count, "page_crc_ok": not bad_pages, "entry_crc_ok": not bad_entries}
+    if bad_pages:
+        checks["bad_page_crcs"] = bad_pages
+    if bad_entries:
+        checks["bad_entry_crcs"] = bad_entries
+    return checks, page_count * NVS_PAGE_SIZE
+
+def checks_ok(checks):
+    # every *_ok check that could be made passed (None means there was nothing to check)
+    return all(value is not False for name, value in checks.items() if name.endswith("_ok"))
+
+def verify_partition(part, data, hash_partition=True):
+    """Integrity record of one partition. The partition is read once: its
+    SHA-256 (with hash_partition) is fed by the same walk that checks an
+    app image or NVS pages, and carried on over whatever follows."""
+    record = {"label": part["label"], "type": part["type"], "subtype": part["subtype"],
+              "offset": part["offset"], "size": part["size"], "checks": {}, "errors": []}
+    digest = hashlib.sha256() if hash_partition else None
+    hashed = 0
+    try:
+        if len(data) < part["size"]:
+            record["errors"].append("partition runs past the end of the image")
+        if part["type"] == 0:
+            record["checks"], hashed = verify_app(data, digest)
+        elif part["type"] == 1 and part["subtype"] == 2:
+            record["checks"], hashed = verify_nvs(data, digest)
+    except ValueError as e:
+        record["errors"].append(str(e))
+        # the digest may have been fed part of the image, start over
+        digest = hashlib.sha256() if hash_partition else None
+        hashed = 0
+    if digest is not None:
+        digest.update(data[hashed:])
+        record["sha256"] = digest.hexdigest()
+    record["ok"] = not record["errors"] and checks_ok(record["checks"])
+    return record
+
+def bootloader_offset(image):
+    """Where the bootloader image starts, or None if there is none.
+
+    An image header at 0x0 names the chip: an S3 or C3 bootloader starts
+    there, and its code at 0x1000 may well hold a 0xE9 byte. 0x1000 is
+    only tried when 0x0 holds no header or an ESP32 / S2 one."""
+    header_size = app_image_header.size + app_image_extended_header.size
+    header = image[:header_size]
+    if len(header) == header_size and header[0] == APP_IMAGE_MAGIC:
+        chip_id = app_image_extended_header.unpack_from(header, app_image_header.size)[4]
+        if APP_CHIP_IDS.get(chip_id) not in BOOTLOADER_AT_0x1000:
+            return 0x0
+    if len(image) > 0x1000 and image[0x1000] == APP_IMAGE_MAGIC:
+        return 0x1000
+    if len(header) and header[0] == APP_IMAGE_MAGIC:
+        return 0x0
+    return None
+
+def verify_bootloader(image):
+    # the bootloader app image in front of the partition table, or None if there is none
+    offset = bootloader_offset(image)
+    if offset is None:
+        return None
+    record = {"offset": offset, "errors": []}
+    try:
+        record["checks"], _ = verify_app(image[offset:PARTITION_TABLE_OFFSET])
+    except ValueError as e:
+        record["checks"] = {}
+        record["errors"].append(str(e))
+    record["ok"] = not record["errors"] and checks_ok(record["checks"])
+    return record
+
+def verify_image(image, jobs=None, labels=None):
+    """Integrity report of a mapped flash dump: partition table MD5,
+    bootloader and, per partition (only those in labels, if given), its
+    SHA-256 plus app checksum / SHA-256 or NVS CRC32 checks.
+
+    Partitions are checked by `jobs` threads; hashlib and the CRC32 release
+    the GIL on large buffers."""
+    part_table = read_partition_table(image)
+    parts = [part for part in part_table.values() if labels is None or part["label"] in labels]
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        bootloader = pool.submit(verify_bootloader, image)
+        partitions = list(pool.map(lambda part: verify_partition(part, image[part["offset"]:part["offset"] + part["size"]]), parts))
+    report = {"table_md5_ok": part_table.md5_ok, "bootloader": bootloader.result(), "partitions": partitions}
+    report["ok"] = (part_table.md5_ok is not False and all(p["ok"] for p in partitions)
+                    and (report["bootloader"] is None or report["bootloader"]["ok"]))
+    return report
+
+def check_summary(record):
+    # one line of the verify report
+    if record["errors"]:
+        return "FAILED " + "; ".join(record["errors"])
+    failed = [name[:-3] for name, value in record["checks"].items() if name.endswith("_ok") and value is False]
+    if failed:
+        return "FAILED " + ", ".join(failed)
+    if record["checks"].get("empty"):
+        return "ok (empty)"
+    passed = [name[:-3] for name, value in record["checks"].items() if name.endswith("_ok") and value]
+    return "ok" + (" (" + ", ".join(passed) + ")" if passed else "")
+
+def print_verify_report(report):
+    md5_ok = report["table_md5_ok"]
+    print("  %-16s %s" % ("partition table", "no MD5" if md5_ok is None else "ok (md5)" if md5_ok else "FAILED md5"))
+    if report["bootloader"] is not None:
+        print("  %-16s %s" % ("bootloader", check_summary(report["bootloader"])))
+    for part in report["partitions"]:
+        print("  %-16s %s" % (part["label"], check_summary(part)))
+    print("Integrity " + ("OK" if report["ok"] else "FAILED"))
+
+def verify_file(path, jobs=None, output=None, labels=None, keys=None):
+    # `verify`: print the report and write it as JSON to output, if given; returns it
+    with flash_image(path, keys) as image:
+        report = verify_image(image, jobs, labels)
+    report["image"] = path
+    print_verify_report(report)
+    if output:
+        with open(output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+        print("Wrote integrity report to " + output)
+    return report
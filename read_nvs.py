@@ -1,8 +1,13 @@
-import os
+import sys
+import json
 import struct
 import base64
 import binascii
-from hexdump import hexdump
+from esp32_firmware_reader import image_view
+
+# optional, only used to decode page headers in bulk; see load_numpy()
+numpy = None
+numpy_checked = False
 
 nvs_types =  {
   0x01: "U8",
@@ -34,227 +39,588 @@ nvs_sector_states = {
         0xFFFFFFF0 : "CORRUPT"
 }
 
-namespaces = {}
+NVS_PAGE_SIZE = 4096
+NVS_ENTRY_COUNT = 126
+
+# page header: state, seq no., version, (19 unused), crc32, entry state bitmap
+nvs_page_header = struct.Struct("<IIB19xI32s")
+# entry header: ns index, type, span, chunk index, (crc32), key, data
+nvs_entry_header = struct.Struct("<BBBB4x16s8s")
+
+# each bitmap byte holds four 2-bit entry states, first entry in the low bits
+# (nvs_partition_gen clears bit 2 * n of the bitmap to mark entry n written)
+bitmap_byte_states = [''.join(str((b >> shift) & 3) for shift in (0, 2, 4, 6)) for b in range(256)]
+
+# pages decoded per NumPy batch when streaming, bounds memory on huge partitions
+NVS_DECODE_BATCH = 64
+
+# parse_nvs_values() only hands pages to worker processes past this many,
+# below it starting the pool costs more than decoding
+NVS_PARALLEL_MIN_PAGES = 256
+
+# entry types whose header entry is followed by span - 1 payload entries
+nvs_span_types = (0x21, 0x41, 0x42)
+
+# page states whose entries are live, see nvs_page_records()
+nvs_live_page_states = ("ACTIVE", "FULL", "FREEING")
+
+# importing NumPy takes ~80 ms and it saves ~10 us per page, so only
+# partitions this large pull it in (unless something already imported it)
+NVS_NUMPY_MIN_PAGES = 8192
+
+def load_numpy(page_count=NVS_NUMPY_MIN_PAGES):
+    # NumPy if it is installed and worth importing for page_count pages, else None
+    global numpy, numpy_checked, nvs_page_dtype
+    if numpy_checked:
+        return numpy
+    if page_count < NVS_NUMPY_MIN_PAGES and 'numpy' not in sys.modules:
+        return None
+    numpy_checked = True
+    try:
+        import numpy
+    except ImportError:
+        return None
+    nvs_page_dtype = numpy.dtype([
+        ("state", "<u4"), ("seq_no", "<u4"), ("version", "u1"), ("unused", "V19"),
+        ("crc_32", "<u4"), ("bitmap", "u1", (32,)), ("entries", "V%d" % (NVS_ENTRY_COUNT * 32))])
+    return numpy
+
+def iter_decode_nvs_pages(view):
+    """Unpack the header, entry state bitmap and all 126 entry headers of
+    each page in an NVS partition, one page at a time.
+
+    Yields one (state, seq_no, version, crc_32, bitmap, entry_headers) tuple
+    per page, with the bitmap as a string of 2-bit states and entry_headers
+    as (ns, type, span, chunk_index, key, data) tuples. With NumPy available
+    page headers and bitmaps are decoded NVS_DECODE_BATCH pages at a time in
+    one vectorized pass; entry headers always come from struct.iter_unpack."""
+    page_count = len(view) // NVS_PAGE_SIZE
+    if load_numpy(page_count) is not None:
+        for first in range(0, page_count, NVS_DECODE_BATCH):
+            count = min(NVS_DECODE_BATCH, page_count - first)
+            for page in decode_nvs_pages_numpy(view[first * NVS_PAGE_SIZE:(first + count) * NVS_PAGE_SIZE], count):
+                yield page
+        return
+
+    for page_num in range(page_count):
+        page = view[page_num * NVS_PAGE_SIZE:(page_num + 1) * NVS_PAGE_SIZE]
+        state, seq_no, version, crc_32, bitmap = nvs_page_header.unpack_from(page)
+        bitmap_decoded = ''.join([bitmap_byte_states[b] for b in bitmap])[:NVS_ENTRY_COUNT]
+        entry_headers = list(nvs_entry_header.iter_unpack(page[64:]))
+        yield (state, seq_no, version, crc_32, bitmap_decoded, entry_headers)
+
+def decode_nvs_pages(view):
+    # every page at once, see iter_decode_nvs_pages()
+    return list(iter_decode_nvs_pages(view))
+
+def decode_nvs_pages_numpy(view, page_count):
+    raw = numpy.frombuffer(view, dtype=nvs_page_dtype, count=page_count)
+
+    shifts = numpy.array([0, 2, 4, 6], dtype=numpy.uint8)
+    states = ((raw["bitmap"][:, :, None] >> shifts) & 3).reshape(page_count, 128)[:, :NVS_ENTRY_COUNT]
+    bitmaps = (states + ord('0')).astype(numpy.uint8).tobytes().decode('ascii')
+
+    pages = []
+    states, seq_nos, versions, crcs = (raw[name].tolist() for name in ("state", "seq_no", "version", "crc_32"))
+    for page_num in range(page_count):
+        bitmap_decoded = bitmaps[page_num * NVS_ENTRY_COUNT:(page_num + 1) * NVS_ENTRY_COUNT]
+        # tuples straight out of iter_unpack beat converting the structured array row by row
+        entry_headers = list(nvs_entry_header.iter_unpack(view[page_num * NVS_PAGE_SIZE + 64:(page_num + 1) * NVS_PAGE_SIZE]))
+        pages.append((states[page_num], seq_nos[page_num], versions[page_num], crcs[page_num], bitmap_decoded, entry_headers))
+    return pages
 
-def parse_nvs_entries(entries, entry_state_bitmap):
-    entries_out = []
+# struct formats of the fixed size types, read from the entry's 8 data bytes
+nvs_int_formats = {
+  "U8": "<B",
+  "I8": "<b",
+  "U16": "<H",
+  "I16": "<h",
+  "U32": "<I",
+  "I32": "<i"
+}
+
+class NVSEntry(object):
+    """One entry slot of an NVS page as visited by the parser.
+
+    Slots that hold nothing (erased, empty, or ANY) only carry index and
+    state; `type` is None for them. `value` is an int for the integer types,
+    a str for STR and raw bytes for BLOB/BLOB_DATA and unhandled types."""
+    __slots__ = ("index", "state", "ns_index", "ns", "type", "span", "chunk_index", "key",
+                 "data_type", "size", "value", "chunk_count", "chunk_start")
+
+    def __init__(self, index, state):
+        self.index = index
+        self.state = state
+        self.ns_index = None
+        self.ns = None
+        self.type = None
+        self.span = None
+        self.chunk_index = None
+        self.key = None
+        self.data_type = None
+        self.size = None
+        self.value = None
+        self.chunk_count = None
+        self.chunk_start = None
+
+    @property
+    def written(self):
+        return self.type is not None
+
+class NVSPage(object):
+    """Decoded NVS page header plus the entries parse_nvs_entries visited."""
+    __slots__ = ("index", "state", "seq_no", "version", "crc_32", "entry_state_bitmap", "entries")
+
+    def __init__(self, index, state, seq_no, version, crc_32, entry_state_bitmap, entries):
+        self.index = index
+        self.state = state
+        self.seq_no = seq_no
+        self.version = version
+        self.crc_32 = crc_32
+        self.entry_state_bitmap = entry_state_bitmap
+        self.entries = entries
+
+def parse_nvs_entries(entries, entry_state_bitmap, entry_headers=None, namespaces=None):
+    return list(iter_nvs_page_entries(entries, entry_state_bitmap, entry_headers, namespaces))
+
+def iter_nvs_page_entries(entries, entry_state_bitmap, entry_headers=None, namespaces=None):
+    # entries is the page's 126 * 32 byte entry area (or a list of the 32 byte
+    # entries); namespaces maps namespace index -> name, see nvs_namespaces()
+    if isinstance(entries, list):
+        entries = b''.join(entries)
+    if entry_headers is None:
+        entry_headers = list(nvs_entry_header.iter_unpack(entries))
     i = 0
     while i < 126:
-        entry_data = {}
-        print("  Entry %d" % (i))
-        print("  Bitmap State : %s" % (entry_state_descs[int(entry_state_bitmap[i])]))
-        entry_data["entry_state"] = entry_state_descs[int(entry_state_bitmap[i])]
-
-        entry = entries[i]
-        state = entry_state_bitmap[i]
-    
-        entry_ns = entry[0]
-        entry_type = entry[1]
-        entry_span = entry[2]
-        chunk_index = entry[3]
-
-        key = entry[8:24]
-
-        data = entry[24:]
-        if(entry_type == 0):
-            i += 1
-            continue
+        entry = NVSEntry(i, entry_state_descs[int(entry_state_bitmap[i])])
 
-        if(nvs_types[entry_type] == "ANY"):
+        entry_ns, entry_type, entry_span, chunk_index, key, data = entry_headers[i]
+        if(entry_type == 0 or nvs_types[entry_type] == "ANY"):
             i += 1
+            yield entry
             continue
 
-        decoded_key = ''
-        for c in key:
-            if(c == 0):
-                break
-            decoded_key += chr(c)
-
-        key = decoded_key
-
-        print("    Written Entry %d" % (i))
-        print("      NS Index : %d" % (entry_ns))
-        entry_data["entry_ns_index"] = entry_ns
-
-        if(entry_ns != 0 and entry_ns in namespaces):
-            print("          NS : %s" % (namespaces[entry_ns]))
-            entry_data["entry_ns"] = namespaces[entry_ns]
-
-        print("      Type : %s" % (nvs_types[entry_type]))
-        print("      Span : %d" % (entry_span))
-        print("      ChunkIndex : %d" % (chunk_index))
-        print("      Key : " + key)
-        entry_data["entry_type"] = nvs_types[entry_type]
-        entry_data["entry_span"] = entry_span
-        entry_data["entry_chunk_index"] = chunk_index
-        entry_data["entry_key"] = key
-
-
-        if(nvs_types[entry_type] == "U8"):
-            data = struct.unpack("<B", data[0:1])[0]
-            print("      Data (U8) : %d" % (data))
-            if(entry_ns == 0):
-                namespaces[data] = key
-            entry_data["entry_data_type"] = "U8"
-            entry_data["entry_data"] = data
-
-        elif(nvs_types[entry_type] == "I8"):
-            data = struct.unpack("<b", data[0:1])[0]
-            print("      Data (I8) : %d" % (data))
-            entry_data["entry_data_type"] = "I8"
-            entry_data["entry_data"] = data
-
-        elif(nvs_types[entry_type] == "U16"):
-            data = struct.unpack("<H", data[0:2])[0]
-            print("      Data (U16) : %d" % (data))
-            entry_data["entry_data_type"] = "U16"
-            entry_data["entry_data"] = data
-        
-        elif(nvs_types[entry_type] == "I16"):
-            data = struct.unpack("<h", data[0:2])[0]
-            print("      Data (I16) : %d" % (data))
-            entry_data["entry_data_type"] = "I16"
-            entry_data["entry_data"] = data
-
-        elif(nvs_types[entry_type] == "U32"):
-            data = struct.unpack("<I", data[0:4])[0]
-            print("      Data (U32) : %d" % (data))
-            entry_data["entry_data_type"] = "U32"
-            entry_data["entry_data"] = data
-        
-        elif(nvs_types[entry_type] == "I32"):
-            data = struct.unpack("<i", data[0:4])[0]
-            print("      Data (I32) : %d" % (data))
-            entry_data["entry_data_type"] = "I32"
-            entry_data["entry_data"] = data
-
-        elif(nvs_types[entry_type] == "STR"):
-            str_size = struct.unpack("<H", data[0:2])[0]
-            print("      String :")
-            entry_data["entry_data_type"] = "STR"
-            print("        Size : %d " % (str_size))
-            entry_data["entry_data_size"] = str_size
-            data = b'' 
-            for x in range(1, entry_span):
-                i += 1
-                data += entries[i]
-            data = data[0:str_size-1].decode('ascii')
-            print("        Data : %s" % (data))
-            entry_data["entry_data"] = str(data)
-
-        elif(nvs_types[entry_type] == "BLOB_DATA"):
-            blob_data_size = struct.unpack("<H", data[0:2])[0]
-            print("      Blob Data :")
-            entry_data["entry_data_type"] = "BLOB_DATA"
-            print("        Size : %d " % (blob_data_size))
-            entry_data["entry_data_size"] = blob_data_size
-            data = b'' 
-            for x in range(1, entry_span):
-                i += 1
-                data += entries[i]
-            print("        Data :")
-            hexdump(data[:blob_data_size])
-            entry_data["entry_data"] = base64.b64encode(data[:blob_data_size]).decode('ascii')
-
-        elif(nvs_types[entry_type] == "BLOB"):
-            blob_size = struct.unpack("<H", data[0:2])[0]
-            print("      Data (Blob) :")
-            entry_data["entry_data_type"] = "BLOB"
-            print("        Size : %d " % (blob_size))
-            entry_data["entry_data_size"] = blob_size
-            data = b'' 
-            for x in range(1, entry_span):
-                i += 1
-                data += entries[i]
-            print("        Data :")
-            hexdump(data[:blob_size])
-            entry_data["entry_data"] = base64.b64encode(data[:blob_size]).decode('ascii')
-
-        elif(nvs_types[entry_type] == "BLOB_IDX"):
-            idx_size = struct.unpack("<I", data[0:4])[0]
-            chunk_count = struct.unpack("<B", data[5:6])[0]
-            chunk_start = struct.unpack("<B", data[6:7])[0]
-            print("      Blob IDX :")
-            entry_data["entry_data_type"] = "BLOB_IDX"
-            print("        Size        : %d " % (idx_size))
-            print("        Chunk Count : %d " % (chunk_count))
-            print("        Chunk Start  : %d " % (chunk_start))
-            entry_data["entry_data_size"] = idx_size
-            entry_data["entry_data_chunk_count"] = chunk_count
-            entry_data["entry_data_chunk_start"] = chunk_start
+        key = key.split(b'\0', 1)[0].decode('latin-1')
+
+        entry.ns_index = entry_ns
+        if(entry_ns != 0 and namespaces and entry_ns in namespaces):
+            entry.ns = namespaces[entry_ns]
+
+        entry.type = nvs_types[entry_type]
+        entry.span = entry_span
+        entry.chunk_index = chunk_index
+        entry.key = key
+
+        if(entry.type in nvs_int_formats):
+            entry.data_type = entry.type
+            entry.value = struct.unpack_from(nvs_int_formats[entry.type], data)[0]
+
+        elif(entry.type in ("STR", "BLOB_DATA", "BLOB")):
+            entry.data_type = entry.type
+            entry.size = struct.unpack("<H", data[0:2])[0]
+            # the payload fills the span - 1 entries after this one, take it in one slice
+            data = entries[(i + 1) * 32:(i + entry_span) * 32]
+            i += max(entry_span - 1, 0)
+            if(entry.type == "STR"):
+                entry.value = bytes(data[0:entry.size-1]).decode('ascii')
+            else:
+                entry.value = bytes(data[:entry.size])
+
+        elif(entry.type == "BLOB_IDX"):
+            entry.data_type = "BLOB_IDX"
+            # data size, chunk count, chunk start (0 or 128, by blob version)
+            entry.size, entry.chunk_count, entry.chunk_start = struct.unpack_from("<IBB", data)
 
         else:
-            print("      Data : %s" % (str(data)))
-            entry_data["entry_data"] = str(data)
+            entry.value = bytes(data)
 
-        entries_out.append(entry_data)
         i += 1
-        print("")
-    return entries_out
+        yield entry
+
+def nvs_namespaces(view):
+    """Namespace index -> name for a whole partition.
+
+    Namespaces are the U8 entries of namespace 0 and may sit on any page, so
+    every page's entry headers are scanned up front (stepping over string
+    and blob payloads) instead of relying on definitions coming first."""
+    namespaces = {}
+    for page_num in range(len(view) // NVS_PAGE_SIZE):
+        entry_headers = list(nvs_entry_header.iter_unpack(view[page_num * NVS_PAGE_SIZE + 64:(page_num + 1) * NVS_PAGE_SIZE]))
+        i = 0
+        while i < NVS_ENTRY_COUNT:
+            entry_ns, entry_type, entry_span, chunk_index, key, data = entry_headers[i]
+            if entry_ns == 0 and entry_type == 0x01:
+                namespaces[data[0]] = key.split(b'\0', 1)[0].decode('latin-1')
+            i += max(entry_span, 1) if entry_type in nvs_span_types else 1
+    return namespaces
+
+def nvs_crc32(data):
+    # CRC32 as NVS computes it (crc32_le seeded with 0xffffffff)
+    return binascii.crc32(data, 0xFFFFFFFF)
+
+def verify_nvs_page(page):
+    """Check the CRC32s of one 4 KB page: the header's over its seq no. and
+    version, each written entry's over its header and, for strings and
+    blob chunks, the payload's.
+
+    Returns (header_ok, bad_entries) with bad_entries the indices of entries
+    whose CRC doesn't match. Empty (erased) pages have nothing to check."""
+    state, seq_no, version, crc_32, bitmap = nvs_page_header.unpack_from(page)
+    if state == 0xFFFFFFFF:
+        return True, []
+    header_ok = nvs_crc32(page[4:28]) == crc_32
+    states = ''.join([bitmap_byte_states[b] for b in bitmap])[:NVS_ENTRY_COUNT]
+    entries = page[64:]
+    bad_entries = []
+    i = 0
+    while i < NVS_ENTRY_COUNT:
+        entry = entries[i * 32:(i + 1) * 32]
+        entry_type, span = entry[1], entry[2]
+        step = max(span, 1) if entry_type in nvs_span_types else 1
+        if states[i] == "2" and entry_type not in (0, 0xFF):
+            ok = nvs_crc32(bytes(entry[0:4]) + bytes(entry[8:32])) == struct.unpack_from("<I", entry, 4)[0]
+            if ok and entry_type in nvs_span_types:
+                size, _, data_crc = struct.unpack_from("<HHI", entry, 24)
+                ok = nvs_crc32(entries[(i + 1) * 32:(i + 1) * 32 + size]) == data_crc
+            if not ok:
+                bad_entries.append(i)
+        i += step
+    return header_ok, bad_entries
+
+def nvs_page(view, page_num, header, namespaces=None):
+    # NVSPage for page page_num of view, from its iter_decode_nvs_pages() tuple
+    state, seq_no, version, crc_32, entry_state_bitmap_decoded, entry_headers = header
+    page = NVSPage(page_num, nvs_sector_states[state], seq_no, (version ^ 0xff) + 1, crc_32,
+                   entry_state_bitmap_decoded, [])
+    page.entries = parse_nvs_entries(nvs_page_entry_area(view, page_num), entry_state_bitmap_decoded, entry_headers, namespaces)
+    return page
+
+def iter_nvs_pages(fh):
+    """Yield NVSPage records one page at a time.
+
+    Takes a slice of the mapped flash image or an open file. Does no
+    printing or formatting; see print_nvs_pages() and nvs_pages_to_dicts()
+    for the text and JSON renderings."""
+    # works on a slice of the mapped flash image, or on an open file
+    view = image_view(fh)
+    namespaces = nvs_namespaces(view)
+
+    for x, header in enumerate(iter_decode_nvs_pages(view)):
+        yield nvs_page(view, x, header, namespaces)
+
+def resolve_nvs_namespaces(pages):
+    """Name the entries of every page from the namespace definitions found
+    on any of them. Returns the index -> name map."""
+    namespaces = {}
+    for page in pages:
+        for entry in page.entries:
+            if entry.ns_index == 0 and entry.type == "U8":
+                namespaces[entry.value] = entry.key
+    for page in pages:
+        for entry in page.entries:
+            if entry.written and entry.ns_index != 0:
+                entry.ns = namespaces.get(entry.ns_index)
+    return namespaces
+
+def parse_nvs_pages(fh):
+    """The whole partition as a list of NVSPage records.
+
+    Pages are decoded on their own first, then namespace names are
+    resolved across all of them."""
+    view = image_view(fh)
+    pages = [nvs_page(view, x, header) for x, header in enumerate(iter_decode_nvs_pages(view))]
+    resolve_nvs_namespaces(pages)
+    return pages
+
+def iter_nvs_entries(fh):
+    """Yield (page, entry) for every written entry as soon as it is decoded.
+
+    Only one page is ever held in memory; page.entries stays empty, the
+    page record is there for its header fields."""
+    view = image_view(fh)
+    namespaces = nvs_namespaces(view)
+
+    for x, (state, seq_no, version, crc_32, entry_state_bitmap_decoded, entry_headers) in enumerate(iter_decode_nvs_pages(view)):
+        page = NVSPage(x, nvs_sector_states[state], seq_no, (version ^ 0xff) + 1, crc_32,
+                       entry_state_bitmap_decoded, [])
+        for entry in iter_nvs_page_entries(nvs_page_entry_area(view, x), entry_state_bitmap_decoded, entry_headers, namespaces):
+            if entry.written:
+                yield page, entry
+
+def nvs_page_records(page, bad_entries=()):
+    """What merge_nvs_records() needs of a page: (index, seq_no, entries)
+    with one (index, ns_index, type, key, chunk_index, value, size,
+    chunk_count, chunk_start, crc_ok) tuple per written entry, or None for
+    a page that isn't live. crc_ok is False for the entries in bad_entries,
+    see verify_nvs_page(). Small and cheap to pickle."""
+    if page.state not in nvs_live_page_states:
+        return None
+    return (page.index, page.seq_no,
+            [(e.index, e.ns_index, e.type, e.key, e.chunk_index, e.value, e.size, e.chunk_count, e.chunk_start, e.index not in bad_entries)
+             for e in page.entries if e.written and e.state == "Written"])
+
+def decode_nvs_page_records(data, first_page=0):
+    # first phase, for a run of pages starting at page first_page; runs in pool workers
+    view = image_view(data)
+    records = []
+    for x, header in enumerate(iter_decode_nvs_pages(view)):
+        _, bad_entries = verify_nvs_page(view[x * NVS_PAGE_SIZE:(x + 1) * NVS_PAGE_SIZE])
+        record = nvs_page_records(nvs_page(view, x, header), set(bad_entries))
+        if record is not None:
+            records.append((first_page + x,) + record[1:])
+    return records
+
+def merge_nvs_records(records):
+    """Second phase: merge page records into the current value of every key.
+
+    Pages are replayed in sequence number order, so a later write of a key
+    wins over an earlier one; a BLOB_IDX entry is reassembled from the
+    BLOB_DATA chunks it indexes, which may be spread over several pages.
+    Entries failing their CRC32 are skipped, so a torn or corrupted write
+    doesn't replace the last valid value. A blob with chunks missing keeps
+    what was found, with "complete": False.
+    Returns a list of dicts sorted by namespace index and key."""
+    namespaces = {}
+    latest = {}
+    chunks = {}
+    for page_index, seq_no, entries in sorted(records, key=lambda r: r[1]):
+        for entry in entries:
+            index, ns_index, entry_type, key, chunk_index, value = entry[:6]
+            if not entry[9]:
+                continue
+            if ns_index == 0:
+                if entry_type == "U8":
+                    namespaces[value] = key
+            elif entry_type == "BLOB_DATA":
+                chunks[(ns_index, key, chunk_index)] = value
+            else:
+                latest[(ns_index, key)] = (page_index, seq_no, entry)
+
+    values = []
+    for (ns_index, key), (page_index, seq_no, entry) in sorted(latest.items()):
+        index, _, entry_type, _, _, value, size, chunk_count, chunk_start, _ = entry
+        record = {"namespace": namespaces.get(ns_index), "ns_index": ns_index, "key": key,
+                  "type": entry_type, "page_index": page_index, "page_seq_no": seq_no, "entry_index": index}
+        if entry_type == "BLOB_IDX":
+            parts = [chunks.get((ns_index, key, chunk_start + n)) for n in range(chunk_count)]
+            data = b''.join(part for part in parts if part is not None)
+            record["type"] = "BLOB"
+            record["size"] = size
+            record["chunk_count"] = chunk_count
+            record["complete"] = None not in parts and len(data) == size
+            value = data[:size]
+        record["value"] = value
+        values.append(record)
+    return values
+
+def resolve_nvs_values(pages):
+    # the current value of every key of already parsed pages, see merge_nvs_records();
+    # without the page bytes there are no CRCs to check, every entry counts
+    return merge_nvs_records([r for r in map(nvs_page_records, pages) if r is not None])
+
+def parse_nvs_values(fh, jobs=None):
+    """The current value of every key in the partition.
+
+    Pages are decoded independently, by `jobs` worker processes once there
+    are NVS_PARALLEL_MIN_PAGES of them, and only their live entries come
+    back to be merged by merge_nvs_records()."""
+    view = image_view(fh)
+    page_count = len(view) // NVS_PAGE_SIZE
+    if jobs is None or jobs < 2 or page_count < NVS_PARALLEL_MIN_PAGES:
+        return merge_nvs_records(decode_nvs_page_records(view))
+
+    from concurrent.futures import ProcessPoolExecutor
+    records = []
+    # workers get plain bytes, a mapped view can't be pickled
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(decode_nvs_page_records, view[first * NVS_PAGE_SIZE:min(first + NVS_DECODE_BATCH, page_count) * NVS_PAGE_SIZE].tobytes(), first)
+                   for first in range(0, page_count, NVS_DECODE_BATCH)]
+        for future in futures:
+            records += future.result()
+    return merge_nvs_records(records)
+
+def nvs_page_entry_area(view, page_num):
+    # the 126 entries of a page as one contiguous slice
+    return view[page_num * NVS_PAGE_SIZE + 64:(page_num + 1) * NVS_PAGE_SIZE]
+
+def nvs_entry_to_dict(entry):
+    entry_data = {}
+    entry_data["entry_state"] = entry.state
+    entry_data["entry_ns_index"] = entry.ns_index
+    if(entry.ns is not None):
+        entry_data["entry_ns"] = entry.ns
+    entry_data["entry_type"] = entry.type
+    entry_data["entry_span"] = entry.span
+    entry_data["entry_chunk_index"] = entry.chunk_index
+    entry_data["entry_key"] = entry.key
+
+    if(entry.data_type is not None):
+        entry_data["entry_data_type"] = entry.data_type
+    if(entry.size is not None):
+        entry_data["entry_data_size"] = entry.size
+
+    if(entry.data_type == "BLOB_IDX"):
+        entry_data["entry_data_chunk_count"] = entry.chunk_count
+        entry_data["entry_data_chunk_start"] = entry.chunk_start
+    elif(entry.data_type in ("BLOB", "BLOB_DATA")):
+        entry_data["entry_data"] = base64.b64encode(entry.value).decode('ascii')
+    elif(entry.data_type is None):
+        entry_data["entry_data"] = str(entry.value)
+    else:
+        entry_data["entry_data"] = entry.value
+    return entry_data
+
+def nvs_page_to_dict(page):
+    page_data = {}
+    page_data["page_state"] = page.state
+    page_data["page_seq_no"] = page.seq_no
+    page_data["page_version"] = page.version
+    page_data["page_crc_32"] = page.crc_32
+    page_data["page_entry_state_bitmap"] = page.entry_state_bitmap
+    page_data["entries"] = [nvs_entry_to_dict(entry) for entry in page.entries if entry.written]
+    return page_data
+
+def nvs_pages_to_dicts(pages):
+    # the layout `dump_nvs -nvs_output_type json` prints
+    return [nvs_page_to_dict(page) for page in pages]
+
+def write_nvs_json(fh, out):
+    """Stream the `dump_nvs -nvs_output_type json` document to out.
+
+    Writes the same text as json.dumps(nvs_pages_to_dicts(...)), but one
+    page at a time, so the decoded partition is never held in memory."""
+    out.write("[")
+    for page in iter_nvs_pages(fh):
+        if page.index:
+            out.write(", ")
+        out.write(json.dumps(nvs_page_to_dict(page)))
+    out.write("]")
+
+def decode_nvs_page(view, page_num, namespaces=None):
+    # one page on its own, e.g. to decode again just the pages that changed
+    page_view = view[page_num * NVS_PAGE_SIZE:(page_num + 1) * NVS_PAGE_SIZE]
+    page = nvs_page(page_view, 0, next(iter_decode_nvs_pages(page_view)), namespaces)
+    page.index = page_num
+    return page
+
+def write_nvs_json_update(fh, out, previous_pages, changed_pages):
+    """Write the same document as write_nvs_json(), decoding only the pages
+    listed in changed_pages and taking every other page from previous_pages,
+    the page dicts of an earlier dump of the same partition. Only valid when
+    the namespaces are the same in both dumps."""
+    view = image_view(fh)
+    namespaces = nvs_namespaces(view)
+    changed_pages = set(changed_pages)
+    out.write("[")
+    for x, previous in enumerate(previous_pages):
+        if x:
+            out.write(", ")
+        if x in changed_pages:
+            previous = nvs_page_to_dict(decode_nvs_page(view, x, namespaces))
+        out.write(json.dumps(previous))
+    out.write("]")
+
+def write_nvs_json_file(fh, filename):
+    with open(filename, 'w') as out:
+        write_nvs_json(fh, out)
+
+def nvs_entry_record(page, entry):
+    # one NDJSON line: the entry plus the header fields of its page
+    record = {"page_index": page.index, "page_state": page.state, "page_seq_no": page.seq_no}
+    record.update(nvs_entry_to_dict(entry))
+    return record
+
+def write_nvs_ndjson(fh, out):
+    # one JSON object per written entry, each written as soon as it is decoded
+    for page, entry in iter_nvs_entries(fh):
+        out.write(json.dumps(nvs_entry_record(page, entry)) + "\n")
+
+def nvs_value_to_dict(value):
+    # parse_nvs_values() record with bytes as base64, ready for json
+    if isinstance(value["value"], bytes):
+        return dict(value, value=base64.b64encode(value["value"]).decode('ascii'))
+    return value
+
+def write_nvs_values_json(fh, out, jobs=None):
+    # `dump_nvs -nvs_output_type values`: the current value of every key
+    values = parse_nvs_values(fh, jobs)
+    out.write(json.dumps([nvs_value_to_dict(value) for value in values]))
+
+def hex_lines(data):
+    # the lines of a classic hex dump: offset, 16 bytes in hex, printable ASCII
+    for offset in range(0, len(data), 16):
+        line = bytes(data[offset:offset + 16])
+        hex_part = ' '.join('%02X' % b for b in line[:8])
+        if len(line) > 8:
+            hex_part += '  ' + ' '.join('%02X' % b for b in line[8:])
+        text = ''.join(chr(b) if 0x20 <= b < 0x7f else '.' for b in line)
+        yield '%08X: %-48s  %s' % (offset, hex_part, text)
+
+def print_nvs_entry(entry, out=None):
+    out = out or sys.stdout
+    print("  Entry %d" % (entry.index), file=out)
+    print("  Bitmap State : %s" % (entry.state), file=out)
+    if not entry.written:
+        return
+
+    print("    Written Entry %d" % (entry.index), file=out)
+    print("      NS Index : %d" % (entry.ns_index), file=out)
+    if(entry.ns is not None):
+        print("          NS : %s" % (entry.ns), file=out)
+    print("      Type : %s" % (entry.type), file=out)
+    print("      Span : %d" % (entry.span), file=out)
+    print("      ChunkIndex : %d" % (entry.chunk_index), file=out)
+    print("      Key : " + entry.key, file=out)
+
+    if(entry.data_type in nvs_int_formats):
+        print("      Data (%s) : %d" % (entry.data_type, entry.value), file=out)
+    elif(entry.data_type == "STR"):
+        print("      String :", file=out)
+        print("        Size : %d " % (entry.size), file=out)
+        print("        Data : %s" % (entry.value), file=out)
+    elif(entry.data_type in ("BLOB_DATA", "BLOB")):
+        if(entry.data_type == "BLOB_DATA"):
+            print("      Blob Data :", file=out)
+        else:
+            print("      Data (Blob) :", file=out)
+        print("        Size : %d " % (entry.size), file=out)
+        print("        Data :", file=out)
+        if(entry.value):
+            # hex is only ever rendered here, line by line as it is printed
+            for line in hex_lines(entry.value):
+                print(line, file=out)
+    elif(entry.data_type == "BLOB_IDX"):
+        print("      Blob IDX :", file=out)
+        print("        Size        : %d " % (entry.size), file=out)
+        print("        Chunk Count : %d " % (entry.chunk_count), file=out)
+        print("        Chunk Start  : %d " % (entry.chunk_start), file=out)
+    else:
+        print("      Data : %s" % (str(entry.value)), file=out)
+    print("", file=out)
+
+def print_nvs_pages(pages, out=None):
+    # the layout `dump_nvs` prints by default
+    out = out or sys.stdout
+    for page in pages:
+        print("Page %d" % (page.index), file=out)
+        print("  page state : %s" % (page.state), file=out)
+        print("  page seq no. : %d" % (page.seq_no), file=out)
+        print("  page version : %d" % (page.version), file=out)
+        print("  crc 32 : %d" % (page.crc_32), file=out)
+        print("  page entry state bitmap (decoded) : %s" % (page.entry_state_bitmap), file=out)
+        for entry in page.entries:
+            print_nvs_entry(entry, out)
+        print("", file=out)
+        print("", file=out)
+        print("------------------------------------------------------------------------------", file=out)
+        print("", file=out)
+    print("", file=out)
 
 def read_nvs_pages(fh):
-    pages = []
-    fh.seek(0, os.SEEK_END)
-    file_len = fh.tell()
-
-    sector_pos = 0
-    x = 0
-    while(sector_pos < file_len):
-        page_data = {}
-
-        fh.seek(sector_pos)
-        page_state = nvs_sector_states[struct.unpack("<I", fh.read(4))[0]]
-        seq_no = struct.unpack("<I", fh.read(4))[0]
-        version = (ord(fh.read(1)) ^ 0xff) + 1
-
-        print("Page %d" % (x))
-        print("  page state : %s" % (page_state))
-        print("  page seq no. : %d" % (seq_no))
-        print("  page version : %d" % (version))
-       
-        page_data["page_state"] = page_state
-        page_data["page_seq_no"] = seq_no
-        page_data["page_version"] = version
-
-        fh.read(19) # unused
-
-        crc_32 = struct.unpack("<I", fh.read(4))[0]
-        print("  crc 32 : %d" % (crc_32))
-        page_data["page_crc_32"] = crc_32
-
-        entry_state_bitmap = fh.read(32)
-        entry_state_bitmap_decoded = ''
-
-        for entry_num in range(0, 126):
-            bitnum = entry_num * 2
-            byte_index = int(bitnum / 8)
-            temp = entry_state_bitmap[byte_index]
-            
-            temp = temp >> (6 - (bitnum % 8))
-            temp = temp & 3
-            entry_state_bitmap_decoded = entry_state_bitmap_decoded + str(temp)
-
-        print("  page entry state bitmap (decoded) : %s" % (entry_state_bitmap_decoded))
-        page_data["page_entry_state_bitmap"] = entry_state_bitmap_decoded 
-        sector_pos += 4096
-        x += 1
-
-        entries = []
-        entry_data = ''
-        for entry in entry_state_bitmap_decoded:
-            entry_data = fh.read(32)
-            entries.append(entry_data)
-
-        page_data["entries"] = parse_nvs_entries(entries, entry_state_bitmap_decoded)
-
-        print("")
-        print("")
-        print("------------------------------------------------------------------------------")
-        print("")
-        pages.append(page_data)
-
-    print("")
-    return pages
+    # parse, print the text dump and return the JSON-ready page dicts
+    pages = parse_nvs_pages(fh)
+    print_nvs_pages(pages)
+    return nvs_pages_to_dicts(pages)
 
 #parser = argparse.ArgumentParser()
 #parser.add_argument("nvs_bin_file", help="nvs partition binary file", type=str)
@@ -0,0 +1,96 @@
+import os
+import sys
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, os.pardir))
+sys.path.insert(0, os.path.join(TESTS_DIR, os.pardir, "benchmarks"))
+
+import synthetic
+
+# small enough that every test can build its own image
+FLASH_SIZE = 1 << 20
+APP_SIZE = 16 << 10
+
+def make_image(**kwargs):
+    # (image bytes, partitions) of a small synthetic flash dump
+    kwargs.setdefault("flash_size", FLASH_SIZE)
+    kwargs.setdefault("app_size", APP_SIZE)
+    kwargs.setdefault("nvs_pages", 3)
+    return synthetic.flash_image(**kwargs)
+
+def erase_partition(image, partitions, label):
+    # the image with one partition erased back to 0xff
+    image = bytearray(image)
+    for part_label, part_type, subtype, offset, size, *flags in partitions:
+        if part_label == label:
+            image[offset:offset + size] = b'\xff' * size
+    return bytes(image)
+
+@pytest.fixture
+def flash_file(tmp_path):
+    image, _ = make_image()
+    path = tmp_path / "flash.bin"
+    path.write_bytes(image)
+    return str(path)
+
+# flash encryption, done the way the chip does it, for the decryption tests
+NVS_KEYS_OFFSET = 0x30000
+
+def encrypted_plain_image():
+    """(image bytes, partitions, nvs_key): a small flash dump with an
+    nvs_keys partition (flagged encrypted) holding a random NVS key."""
+    import struct
+    import random
+    image, partitions = make_image()
+    partitions = partitions + [("nvs_keys", 1, 4, NVS_KEYS_OFFSET, 0x1000, 1)]
+    nvs_key = random.Random(5).getrandbits(512).to_bytes(64, 'little')
+    image = bytearray(image)
+    image[synthetic.PARTITION_TABLE_OFFSET:synthetic.PARTITION_TABLE_OFFSET + 0xC00] = synthetic.partition_table(partitions)
+    image[NVS_KEYS_OFFSET:NVS_KEYS_OFFSET + 68] = nvs_key + struct.pack("<I", synthetic.nvs_crc32(nvs_key))
+    return bytes(image), partitions, nvs_key
+
+def encrypt_nvs(image, part_offset, part_size, nvs_key):
+    # XTS-AES-256 over every written 32 byte entry, tweaked with its offset in the partition
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    for page in range(part_offset, part_offset + part_size, 4096):
+        if image[page:page + 4] == b'\xff' * 4:
+            continue
+        for entry in range(page + 64, page + 4096, 32):
+            if image[entry:entry + 32] == b'\xff' * 32:
+                continue
+            tweak = (entry - part_offset).to_bytes(16, 'little')
+            image[entry:entry + 32] = Cipher(algorithms.AES(nvs_key), modes.XTS(tweak)).encryptor().update(bytes(image[entry:entry + 32]))
+
+def encrypt_flash(image, start, end, scheme, key):
+    # flash encryption of [start, end); sectors that are erased stay erased
+    import struct
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from esp32_decrypt import esp32_block_keys
+    for sector in range(start, end, 0x1000):
+        if image[sector:sector + 0x1000] == b'\xff' * 0x1000:
+            continue
+        if scheme == "esp32":
+            # AES decryption of each byte-reversed 16 byte block, with the block's tweaked key
+            for offset in range(sector, sector + 0x1000, 32):
+                cipher = Cipher(algorithms.AES(esp32_block_keys(key, offset, 1)), modes.ECB()).decryptor()
+                block = bytes(image[offset:offset + 32])
+                image[offset:offset + 32] = cipher.update(block[15::-1])[::-1] + cipher.update(block[:15:-1])[::-1]
+        else:
+            for offset in range(sector, sector + 0x1000, 128):
+                tweak = struct.pack("<I", offset) + b'\0' * 12
+                cipher = Cipher(algorithms.AES(key), modes.XTS(tweak)).encryptor()
+                image[offset:offset + 128] = cipher.update(bytes(image[offset:offset + 128])[::-1])[::-1]
+
+def encrypt_image(image, partitions, scheme, key, nvs_key):
+    """image flash encrypted with key: bootloader and partition table,
+    app partitions and partitions flagged encrypted, plus its NVS
+    partitions encrypted with nvs_key."""
+    image = bytearray(image)
+    encrypt_flash(image, 0, synthetic.PARTITION_TABLE_OFFSET + 0x1000, scheme, key)
+    for label, part_type, subtype, offset, size, *flags in partitions:
+        if part_type == 1 and subtype == 2:
+            encrypt_nvs(image, offset, size, nvs_key)
+        elif part_type == 0 or (flags and flags[0] & 1):
+            encrypt_flash(image, offset, offset + size, scheme, key)
+    return bytes(image)
@@ -0,0 +1,113 @@
+import struct
+import random
+import pytest
+import synthetic
+from esp32_firmware_reader import MemoryMap, read_app_image
+from esp32_image_parser import image2elf
+
+EM_XTENSA = 94
+EM_RISCV = 243
+
+# chip id: chip, (DROM, DRAM, IRAM, IRAM, IROM) load addresses, their segment names, e_machine
+CHIPS = {
+    0: ("esp32", (0x3F400020, 0x3FFB0000, 0x40080000, 0x40080400, 0x400D0018),
+        ("DROM", "BYTE_ACCESSIBLE, DRAM, DMA", "IRAM", "IRAM", "IROM"), EM_XTENSA),
+    2: ("esp32s2", (0x3F000020, 0x3FFB0000, 0x40020000, 0x40020400, 0x40080018),
+        ("DROM", "BYTE_ACCESSIBLE, MEM_INTERNAL, DRAM", "MEM_INTERNAL, IRAM",
+         "MEM_INTERNAL, IRAM", "IROM"), EM_XTENSA),
+    5: ("esp32c3", (0x3C000020, 0x3FC88000, 0x4037C000, 0x4037C400, 0x42000018),
+        ("DROM", "DRAM, BYTE_ACCESSIBLE", "IRAM", "IRAM", "IROM"), EM_RISCV),
+    9: ("esp32s3", (0x3C000020, 0x3FC88000, 0x40370000, 0x40370400, 0x42000018),
+        ("DROM", "BYTE_ACCESSIBLE, MEM_INTERNAL, DRAM", "MEM_INTERNAL, IRAM",
+         "MEM_INTERNAL, IRAM", "IROM"), EM_XTENSA),
+}
+
+SECTIONS = {".flash.rodata": 0, ".dram0.data": 1, ".iram0.vectors": 2, ".flash.text": 4}
+
+def app(chip_id):
+    rnd = random.Random(chip_id)
+    addrs = CHIPS[chip_id][1]
+    segments = [(addr, rnd.getrandbits(8 * 0x400).to_bytes(0x400, 'little')) for addr in addrs]
+    return synthetic.app_image(segments, entrypoint=addrs[2], chip_id=chip_id)
+
+def elf_header(filename):
+    # e_machine and {section name: address} of an ELF32 file
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+    e_machine, = struct.unpack_from("<H", data, 18)
+    e_shoff, = struct.unpack_from("<I", data, 32)
+    e_shentsize, e_shnum, e_shstrndx = struct.unpack_from("<HHH", data, 46)
+    def shdr(i):
+        return struct.unpack_from("<IIIIII", data, e_shoff + i * e_shentsize)
+    strtab_offset = shdr(e_shstrndx)[4]
+    sections = {}
+    for i in range(e_shnum):
+        name, _, _, addr, _, _ = shdr(i)
+        name = data[strtab_offset + name:data.index(b'\0', strtab_offset + name)].decode()
+        sections[name] = addr
+    return e_machine, sections
+
+@pytest.mark.parametrize("chip_id", sorted(CHIPS))
+def test_read_app_image(chip_id):
+    chip, addrs, names, _ = CHIPS[chip_id]
+    image = read_app_image(memoryview(app(chip_id)))
+    assert (image.chip, image.chip_id, image.entrypoint) == (chip, chip_id, addrs[2])
+    assert [seg.addr for seg in image.segments] == list(addrs)
+    assert [seg.name for seg in image.segments] == list(names)
+    assert image.checksum_ok and image.sha256_ok
+
+@pytest.mark.parametrize("chip_id", sorted(CHIPS))
+def test_image2elf(tmp_path, chip_id):
+    _, addrs, _, e_machine = CHIPS[chip_id]
+    output = str(tmp_path / "app.elf")
+    assert image2elf(memoryview(app(chip_id)), output, quiet=True) == []
+    machine, sections = elf_header(output)
+    assert machine == e_machine
+    for name, segment in SECTIONS.items():
+        assert sections[name] == addrs[segment]
+
+def test_unsupported_chip():
+    with pytest.raises(ValueError, match="unsupported chip id 1"):
+        read_app_image(memoryview(synthetic.app_image([(0x3F400020, b'\0' * 16)], chip_id=1)))
+
+def test_checksum_mismatch(tmp_path, capsys):
+    image = bytearray(app(0))
+    # a byte of the first segment's data: both the checksum and the SHA-256 are off
+    image[24 + 8] ^= 0xFF
+    app_image = read_app_image(memoryview(bytes(image)))
+    assert app_image.checksum_ok is False and app_image.sha256_ok is False
+    warnings = image2elf(memoryview(bytes(image)), str(tmp_path / "app.elf"))
+    assert warnings == ["app image checksum mismatch", "app image SHA-256 mismatch"]
+    assert "Warning: app image checksum mismatch" in capsys.readouterr().out
+
+def test_sha256_mismatch(tmp_path):
+    image = bytearray(app(9))
+    image[-1] ^= 0xFF
+    app_image = read_app_image(memoryview(bytes(image)))
+    assert app_image.checksum_ok is True and app_image.sha256_ok is False
+    warnings = image2elf(memoryview(bytes(image)), str(tmp_path / "app.elf"), quiet=True)
+    assert warnings == ["app image SHA-256 mismatch"]
+
+@pytest.mark.parametrize("cut, message", [
+    (24 + 4, "truncated in segment table"),
+    (24 + 8 + 0x100, "segment at 0x3f400020 runs past the end"),
+    (24 + 5 * (8 + 0x400) + 4, "truncated before its checksum"),
+    (-16, "truncated in its SHA-256"),
+])
+def test_truncated(tmp_path, cut, message):
+    image = memoryview(app(0)[:cut])
+    with pytest.raises(ValueError, match=message):
+        read_app_image(image)
+    with pytest.raises(ValueError, match=message):
+        image2elf(image, str(tmp_path / "app.elf"), quiet=True)
+
+def test_memory_map():
+    memory_map = MemoryMap([[0x100, 0x200, "A"], [0x180, 0x300, "B"], [0x400, 0x500, "C"]])
+    assert memory_map.name(0xFF) == ''
+    assert memory_map.name(0x100) == "A"
+    assert memory_map.name(0x180) == "A, B"
+    assert memory_map.name(0x1FF) == "A, B"
+    assert memory_map.name(0x200) == "B"
+    assert memory_map.name(0x300) == ''
+    assert memory_map.name(0x4FF) == "C"
+    assert memory_map.name(0x500) == ''
@@ -0,0 +1,44 @@
+import os
+import zipfile
+from conftest import make_image
+from esp32_batch import run_batch
+
+def test_mixed_directory(tmp_path, capsys):
+    image, partitions = make_image()
+    dumps = tmp_path / "dumps"
+    dumps.mkdir()
+    (dumps / "good.bin").write_bytes(image)
+    # cut off before the partition table
+    (dumps / "short.bin").write_bytes(image[:0x8000])
+    # an app slot holding something that isn't an app image
+    bad = bytearray(image)
+    ota_0 = [p for p in partitions if p[0] == "ota_0"][0]
+    bad[ota_0[3]] = 0x00
+    (dumps / "bad.bin").write_bytes(bytes(bad))
+    with zipfile.ZipFile(str(dumps / "d.zip"), 'w') as archive:
+        archive.writestr("flash.bin", image)
+        archive.writestr("other.txt", b"release notes\n")
+
+    out = tmp_path / "out"
+    manifest = run_batch(str(dumps), str(out), jobs=1)
+    printed = capsys.readouterr().out
+    results = {os.path.relpath(r["image"], str(dumps)): r for r in manifest["images"]}
+    assert sorted(results) == ["bad.bin", "d.zip:flash.bin", "d.zip:other.txt", "good.bin", "short.bin"]
+
+    assert sorted(os.path.relpath(path, str(dumps)) for path in manifest["failed"]) == ["bad.bin", "short.bin"]
+    assert [os.path.relpath(path, str(dumps)) for path in manifest["skipped"]] == ["d.zip:other.txt"]
+    assert results["short.bin"]["not_image"] is True
+    assert "no partition table" in results["short.bin"]["errors"][0]
+    bad_parts = {p["label"]: p for p in results["bad.bin"]["partitions"]}
+    assert bad_parts["ota_0"]["errors"] and not bad_parts["ota_1"]["errors"]
+    assert results["d.zip:other.txt"]["partitions"] == []
+    assert not os.path.exists(out / "other")
+    for name in ("good.bin", "d.zip:flash.bin"):
+        assert not results[name]["errors"]
+        assert {p["label"] for p in results[name]["partitions"]} == {p[0] for p in partitions}
+
+    assert "d.zip:other.txt skipped, not a flash image" in printed
+    assert "short.bin FAILED ValueError: no partition table at 0x8000" in printed
+    assert "bad.bin FAILED" in printed
+    assert "good.bin ok" in printed
+    assert "d.zip:flash.bin ok" in printed
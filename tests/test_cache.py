@@ -0,0 +1,124 @@
+import os
+import sys
+import hashlib
+from conftest import make_image
+from esp32_cache import WARNINGS_SUFFIX, ResultCache, result_key
+from esp32_extract import extract_image
+from esp32_symbols import symbols_path, symbols_version
+
+def create_elf(monkeypatch, capsys, flash_file, output, *options):
+    import esp32_image_parser
+    monkeypatch.setattr(sys, "argv", ["esp32_image_parser.py", "create_elf", flash_file, "-partition", "ota_0",
+                                      "-output", output] + list(options))
+    esp32_image_parser.main()
+    return capsys.readouterr().out
+
+def cache_files(directory):
+    return [os.path.join(root, name) for root, _, names in os.walk(directory) for name in names]
+
+def cache_entries(directory):
+    return sorted(os.path.basename(path) for path, _, _ in ResultCache(directory).entries())
+
+def corrupt_flash_file(tmp_path):
+    # a dump whose ota_0 app image fails its checksum and SHA-256
+    image, partitions = make_image()
+    image = bytearray(image)
+    ota_0 = [p for p in partitions if p[0] == "ota_0"][0]
+    image[ota_0[3] + 0x100] ^= 0xFF
+    path = tmp_path / "flash.bin"
+    path.write_bytes(bytes(image))
+    return str(path)
+
+def other_symbols(tmp_path):
+    # the packaged set less its last symbol
+    path = str(tmp_path / "symbols_other.txt")
+    with open(symbols_path("esp32")) as fh:
+        lines = fh.read().splitlines(True)
+    with open(path, 'w') as fh:
+        fh.writelines(lines[:-1])
+    return path
+
+def test_create_elf_from_cache(tmp_path, monkeypatch, capsys, flash_file):
+    cache_dir = str(tmp_path / "cache")
+    first = str(tmp_path / "first.elf")
+    second = str(tmp_path / "second.elf")
+    assert "cached" not in create_elf(monkeypatch, capsys, flash_file, first, "-cache_dir", cache_dir)
+    assert len(cache_entries(cache_dir)) == 1
+    assert "Writing cached ELF to " + second in create_elf(monkeypatch, capsys, flash_file, second, "-cache_dir", cache_dir)
+    with open(first, 'rb') as a, open(second, 'rb') as b:
+        assert a.read() == b.read()
+
+    # another symbol set is another entry
+    out = create_elf(monkeypatch, capsys, flash_file, str(tmp_path / "third.elf"), "-cache_dir", cache_dir, "-symbols", other_symbols(tmp_path))
+    assert "cached" not in out
+    assert len(cache_entries(cache_dir)) == 2
+
+def test_cached_elf_warnings(tmp_path, monkeypatch, capsys):
+    flash_file = corrupt_flash_file(tmp_path)
+    cache_dir = str(tmp_path / "cache")
+    first = create_elf(monkeypatch, capsys, flash_file, str(tmp_path / "first.elf"), "-cache_dir", cache_dir)
+    second = create_elf(monkeypatch, capsys, flash_file, str(tmp_path / "second.elf"), "-cache_dir", cache_dir)
+    assert "Writing cached ELF" in second
+    for out in (first, second):
+        assert "Warning: app image checksum mismatch" in out
+        assert "Warning: app image SHA-256 mismatch" in out
+
+def test_entry_without_warnings_is_rebuilt(tmp_path, monkeypatch, capsys, flash_file):
+    cache_dir = str(tmp_path / "cache")
+    create_elf(monkeypatch, capsys, flash_file, str(tmp_path / "first.elf"), "-cache_dir", cache_dir)
+    for path in cache_files(cache_dir):
+        if path.endswith(WARNINGS_SUFFIX):
+            os.remove(path)
+    assert "cached" not in create_elf(monkeypatch, capsys, flash_file, str(tmp_path / "second.elf"), "-cache_dir", cache_dir)
+    assert "Writing cached ELF" in create_elf(monkeypatch, capsys, flash_file, str(tmp_path / "third.elf"), "-cache_dir", cache_dir)
+
+def test_extract_replays_warnings(tmp_path):
+    flash_file = corrupt_flash_file(tmp_path)
+    cache = ResultCache(str(tmp_path / "cache"))
+    first = extract_image(flash_file, str(tmp_path / "first"), jobs=1, cache=cache)
+    second = extract_image(flash_file, str(tmp_path / "second"), jobs=1, cache=cache)
+    ota_0 = [[p for p in result["partitions"] if p["label"] == "ota_0"][0] for result in (first, second)]
+    assert ota_0[0]["cached"] == [] and ota_0[1]["cached"] == ["elf"]
+    assert ota_0[0]["warnings"] == ota_0[1]["warnings"] == ["app image checksum mismatch", "app image SHA-256 mismatch"]
+    # an ELF carried forward from a previous run keeps its warnings too
+    third = extract_image(flash_file, str(tmp_path / "third"), jobs=1, previous=second)
+    ota_0 = [p for p in third["partitions"] if p["label"] == "ota_0"][0]
+    assert ota_0["carried"] == ["elf"]
+    assert ota_0["warnings"] == ["app image checksum mismatch", "app image SHA-256 mismatch"]
+
+def test_cache_max_mb(tmp_path, monkeypatch, capsys, flash_file):
+    cache_dir = str(tmp_path / "cache")
+    create_elf(monkeypatch, capsys, flash_file, str(tmp_path / "out.elf"), "-cache_dir", cache_dir, "-cache_max_mb", "0")
+    assert cache_files(cache_dir) == []
+
+def test_key_follows_symbol_set(tmp_path):
+    data = b'\xe9' + b'\0' * 63
+    assert result_key("elf", data, symbols_version("esp32")) != result_key("elf", data, symbols_version(other_symbols(tmp_path)))
+    assert result_key("elf", data, symbols_version("esp32")) == result_key("elf", data, symbols_version("esp32"))
+
+def test_key_from_digest():
+    data = b'\xe9' + b'\0' * 63
+    digest = hashlib.sha256(data).hexdigest()
+    assert result_key("elf", data, "v", digest=digest) == result_key("elf", data, "v")
+    assert result_key("nvs-json", data, digest=digest) != result_key("elf", data, digest=digest)
+
+def write_kb(filename):
+    with open(filename, 'wb') as fh:
+        fh.write(b'x' * 1000)
+
+def test_lru_eviction(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1 << 20)
+    keys = ["%02x" % i * 32 for i in range(6)]
+    for n, key in enumerate(keys):
+        path = cache.store(key, write_kb)
+        # oldest first, a second apart
+        os.utime(path, (1000000 + n, 1000000 + n))
+    # a hit makes the oldest entry the most recently used
+    assert cache.lookup(keys[0]) is not None
+
+    cache.max_bytes = 3000
+    cache.evict()
+    assert sum(size for _, _, size in cache.entries()) <= cache.max_bytes
+    assert cache_entries(str(tmp_path)) == sorted([keys[0], keys[4], keys[5]])
+    # evicted entries take their warnings along
+    assert len(cache_files(str(tmp_path))) == 2 * 3
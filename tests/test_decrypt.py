@@ -0,0 +1,122 @@
+import pytest
+from conftest import encrypted_plain_image, encrypt_image, erase_partition
+
+pytest.importorskip("cryptography")
+import esp32_decrypt
+from esp32_decrypt import FlashKeys, DecryptedImage, load_flash_keys, flash_decrypt
+from esp32_extract import extract_image
+
+SCHEMES = [("esp32", 32), ("xts", 32), ("xts", 64)]
+
+@pytest.fixture(scope="module")
+def plain():
+    return encrypted_plain_image()
+
+def flash_key(length):
+    return bytes(range(7, 7 + length))
+
+# known answers from espsecure.py encrypt_flash_data [--aes_xts] --address 0x1000:
+# bytes(range(128)) encrypted with the key bytes(range(key length))
+KNOWN_ANSWERS = [
+    ("esp32", 32, bytes.fromhex(
+        "a354ea55e9d9d83cd027e80a6b03a53cfc3886d3f8090e2da27c51dbc4a61351"
+        "cdf9f00c743bd33742e28544ffad8d92783779f1e794e3744df99032250a8f5a"
+        "322c7aaf9e0967acb548e76f71193a6538bb817229be79d4f86ee23415285c6e"
+        "bfed605a0088040b4fc3e7a7b5a628d1ff72d5a6b26d3d2989435b71765035c1")),
+    ("xts", 32, bytes.fromhex(
+        "2755cc2435194803de92960f67cda56154da1a9b073f34201ae66a6aba34a2f3"
+        "1243b4916aeee963800bab27b8b3fb065a1cbcfb511d2d74a4f53ea8ae7c3949"
+        "badee84eebdd24cea450d79d10f934928cdf2f3b42741bcb0626b499313e486b"
+        "0d37284151487f30d97b49d89594d0b4383a3cf77427130103b1f16e9d9c3b29")),
+    ("xts", 64, bytes.fromhex(
+        "26c007f32a0ab24bdcdd69efac15924b876a1ef30864c76c630579bf4d777d22"
+        "11ad8f8f968e21c84f8ea86069cbaea9faaa84a9a70bb323ce2eaa500ddabdf4"
+        "250bcdaa8235260855cbbeac633387522fc2dacb6894301cd2f0a7be4f8fa905"
+        "00cb6481212bae562338855e56b3a80ad37b0b1e03d4fb670bc2e19464bb6c7c")),
+]
+
+@pytest.mark.parametrize("scheme, key_length, ciphertext", KNOWN_ANSWERS)
+def test_known_answer(scheme, key_length, ciphertext):
+    assert flash_decrypt(ciphertext, 0x1000, scheme, bytes(range(key_length))) == bytes(range(128))
+
+def test_esp32_known_answer_without_numpy(monkeypatch):
+    monkeypatch.setattr(esp32_decrypt, "numpy", None)
+    monkeypatch.setattr(esp32_decrypt, "numpy_checked", True)
+    scheme, key_length, ciphertext = KNOWN_ANSWERS[0]
+    assert flash_decrypt(ciphertext, 0x1000, scheme, bytes(range(key_length))) == bytes(range(128))
+
+@pytest.mark.parametrize("scheme, key_length", SCHEMES)
+def test_round_trip(plain, scheme, key_length):
+    image, partitions, nvs_key = plain
+    key = flash_key(key_length)
+    encrypted = encrypt_image(image, partitions, scheme, key, nvs_key)
+    assert encrypted != image
+
+    # NVS keys from the nvs_keys partition, then given explicitly
+    for keys in (FlashKeys(key), FlashKeys(key, nvs_key)):
+        decrypted = DecryptedImage(memoryview(encrypted), keys)
+        try:
+            assert decrypted.scheme == scheme
+            assert decrypted[:].tobytes() == image
+            # reads that start and end inside a data unit
+            assert decrypted[0x8003:0x8095].tobytes() == image[0x8003:0x8095]
+        finally:
+            decrypted.close()
+
+def test_esp32_without_numpy(plain, monkeypatch):
+    image, partitions, nvs_key = plain
+    key = flash_key(32)
+    encrypted = encrypt_image(image, partitions, "esp32", key, nvs_key)
+    monkeypatch.setattr(esp32_decrypt, "numpy", None)
+    monkeypatch.setattr(esp32_decrypt, "numpy_checked", True)
+    ota_0 = [p for p in partitions if p[0] == "ota_0"][0]
+    decrypted = DecryptedImage(memoryview(encrypted), FlashKeys(key, nvs_key))
+    assert decrypted[ota_0[3]:ota_0[3] + 0x1000].tobytes() == image[ota_0[3]:ota_0[3] + 0x1000]
+
+def test_erased_slot_stays_erased(plain):
+    image, partitions, nvs_key = plain
+    image = erase_partition(image, partitions, "ota_1")
+    key = flash_key(32)
+    decrypted = DecryptedImage(memoryview(encrypt_image(image, partitions, "xts", key, nvs_key)), FlashKeys(key))
+    assert decrypted[:].tobytes() == image
+
+def test_wrong_key(plain):
+    image, partitions, nvs_key = plain
+    encrypted = encrypt_image(image, partitions, "xts", flash_key(32), nvs_key)
+    with pytest.raises(ValueError):
+        DecryptedImage(memoryview(encrypted), FlashKeys(bytes(32)))
+
+def test_extract_encrypted_matches_plain(plain, tmp_path):
+    image, partitions, nvs_key = plain
+    key = flash_key(32)
+    (tmp_path / "plain.bin").write_bytes(image)
+    (tmp_path / "encrypted.bin").write_bytes(encrypt_image(image, partitions, "esp32", key, nvs_key))
+    (tmp_path / "flash_key.bin").write_bytes(key[:24])
+
+    # a 24 byte key is extended the way 3/4 coding does it
+    keys = load_flash_keys(str(tmp_path / "flash_key.bin"))
+    assert keys.flash_key == key[:24] + key[8:16]
+    keys.flash_key = key
+
+    expected = extract_image(str(tmp_path / "plain.bin"), str(tmp_path / "plain"), jobs=1)
+    result = extract_image(str(tmp_path / "encrypted.bin"), str(tmp_path / "encrypted"), jobs=1, keys=keys)
+    assert not result["errors"]
+    for want, got in zip(expected["partitions"], result["partitions"]):
+        assert got["sha256"] == want["sha256"]
+        for kind, filename in want["outputs"].items():
+            with open(filename, 'rb') as fh, open(got["outputs"][kind], 'rb') as other:
+                assert fh.read() == other.read(), kind
+
+def test_parallel_decrypt(plain, monkeypatch):
+    image, partitions, nvs_key = plain
+    key = flash_key(64)
+    encrypted = encrypt_image(image, partitions, "xts", key, nvs_key)
+    monkeypatch.setattr(esp32_decrypt, "DECRYPT_CHUNK_SIZE", 0x4000)
+    monkeypatch.setattr(esp32_decrypt, "DECRYPT_PARALLEL_MIN_BYTES", 0x8000)
+    decrypted = DecryptedImage(memoryview(encrypted), FlashKeys(key, jobs=2))
+    try:
+        ota_0 = [p for p in partitions if p[0] == "ota_0"][0]
+        assert decrypted[ota_0[3]:ota_0[3] + ota_0[4]].tobytes() == image[ota_0[3]:ota_0[3] + ota_0[4]]
+        assert decrypted.pool is not None
+    finally:
+        decrypted.close()
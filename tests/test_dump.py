@@ -0,0 +1,64 @@
+import os
+import gzip
+import json
+import lzma
+import random
+import pytest
+from esp32_firmware_reader import EXTENTS_SUFFIX, restore_dump
+
+SECTOR = 0x1000
+
+def partition_bytes():
+    # random data with erased sectors at the start, in the middle and at the end
+    rnd = random.Random(3)
+    data = bytearray(rnd.getrandbits(8 * 24 * SECTOR).to_bytes(24 * SECTOR, 'little'))
+    erased = [[0, 2 * SECTOR], [9 * SECTOR, 12 * SECTOR], [20 * SECTOR, 24 * SECTOR]]
+    for start, end in erased:
+        data[start:end] = b'\xff' * (end - start)
+    return bytes(data), erased
+
+def compress(dump_format, data):
+    if dump_format == "gzip":
+        return gzip.compress(data)
+    if dump_format == "xz":
+        return lzma.compress(data)
+    zstandard = pytest.importorskip("zstandard")
+    return zstandard.ZstdCompressor().compress(data)
+
+def write_dump(tmp_path, dump_format, data, erased, cut=0):
+    # a dump laid out by hand rather than by dump_bytes(), cut bytes short
+    filename = str(tmp_path / ("part.bin." + dump_format))
+    with open(filename, 'wb') as fh:
+        if dump_format == "sparse":
+            pos = 0
+            for start, end in erased:
+                fh.write(data[pos:start])
+                fh.seek(end)
+                pos = end
+            fh.write(data[pos:])
+            fh.truncate(len(data) - cut)
+        else:
+            stream = compress(dump_format, data)
+            fh.write(stream[:len(stream) - cut])
+    with open(filename + EXTENTS_SUFFIX, 'w') as fh:
+        json.dump({"size": len(data), "format": dump_format, "erased": erased}, fh)
+    return filename
+
+@pytest.mark.parametrize("dump_format", ["sparse", "gzip", "xz", "zstd"])
+def test_restore(tmp_path, dump_format):
+    data, erased = partition_bytes()
+    output = str(tmp_path / "restored.bin")
+    restore_dump(write_dump(tmp_path, dump_format, data, erased), output)
+    with open(output, 'rb') as fh:
+        assert fh.read() == data
+
+@pytest.mark.parametrize("dump_format", ["sparse", "gzip", "xz", "zstd"])
+def test_restore_truncated(tmp_path, dump_format):
+    data, erased = partition_bytes()
+    # sparse: lose the last data sector, which sits before the trailing hole
+    erased = erased[:-1] if dump_format == "sparse" else erased
+    filename = write_dump(tmp_path, dump_format, data, erased, cut=SECTOR * 5 if dump_format == "sparse" else 64)
+    output = str(tmp_path / "restored.bin")
+    with pytest.raises(ValueError):
+        restore_dump(filename, output)
+    assert not os.path.exists(output)
@@ -0,0 +1,122 @@
+import os
+from conftest import make_image, erase_partition
+from esp32_extract import extract_image, partition_summary, image_failed, load_manifest
+
+def test_extract_image(tmp_path, flash_file):
+    result = extract_image(flash_file, str(tmp_path / "out"), jobs=1)
+    assert not image_failed(result)
+    parts = {p["label"]: p for p in result["partitions"]}
+    assert set(parts["ota_0"]["outputs"]) == {"elf"}
+    assert set(parts["nvs"]["outputs"]) == {"nvs"}
+    assert set(parts["phy_init"]["outputs"]) == {"raw"}
+    for part in parts.values():
+        for filename in part["outputs"].values():
+            assert os.path.isfile(filename)
+
+def test_erased_ota_slot_is_empty(tmp_path):
+    image, partitions = make_image()
+    path = tmp_path / "flash.bin"
+    path.write_bytes(erase_partition(image, partitions, "ota_1"))
+
+    result = extract_image(str(path), str(tmp_path / "out"), jobs=1)
+    assert not image_failed(result)
+    ota_1 = [p for p in result["partitions"] if p["label"] == "ota_1"][0]
+    assert ota_1["empty"] is True
+    assert ota_1["outputs"] == {}
+    assert partition_summary(ota_1) == "empty"
+    assert not os.path.exists(tmp_path / "out" / "ota_1.elf")
+    ota_0 = [p for p in result["partitions"] if p["label"] == "ota_0"][0]
+    assert "empty" not in ota_0
+
+def test_elf_warnings_go_to_the_manifest(tmp_path, capsys):
+    image, partitions = make_image()
+    image = bytearray(image)
+    ota_0 = [p for p in partitions if p[0] == "ota_0"][0]
+    # a byte of segment data, past the image and segment headers
+    image[ota_0[3] + 0x100] ^= 0xFF
+    path = tmp_path / "flash.bin"
+    path.write_bytes(bytes(image))
+
+    result = extract_image(str(path), str(tmp_path / "out"), jobs=2)
+    assert capsys.readouterr().out == ""
+    parts = {p["label"]: p for p in result["partitions"]}
+    assert parts["ota_0"]["warnings"] == ["app image checksum mismatch", "app image SHA-256 mismatch"]
+    assert parts["ota_1"]["warnings"] == []
+    assert "checksum mismatch" in partition_summary(parts["ota_0"])
+
+def rewrite_nvs_page(image, partitions, page_num):
+    # the image with one NVS page replaced, its namespace definition kept
+    import struct
+    import synthetic
+    offset = [p for p in partitions if p[0] == "nvs"][0][3] + page_num * 0x1000
+    page = synthetic.nvs_page(page_num, [synthetic.nvs_entry(0, 0x01, 1, 0xff, "ns%d" % page_num, bytes([page_num + 1])),
+                                         synthetic.nvs_entry(page_num + 1, 0x04, 1, 0xff, "k1", struct.pack("<I", 5))])
+    image = bytearray(image)
+    image[offset:offset + len(page)] = page
+    return bytes(image), offset
+
+def test_previous_run(tmp_path, capsys):
+    import json
+    from esp32_extract import extract_all
+    from read_nvs import write_nvs_json_file
+    image, partitions = make_image()
+    (tmp_path / "old.bin").write_bytes(image)
+    extract_all(str(tmp_path / "old.bin"), str(tmp_path / "old"), jobs=1)
+
+    image, page_offset = rewrite_nvs_page(image, partitions, 1)
+    (tmp_path / "new.bin").write_bytes(image)
+    result = extract_image(str(tmp_path / "new.bin"), str(tmp_path / "new"), jobs=1,
+                           previous=load_manifest(str(tmp_path / "old" / "manifest.json")))
+    assert not image_failed(result)
+    parts = {p["label"]: p for p in result["partitions"]}
+
+    for label in ("otadata", "phy_init", "ota_0", "ota_1"):
+        assert parts[label]["status"] == "unchanged"
+        assert parts[label]["changed_regions"] == []
+    assert parts["ota_0"]["carried"] == ["elf"]
+    assert parts["phy_init"]["carried"] == ["raw"]
+    with open(str(tmp_path / "old" / "ota_0.elf"), 'rb') as old, open(parts["ota_0"]["outputs"]["elf"], 'rb') as new:
+        assert old.read() == new.read()
+
+    nvs = parts["nvs"]
+    assert nvs["status"] == "changed"
+    assert nvs["carried"] == []
+    assert nvs["nvs_pages_decoded"] == 1
+    assert nvs["changed_regions"] == [[page_offset, page_offset + 0x1000]]
+    assert result["changed_regions"] == [[page_offset, page_offset + 0x1000]]
+    # the updated document matches decoding the new partition from scratch
+    nvs_part = [p for p in partitions if p[0] == "nvs"][0]
+    write_nvs_json_file(image[nvs_part[3]:nvs_part[3] + nvs_part[4]], str(tmp_path / "fresh.json"))
+    with open(nvs["outputs"]["nvs"]) as updated, open(str(tmp_path / "fresh.json")) as fresh:
+        assert json.load(updated) == json.load(fresh)
+
+def test_previous_run_with_other_symbols(tmp_path):
+    from test_cache import other_symbols
+    image, partitions = make_image()
+    (tmp_path / "flash.bin").write_bytes(image)
+    old = extract_image(str(tmp_path / "flash.bin"), str(tmp_path / "old"), jobs=1)
+    result = extract_image(str(tmp_path / "flash.bin"), str(tmp_path / "new"), jobs=1,
+                           symbols=other_symbols(tmp_path), previous=old)
+    ota_0 = [p for p in result["partitions"] if p["label"] == "ota_0"][0]
+    assert ota_0["status"] == "unchanged"
+    assert ota_0["carried"] == []
+    with open(str(tmp_path / "old" / "ota_0.elf"), 'rb') as before, open(ota_0["outputs"]["elf"], 'rb') as after:
+        assert before.read() != after.read()
+    # what doesn't depend on the symbols still carries
+    assert [p for p in result["partitions"] if p["label"] == "nvs"][0]["carried"] == ["nvs"]
+
+def test_previous_run_of_older_tool_version(tmp_path):
+    image, partitions = make_image()
+    (tmp_path / "old.bin").write_bytes(image)
+    old = extract_image(str(tmp_path / "old.bin"), str(tmp_path / "old"), jobs=1)
+    for part in old["partitions"]:
+        part["tool_version"] = "1"
+    image, _ = rewrite_nvs_page(image, partitions, 1)
+    (tmp_path / "new.bin").write_bytes(image)
+    result = extract_image(str(tmp_path / "new.bin"), str(tmp_path / "new"), jobs=1, previous=old)
+    parts = {p["label"]: p for p in result["partitions"]}
+    assert parts["ota_0"]["carried"] == []
+    # the NVS document is decoded from scratch, not patched
+    assert parts["nvs"]["status"] == "changed"
+    assert "nvs_pages_decoded" not in parts["nvs"]
+    assert parts["phy_init"]["carried"] == ["raw"]
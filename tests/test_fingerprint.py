@@ -0,0 +1,63 @@
+import itertools
+import synthetic
+from esp32_fingerprint import fingerprint_app, cluster_apps, similarity
+
+APP_SIZE = 48 << 10
+
+def app(seed, patch=None):
+    # a synthetic app image; patch = (segment, offset) flips one byte of it
+    segments = synthetic.app_segments(APP_SIZE, seed=seed)
+    if patch is not None:
+        segment, offset = patch
+        addr, data = segments[segment]
+        data = bytearray(data)
+        data[offset] ^= 0xff
+        segments[segment] = (addr, bytes(data))
+    return synthetic.app_image(segments)
+
+def clusters(apps):
+    return sorted(sorted(cluster) for cluster in cluster_apps(apps))
+
+def test_one_byte_rebuild_clusters_with_original():
+    apps = [fingerprint_app(app(1)), fingerprint_app(app(1, (0, 100))), fingerprint_app(app(2))]
+    assert apps[0]["app_sha256"] != apps[1]["app_sha256"]
+    assert apps[0]["checksum_ok"] and apps[1]["sha256_ok"]
+    assert clusters(apps) == [[0, 1], [2]]
+
+def test_clusters_do_not_depend_on_order():
+    apps = [fingerprint_app(data) for data in (app(1), app(1, (0, 100)), app(1, (4, 7)), app(2), app(2, (1, 3)))]
+    expected = [[0, 1, 2], [3, 4]]
+    for order in itertools.permutations(range(len(apps))):
+        found = clusters([apps[i] for i in order])
+        assert sorted(sorted(order[i] for i in cluster) for cluster in found) == expected
+
+def near_duplicates(count, seed):
+    # count fingerprints of one build, each with a different bin changed
+    import random
+    from esp32_fingerprint import SKETCH_BINS
+    rnd = random.Random(seed)
+    base = [rnd.getrandbits(64) for _ in range(SKETCH_BINS)]
+    apps = []
+    for n in range(count):
+        sketch = list(base)
+        sketch[n % SKETCH_BINS] = rnd.getrandbits(64)
+        apps.append({"app_sha256": "%d-%d" % (seed, n), "sketch": sketch})
+    # plus exact copies of the first one
+    return apps + [dict(apps[0]) for _ in range(count)]
+
+def comparisons(monkeypatch, apps):
+    import esp32_fingerprint
+    calls = []
+    monkeypatch.setattr(esp32_fingerprint, "similarity", lambda a, b: calls.append(1) or similarity(a, b))
+    found = cluster_apps(apps)
+    return found, len(calls)
+
+def test_duplicates_scale_linearly(monkeypatch):
+    results = []
+    for count in (250, 1000):
+        apps = near_duplicates(count, 1) + near_duplicates(count, 2)
+        found, calls = comparisons(monkeypatch, apps)
+        assert sorted(len(cluster) for cluster in found) == [2 * count, 2 * count]
+        results.append(calls)
+    # four times the apps, not sixteen times the comparisons
+    assert results[1] <= 5 * results[0]
@@ -0,0 +1,33 @@
+import struct
+import synthetic
+from conftest import make_image
+from esp32_index import build_index, query_index, print_query
+
+def nvs_image(tmp_path):
+    # a dump whose NVS partition starts with a page of 64-bit keys
+    image, partitions = make_image()
+    page = synthetic.nvs_page(0, [synthetic.nvs_entry(0, 0x01, 1, 0xff, "stats", b'\x01'),
+                                  synthetic.nvs_entry(1, 0x08, 1, 0xff, "boot_count", struct.pack("<Q", 12345)),
+                                  synthetic.nvs_entry(1, 0x18, 1, 0xff, "drift", struct.pack("<q", -5))])
+    offset = [p for p in partitions if p[0] == "nvs"][0][3]
+    image = bytearray(image)
+    image[offset:offset + len(page)] = page
+    (tmp_path / "images").mkdir()
+    (tmp_path / "images" / "flash.bin").write_bytes(image)
+    return str(tmp_path / "images")
+
+def test_64_bit_keys(tmp_path, capsys):
+    db = str(tmp_path / "index.db")
+    build_index(nvs_image(tmp_path), db, jobs=1)
+
+    rows = query_index(db, key="boot_count")
+    assert [(row[2], row[4], row[5]) for row in rows] == [("stats", "U64", "12345")]
+    print_query(rows)
+    assert "\t12345\t" in capsys.readouterr().out
+
+    assert [row[3] for row in query_index(db, value="12345")] == ["boot_count"]
+    assert [row[3] for row in query_index(db, namespace="stats", value="-5")] == ["drift"]
+
+def test_print_query_without_value_or_size(capsys):
+    print_query([("flash.bin", "nvs", "stats", "raw", "ANY", None, None, 0)])
+    assert "<ANY value>" in capsys.readouterr().out
@@ -0,0 +1,139 @@
+import io
+import sys
+import json
+import struct
+import pytest
+import synthetic
+from read_nvs import parse_nvs_pages, parse_nvs_values, verify_nvs_page, write_nvs_json, write_nvs_ndjson, NVS_PAGE_SIZE
+
+def ns_entry(name, index):
+    return synthetic.nvs_entry(0, 0x01, 1, 0xff, name, bytes([index]))
+
+def u32_entry(key, value, ns=1):
+    return synthetic.nvs_entry(ns, 0x04, 1, 0xff, key, struct.pack("<I", value))
+
+def values(data):
+    return {(v["namespace"], v["key"]): v for v in parse_nvs_values(data)}
+
+def test_later_write_wins():
+    # the pages are out of order on flash; sequence numbers decide
+    data = synthetic.nvs_page(5, [u32_entry("boot", 2)]) + synthetic.nvs_page(4, [ns_entry("cfg", 1), u32_entry("boot", 1)])
+    result = values(data)
+    assert result[("cfg", "boot")]["value"] == 2
+    assert result[("cfg", "boot")]["page_seq_no"] == 5
+
+def test_corrupt_newer_write_loses_to_older_valid_value():
+    newer = bytearray(synthetic.nvs_page(1, [u32_entry("boot", 2)]))
+    # flip a value byte of the newer entry, leaving its CRC32 stale
+    newer[64 + 24] ^= 0xFF
+    data = synthetic.nvs_page(0, [ns_entry("cfg", 1), u32_entry("boot", 1)]) + bytes(newer)
+    assert verify_nvs_page(data[NVS_PAGE_SIZE:])[1] == [0]
+    assert values(data)[("cfg", "boot")]["value"] == 1
+
+def test_blob_chunks_across_pages():
+    first, second = b"a" * 40, b"b" * 20
+    idx = synthetic.nvs_entry(1, 0x48, 1, 0xff, "blob", struct.pack("<IBBH", 60, 2, 0, 0xffff))
+    data = (synthetic.nvs_page(0, [ns_entry("cfg", 1)] + synthetic.nvs_span(1, 0x42, 0, "blob", first))
+            + synthetic.nvs_page(1, synthetic.nvs_span(1, 0x42, 1, "blob", second) + [idx]))
+    blob = values(data)[("cfg", "blob")]
+    assert blob["complete"] is True
+    assert blob["value"] == first + second
+
+def test_corrupt_blob_chunk_is_not_merged():
+    idx = synthetic.nvs_entry(1, 0x48, 1, 0xff, "blob", struct.pack("<IBBH", 8, 1, 0, 0xffff))
+    page = bytearray(synthetic.nvs_page(0, [ns_entry("cfg", 1)] + synthetic.nvs_span(1, 0x42, 0, "blob", b"12345678") + [idx]))
+    # the chunk's payload entry, so its data CRC fails
+    page[64 + 2 * 32] ^= 0xFF
+    blob = values(bytes(page))[("cfg", "blob")]
+    assert blob["complete"] is False
+    assert blob["value"] == b""
+
+def test_parallel_decode_matches(monkeypatch):
+    import read_nvs
+    monkeypatch.setattr(read_nvs, "NVS_PARALLEL_MIN_PAGES", 2)
+    monkeypatch.setattr(read_nvs, "NVS_DECODE_BATCH", 2)
+    data = synthetic.nvs_partition(5)
+    assert parse_nvs_values(data, jobs=2) == parse_nvs_values(data)
+
+def idf_bitmap(entry_count):
+    # entry state bitmap as nvs_partition_gen.py writes it: marking entry n
+    # written clears bit n * 2 (Empty 0b11 -> Written 0b10)
+    bitmap = bytearray(b'\xff' * 32)
+    for entry_num in range(entry_count):
+        bitnum = entry_num * 2
+        bitmap[bitnum // 8] &= ~(1 << (bitnum & 7)) & 0xff
+    return bytes(bitmap)
+
+def idf_page(seq_no, entries):
+    # header and entries from synthetic, the bitmap built independently of it
+    page = synthetic.nvs_page(seq_no, entries)
+    return page[:32] + idf_bitmap(len(entries)) + page[64:]
+
+def test_idf_bitmap():
+    page = idf_page(0, [ns_entry("cfg", 1), u32_entry("boot", 7), u32_entry("mode", 3)])
+    assert page[32] == 0xea
+    assert parse_nvs_pages(page)[0].entry_state_bitmap[:5] == "22233"
+    result = values(page)
+    assert result[("cfg", "boot")]["value"] == 7
+    assert result[("cfg", "mode")]["value"] == 3
+
+def test_numpy_bitmap_decode_matches(monkeypatch):
+    pytest.importorskip("numpy")
+    import read_nvs
+    read_nvs.load_numpy()
+    data = memoryview(idf_page(0, [ns_entry("cfg", 1)] + [u32_entry("k%d" % i, i) for i in range(6)]) + idf_page(1, [ns_entry("net", 2)]))
+    pages = read_nvs.decode_nvs_pages_numpy(data, 2)
+    # the struct path
+    monkeypatch.setattr(read_nvs, "numpy", None)
+    monkeypatch.setattr(read_nvs, "numpy_checked", True)
+    assert pages == read_nvs.decode_nvs_pages(data)
+    assert pages[0][4][:8] == "22222223"
+
+def test_hex_lines():
+    from read_nvs import hex_lines
+    assert list(hex_lines(bytes(range(0x5e, 0x5e + 20)))) == [
+        "00000000: 5E 5F 60 61 62 63 64 65  66 67 68 69 6A 6B 6C 6D  ^_`abcdefghijklm",
+        "00000010: 6E 6F 70 71" + " " * 39 + "nopq",
+    ]
+
+def mixed_partition():
+    # full pages, a page with two entries and an erased one
+    data = synthetic.nvs_partition(3, seed=4)
+    data += synthetic.nvs_page(3, [ns_entry("late", 9), u32_entry("boot", 7, ns=9)])
+    return data + b'\xff' * NVS_PAGE_SIZE
+
+def test_ndjson_matches_json():
+    data = mixed_partition()
+    out = io.StringIO()
+    write_nvs_json(memoryview(data), out)
+    pages = json.loads(out.getvalue())
+    expected = [dict({"page_index": i, "page_state": page["page_state"], "page_seq_no": page["page_seq_no"]}, **entry)
+                for i, page in enumerate(pages) for entry in page["entries"]]
+
+    out = io.StringIO()
+    write_nvs_ndjson(memoryview(data), out)
+    lines = out.getvalue().split("\n")
+    assert lines[-1] == ""
+    records = [json.loads(line) for line in lines[:-1]]
+    assert all(isinstance(record, dict) for record in records)
+    assert records == expected
+    assert len(records) > 3 * 10
+    assert records[-1]["page_index"] == 3 and records[-1]["entry_key"] == "boot"
+    assert {record["entry_data_type"] for record in records} >= {"U32", "STR", "BLOB_DATA", "BLOB_IDX"}
+
+def test_dump_nvs_ndjson(tmp_path, monkeypatch, capsys):
+    import esp32_image_parser
+    from conftest import make_image
+    image, partitions = make_image()
+    path = tmp_path / "flash.bin"
+    path.write_bytes(image)
+    nvs = [p for p in partitions if p[0] == "nvs"][0]
+    monkeypatch.setattr(sys, "argv", ["esp32_image_parser.py", "dump_nvs", str(path), "-partition", "nvs", "-nvs_output_type", "ndjson"])
+    esp32_image_parser.main()
+    lines = capsys.readouterr().out.splitlines()
+
+    out = io.StringIO()
+    write_nvs_ndjson(memoryview(image)[nvs[3]:nvs[3] + nvs[4]], out)
+    # nothing but the records on stdout
+    assert lines == out.getvalue().splitlines()
+    assert all(isinstance(json.loads(line), dict) for line in lines)
@@ -0,0 +1,103 @@
+import os
+import synthetic
+from conftest import make_image
+from esp32_firmware_reader import read_partition_table
+from esp32_extract import extract_image, image_failed, output_names
+
+TABLE = synthetic.PARTITION_TABLE_OFFSET
+
+def with_table(image, partitions):
+    # the image with its partition table rewritten to partitions
+    image = bytearray(image)
+    image[TABLE:TABLE + 0xC00] = synthetic.partition_table(partitions)
+    return bytes(image)
+
+def relabel(partitions, old, new):
+    return [(new if part[0] == old else part[0],) + tuple(part[1:]) for part in partitions]
+
+def test_md5_ok(capsys):
+    image, partitions = make_image()
+    table = read_partition_table(memoryview(image), verbose=True)
+    assert table.md5_ok is True
+    assert " (OK)" in capsys.readouterr().out
+    assert [part["label"] for part in table.values()] == [part[0] for part in partitions]
+
+def test_md5_mismatch(capsys):
+    image, partitions = make_image()
+    image = bytearray(image)
+    # the size of the first entry, covered by the MD5 entry after the last one
+    image[TABLE + 12] ^= 0x01
+    table = read_partition_table(memoryview(bytes(image)), verbose=True)
+    assert table.md5_ok is False
+    assert " (MISMATCH)" in capsys.readouterr().out
+    assert len(table) == len(partitions)
+
+def test_no_md5():
+    image, partitions = make_image()
+    image = bytearray(image)
+    md5_entry = TABLE + 32 * len(partitions)
+    image[md5_entry:md5_entry + 32] = b'\xff' * 32
+    table = read_partition_table(memoryview(bytes(image)))
+    assert table.md5 is None and table.md5_ok is None
+
+def test_duplicate_labels():
+    image, partitions = make_image()
+    partitions = relabel(partitions, "ota_1", "ota_0")
+    table = read_partition_table(memoryview(with_table(image, partitions)))
+    assert table.md5_ok is True
+    ota = [part for part in partitions if part[0] == "ota_0"]
+    # the first one wins, as in the bootloader; find() has both
+    assert table["ota_0"]["offset"] == ota[0][3]
+    assert table.get("ota_0")["offset"] == ota[0][3]
+    assert [part["offset"] for part in table.find(label="ota_0")] == [part[3] for part in ota]
+    assert [part["offset"] for part in table.find(type=0)] == [part[3] for part in ota]
+    assert table.duplicate_labels() == ["ota_0"]
+    assert len(table) == len(partitions)
+    assert "ota_1" not in table
+    assert output_names(table) == ["nvs", "otadata", "phy_init", "ota_0", "ota_0_1"]
+
+def test_extract_duplicate_labels(tmp_path):
+    image, partitions = make_image()
+    path = tmp_path / "flash.bin"
+    path.write_bytes(with_table(image, relabel(partitions, "ota_1", "ota_0")))
+    out = tmp_path / "out"
+    result = extract_image(str(path), str(out), jobs=1)
+    assert not image_failed(result)
+    assert [part["label"] for part in result["partitions"]].count("ota_0") == 2
+    assert os.path.isfile(out / "ota_0.elf")
+    assert os.path.isfile(out / "ota_0_1.elf")
+
+def test_at_and_overlapping():
+    image, partitions = make_image()
+    # a partition overlapping the end of otadata, all of phy_init and past it
+    otadata = [part for part in partitions if part[0] == "otadata"][0]
+    partitions = partitions + [("overlap", 1, 0x99, otadata[3] + 0x1000, 0x2800)]
+    table = read_partition_table(memoryview(with_table(image, partitions)))
+    by_label = {part[0]: part for part in partitions}
+    assert table.starts == sorted(part[3] for part in partitions)
+
+    nvs = by_label["nvs"]
+    assert table.at(nvs[3])["label"] == "nvs"
+    assert table.at(nvs[3] + nvs[4] - 1)["label"] == "nvs"
+    assert table.at(0) is None
+    assert table.at(TABLE) is None
+    # past the end of every partition
+    ota_1 = by_label["ota_1"]
+    assert table.at(ota_1[3] + ota_1[4]) is None
+    # where two partitions overlap, the one starting nearest below wins
+    assert table.at(otadata[3])["label"] == "otadata"
+    assert table.at(otadata[3] + 0x1000)["label"] == "overlap"
+    # past phy_init, the partition starting before it still holds the offset
+    phy_init = by_label["phy_init"]
+    assert table.at(phy_init[3] + phy_init[4])["label"] == "overlap"
+    # the rest of the gap before the 64 KB aligned app slots
+    assert table.at(by_label["overlap"][3] + 0x2800) is None
+
+    def labels(offset, size):
+        return sorted(part["label"] for part in table.overlapping(offset, size))
+    assert labels(otadata[3] + 0x1000, 0x1000) == ["otadata", "overlap"]
+    assert labels(otadata[3] + 0x1800, 0x1000) == ["otadata", "overlap", "phy_init"]
+    assert labels(nvs[3] - 0x1000, 0x1000) == []
+    assert labels(nvs[3] - 0x1000, 0x1001) == ["nvs"]
+    assert labels(ota_1[3] + ota_1[4], 0x1000) == []
+    assert labels(0, 1 << 24) == sorted(by_label)
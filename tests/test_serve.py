@@ -0,0 +1,112 @@
+import json
+import asyncio
+import pytest
+from esp32_serve import ParserService, RequestError
+
+def dispatch(service, target, body=b''):
+    from urllib.parse import urlsplit, parse_qs
+    url = urlsplit(target)
+    query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+    return asyncio.run(service.dispatch("GET", url.path, query, body))
+
+def test_partitions(flash_file):
+    status, content_type, body = dispatch(ParserService(jobs=1), "/partitions?path=" + flash_file)
+    assert status == 200
+    labels = [part["label"] for part in json.loads(body)["partitions"]]
+    assert labels == ["nvs", "otadata", "phy_init", "ota_0", "ota_1"]
+
+@pytest.mark.parametrize("symbols", ["/etc/passwd", "../symbols_dump", "no_such_set"])
+def test_elf_rejects_unknown_symbol_sets(flash_file, symbols):
+    with pytest.raises(RequestError) as e:
+        dispatch(ParserService(jobs=1), "/elf?partition=ota_0&symbols=%s&path=%s" % (symbols, flash_file))
+    assert e.value.status == 400
+
+def test_elf(flash_file, monkeypatch):
+    import esp32_serve
+    service = ParserService(jobs=1)
+    service.start()
+    # symbol sets are hashed once, at startup
+    monkeypatch.setattr(esp32_serve, "symbols_version", None)
+    try:
+        status, _, body = dispatch(service, "/elf?partition=ota_0&symbols=esp32&path=" + flash_file)
+        assert dispatch(service, "/elf?partition=ota_0&path=" + flash_file)[2] == body
+    finally:
+        service.close()
+    assert status == 200
+    assert body[:4] == b'\x7fELF'
+
+def test_unknown_endpoint():
+    # 404 whether or not the request names an image
+    with pytest.raises(RequestError) as e:
+        dispatch(ParserService(jobs=1), "/nope")
+    assert e.value.status == 404
+
+def read_request(data):
+    from esp32_serve import read_request
+
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await read_request(reader, 1024)
+    return asyncio.run(run())
+
+def test_read_request():
+    method, path, query, headers, body = read_request(b"POST /nvs?partition=nvs HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc")
+    assert (method, path, query, body) == ("POST", "/nvs", {"partition": "nvs"}, b"abc")
+
+@pytest.mark.parametrize("length, status", [("abc", 400), ("-1", 400), ("4096", 413)])
+def test_read_request_rejects_content_length(length, status):
+    with pytest.raises(RequestError) as e:
+        read_request(b"POST /nvs HTTP/1.1\r\nContent-Length: " + length.encode() + b"\r\n\r\n")
+    assert e.value.status == status
+
+def test_malformed_request_closes_connection():
+    service = ParserService(jobs=1)
+
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"POST /nvs HTTP/1.1\r\nContent-Length: x\r\n\r\n")
+        writer = FakeWriter()
+        await service.handle(reader, writer)
+        return writer
+    writer = asyncio.run(run())
+    assert writer.closed
+    assert writer.data.startswith(b"HTTP/1.1 400 ")
+    assert b"Connection: close" in writer.data
+
+class FakeWriter(object):
+    def __init__(self):
+        self.data = b''
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+@pytest.mark.parametrize("host, ok", [("127.0.0.1", True), ("localhost", True), ("::1", True), ("0.0.0.0", False), ("8.8.8.8", False)])
+def test_is_loopback(host, ok):
+    from esp32_serve import is_loopback
+    assert is_loopback(host) is ok
+
+def test_uploaded_image_is_decrypted_and_closed(monkeypatch):
+    pytest.importorskip("cryptography")
+    from conftest import encrypted_plain_image, encrypt_image
+    from esp32_decrypt import FlashKeys, DecryptedImage
+    plain, partitions, nvs_key = encrypted_plain_image()
+    key = bytes(range(32))
+    closed = []
+    close = DecryptedImage.close
+    monkeypatch.setattr(DecryptedImage, "close", lambda self: closed.append(self) or close(self))
+
+    service = ParserService(jobs=1, keys=FlashKeys(key))
+    _, _, body = dispatch(service, "/partitions", encrypt_image(plain, partitions, "xts", key, nvs_key))
+    assert [part["label"] for part in json.loads(body)["partitions"]][-1] == "nvs_keys"
+    _, _, body = dispatch(service, "/nvs?partition=nvs", encrypt_image(plain, partitions, "xts", key, nvs_key))
+    assert body == dispatch(ParserService(jobs=1), "/nvs?partition=nvs", plain)[2]
+    assert len(closed) == 2
@@ -0,0 +1,184 @@
+import io
+import gzip
+import lzma
+import zlib
+import random
+import struct
+import tarfile
+import zipfile
+import pytest
+
+import esp32_sources
+from esp32_sources import DeflateImage, XzImage, xz_blocks, split_source, list_source_members
+from esp32_firmware_reader import flash_image
+
+# small blocks, so a few hundred KB of test data spans many of them
+BLOCK = 0x1000
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(esp32_sources, "SOURCE_BLOCK_SIZE", BLOCK)
+    monkeypatch.setattr(esp32_sources, "SOURCE_READ_SIZE", 0x400)
+
+def image_bytes(seed, size=0x30000):
+    # random runs between erased stretches, compressible like a real dump
+    rnd = random.Random(seed)
+    data = bytearray(b'\xff' * size)
+    for _ in range(40):
+        start = rnd.randrange(size)
+        length = min(rnd.randrange(0x2000), size - start)
+        data[start:start + length] = rnd.getrandbits(8 * length).to_bytes(length, 'little')
+    return bytes(data)
+
+def check_reads(image, plain, seed=0):
+    # random slices, some across block boundaries and past the end, in no particular order
+    rnd = random.Random(seed)
+    assert len(image) == len(plain)
+    for _ in range(200):
+        start = rnd.randrange(len(plain))
+        stop = start + rnd.choice([1, 32, BLOCK - 1, BLOCK + 1, 3 * BLOCK, len(plain)])
+        assert bytes(image[start:stop]) == plain[start:stop]
+    assert image[len(plain) - 1] == plain[-1]
+    assert bytes(image[-BLOCK:]) == plain[-BLOCK:]
+    assert bytes(image[len(plain):len(plain) + 10]) == b''
+
+def xz_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def xz_multiblock(pieces):
+    """One .xz stream with a block per piece, the way xz -T0 writes them;
+    lzma.compress() only ever writes a single block."""
+    streams = [lzma.compress(piece) for piece in pieces]
+    header = streams[0][:12]
+    flags = header[6:8]
+    blocks = []
+    records = b''
+    for stream in streams:
+        (offset, unpadded, _, size), = xz_blocks(stream)
+        blocks.append(stream[offset:offset + ((unpadded + 3) & ~3)])
+        records += xz_varint(unpadded) + xz_varint(size)
+    index = b'\0' + xz_varint(len(pieces)) + records
+    index += b'\0' * (-len(index) % 4)
+    index += struct.pack("<I", zlib.crc32(index))
+    backward = struct.pack("<I", len(index) // 4 - 1) + flags
+    footer = struct.pack("<I", zlib.crc32(backward)) + backward + b'YZ'
+    return header + b''.join(blocks) + index + footer
+
+def pieces(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def test_gzip():
+    plain = image_bytes(1)
+    image = DeflateImage(memoryview(gzip.compress(plain)), cache_bytes=2 * BLOCK)
+    check_reads(image, plain)
+    assert len(image.checkpoints) > 10
+
+def test_gzip_members():
+    plain = image_bytes(2)
+    data = b''.join(gzip.compress(piece) for piece in pieces(plain, 0x7001))
+    check_reads(DeflateImage(memoryview(data), cache_bytes=2 * BLOCK), plain)
+
+def test_gzip_size_first():
+    plain = image_bytes(3)
+    image = DeflateImage(memoryview(gzip.compress(plain)))
+    assert image.size() == len(plain)
+    check_reads(image, plain)
+
+def test_xz_blocks():
+    plain = image_bytes(4)
+    data = xz_multiblock(pieces(plain, 0x5000))
+    assert lzma.decompress(data) == plain
+    blocks = xz_blocks(data)
+    assert len(blocks) == 10
+    assert [block[2] for block in blocks] == list(range(0, len(plain), 0x5000))
+    assert sum(block[3] for block in blocks) == len(plain)
+    image = XzImage(memoryview(data), cache_bytes=2 * 0x5000)
+    check_reads(image, plain)
+
+def test_xz_single_block():
+    plain = image_bytes(5)
+    image = XzImage(memoryview(lzma.compress(plain)))
+    assert len(image.index) == 1
+    check_reads(image, plain)
+
+def test_xz_concatenated_streams():
+    plain = image_bytes(6)
+    image = XzImage(memoryview(b''.join(lzma.compress(piece) for piece in pieces(plain, 0x10000))))
+    assert image.index is None
+    check_reads(image, plain)
+
+def tarball(files):
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w') as archive:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return out.getvalue()
+
+def zipped(files):
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w') as archive:
+        for name, data, compress_type in files:
+            archive.writestr(name, data, compress_type)
+    return out.getvalue()
+
+@pytest.mark.parametrize("suffix", [".tar.gz", ".tar.xz"])
+def test_tar_member(tmp_path, suffix):
+    plain = image_bytes(7)
+    data = tarball([("README", b"notes"), ("flash.bin", plain)])
+    if suffix == ".tar.gz":
+        data = gzip.compress(data)
+    else:
+        data = xz_multiblock(pieces(data, 0x8000))
+    path = tmp_path / ("dump" + suffix)
+    path.write_bytes(data)
+    # the only .bin member is picked without being named
+    for spec in (str(path), str(path) + ":flash.bin"):
+        with flash_image(spec) as image:
+            check_reads(image, plain)
+
+@pytest.mark.parametrize("compress_type", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_zip_member(tmp_path, compress_type):
+    plain = image_bytes(8)
+    path = tmp_path / "dump.zip"
+    path.write_bytes(zipped([("flash.bin", plain, compress_type)]))
+    with flash_image(str(path) + ":flash.bin") as image:
+        if compress_type == zipfile.ZIP_DEFLATED:
+            assert isinstance(image, DeflateImage)
+        check_reads(image, plain)
+
+def test_archive_of_images(tmp_path):
+    images = [("a/flash.bin", image_bytes(9), zipfile.ZIP_DEFLATED),
+              ("b/flash.bin", image_bytes(10), zipfile.ZIP_STORED),
+              ("c/flash.bin", image_bytes(11), zipfile.ZIP_DEFLATED)]
+    path = str(tmp_path / "dumps.zip")
+    with open(path, 'wb') as fh:
+        fh.write(zipped(images))
+    assert list_source_members(path) == [path + ":" + name for name, _, _ in images]
+    for name, plain, _ in images:
+        with flash_image(path + ":" + name) as image:
+            check_reads(image, plain)
+    with pytest.raises(ValueError, match="holds 3 images"):
+        with flash_image(path):
+            pass
+    with pytest.raises(FileNotFoundError):
+        with flash_image(path + ":d/flash.bin"):
+            pass
+
+def test_split_source(tmp_path):
+    archive = tmp_path / "dumps.tar"
+    archive.write_bytes(tarball([("flash.bin", b"\xff")]))
+    assert split_source(str(archive)) == (str(archive), None)
+    assert split_source(str(archive) + ":flash.bin") == (str(archive), "flash.bin")
+    # a colon in a file name that exists, or with no file before it, is no member
+    odd = tmp_path / "flash:1.bin"
+    odd.write_bytes(b"\xff")
+    assert split_source(str(odd)) == (str(odd), None)
+    missing = str(tmp_path / "missing.tar") + ":flash.bin"
+    assert split_source(missing) == (missing, None)
@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import pstats
+import pytest
+import esp32_timings
+from conftest import make_image
+
+# the action itself, and what it is made of
+ELF_PHASES = {"create_elf", "read_partition_table", "image2elf", "read_app_image", "merge_segments", "add_elf_symbols", "layout_elf", "write_elf"}
+
+@pytest.fixture(autouse=True)
+def timings_off(monkeypatch):
+    # -timings switches recording on for the whole process; leave it as found
+    monkeypatch.setattr(esp32_timings, "enabled", False)
+    monkeypatch.setattr(esp32_timings, "events", [])
+
+def run(monkeypatch, capsys, *argv):
+    import esp32_image_parser
+    monkeypatch.setattr(sys, "argv", ["esp32_image_parser.py"] + list(argv))
+    esp32_image_parser.main()
+    return capsys.readouterr().out
+
+def test_create_elf_phases(tmp_path, monkeypatch, capsys, flash_file):
+    report_file = str(tmp_path / "timings.json")
+    elf_file = str(tmp_path / "ota_0.elf")
+    run(monkeypatch, capsys, "create_elf", flash_file, "-partition", "ota_0", "-output", elf_file, "-timings", report_file)
+    with open(report_file) as fh:
+        report = json.load(fh)
+
+    phases = {event["name"]: event for event in report["phases"]}
+    assert set(phases) == ELF_PHASES
+    assert set(report["summary"]) == ELF_PHASES
+    for name in ("read_app_image", "merge_segments", "add_elf_symbols", "layout_elf", "write_elf"):
+        assert phases[name]["parent"] == "image2elf"
+    assert phases["image2elf"]["parent"] == phases["read_partition_table"]["parent"] == "create_elf"
+    assert phases["create_elf"]["parent"] is None
+    assert phases["write_elf"]["bytes"] == os.path.getsize(elf_file)
+    assert phases["image2elf"]["bytes"] == phases["read_app_image"]["bytes"]
+    # starts are relative to the first phase, in order
+    starts = [event["start"] for event in report["phases"]]
+    assert starts[0] == 0 and starts == sorted(starts)
+    for event in report["phases"]:
+        assert event["seconds"] >= 0
+        assert isinstance(event["alloc_blocks"], int)
+    assert all(total["calls"] == 1 for total in report["summary"].values())
+
+def test_chrome_trace(tmp_path, monkeypatch, capsys, flash_file):
+    out = run(monkeypatch, capsys, "dump_nvs", flash_file, "-partition", "nvs", "-nvs_output_type", "ndjson",
+              "-timings", "-", "-timings_format", "chrome")
+    # the records, then the report
+    trace = json.loads(out[out.index("\n{\n") + 1:])
+    assert {event["name"] for event in trace["traceEvents"]} == {"dump_nvs", "read_partition_table", "nvs_ndjson"}
+    for event in trace["traceEvents"]:
+        assert event["ph"] == "X" and event["pid"] == os.getpid()
+    nvs = [event for event in trace["traceEvents"] if event["name"] == "nvs_ndjson"][0]
+    assert nvs["args"]["bytes"] == 3 * 0x1000
+
+def test_batch_workers_report_phases(tmp_path, capsys):
+    from esp32_batch import run_batch
+    dumps = tmp_path / "dumps"
+    dumps.mkdir()
+    for name in ("a.bin", "b.bin"):
+        (dumps / name).write_bytes(make_image()[0])
+    esp32_timings.enable()
+    run_batch(str(dumps), str(tmp_path / "out"), jobs=2, timings=True)
+    names = [event["name"] for event in esp32_timings.events]
+    assert names.count("process_image") == 2
+    assert names.count("read_partition_table") == 2
+    # two OTA slots per image
+    assert names.count("image2elf") == 4
+    assert {"hash_partition", "dump_bytes", "nvs_json"} <= set(names)
+    assert all(event["pid"] != os.getpid() for event in esp32_timings.events)
+
+def test_profile(tmp_path, monkeypatch, capsys, flash_file):
+    profile_file = str(tmp_path / "create_elf.prof")
+    run(monkeypatch, capsys, "create_elf", flash_file, "-partition", "ota_0", "-output", str(tmp_path / "ota_0.elf"),
+        "-profile", profile_file)
+    functions = {name for _, _, name in pstats.Stats(profile_file).stats}
+    assert {"image2elf", "read_app_image"} <= functions
+    assert esp32_timings.events == []
@@ -0,0 +1,70 @@
+import struct
+import synthetic
+from conftest import make_image
+from esp32_verify import verify_image, verify_bootloader
+
+def nvs_offset(partitions):
+    return [p for p in partitions if p[0] == "nvs"][0][3]
+
+def test_clean_image_verifies():
+    image, _ = make_image()
+    report = verify_image(memoryview(image), jobs=1)
+    assert report["ok"]
+    nvs = [p for p in report["partitions"] if p["label"] == "nvs"][0]
+    assert nvs["checks"]["entry_crc_ok"] is True
+
+def test_corrupt_nvs_entry_fails():
+    image, partitions = make_image()
+    image = bytearray(image)
+    # a page with two written entries, so the bitmap order decides which get checked
+    page = synthetic.nvs_page(0, [synthetic.nvs_entry(0, 0x01, 1, 0xff, "cfg", b'\x01'),
+                                  synthetic.nvs_entry(1, 0x04, 1, 0xff, "boot", struct.pack("<I", 7))])
+    offset = nvs_offset(partitions)
+    image[offset:offset + len(page)] = page
+    # flip a data byte of the second entry
+    image[offset + 64 + 32 + 24] ^= 0x01
+    report = verify_image(memoryview(bytes(image)), jobs=1)
+    assert not report["ok"]
+    nvs = [p for p in report["partitions"] if p["label"] == "nvs"][0]
+    assert nvs["checks"]["entry_crc_ok"] is False
+    assert nvs["checks"]["bad_entry_crcs"] == [[0, 1]]
+
+def bootloader(chip_id, addr):
+    # a bootloader image 0x2000 bytes long, with an image magic byte in its code at 0x1000
+    code = bytearray(0x2000)
+    code[0x1000 - 32] = 0xE9
+    image = synthetic.app_image([(addr, bytes(code))], entrypoint=addr, chip_id=chip_id)
+    assert image[0x1000] == 0xE9
+    return image
+
+def with_bootloaders(*placed):
+    image = bytearray(make_image()[0])
+    for offset, data in placed:
+        image[offset:offset + len(data)] = data
+    return memoryview(bytes(image))
+
+def test_bootloader_at_0x0_is_checked_first():
+    # S3 and C3 bootloaders start at 0x0; the byte at 0x1000 is their code
+    for chip_id, chip in ((9, "esp32s3"), (5, "esp32c3")):
+        record = verify_bootloader(with_bootloaders((0x0, bootloader(chip_id, 0x403C9000))))
+        assert record["offset"] == 0x0
+        assert record["ok"] and record["checks"]["chip"] == chip
+
+def test_esp32_bootloader_at_0x1000():
+    record = verify_bootloader(with_bootloaders((0x1000, bootloader(0, 0x40080000))))
+    assert record["offset"] == 0x1000
+    assert record["ok"] and record["checks"]["chip"] == "esp32"
+    # an ESP32 / S2 header at 0x0 isn't what the ROM boots
+    record = verify_bootloader(with_bootloaders((0x0, bootloader(2, 0x40020000)[:0x1000]), (0x1000, bootloader(2, 0x40020000))))
+    assert record["offset"] == 0x1000
+    assert record["ok"] and record["checks"]["chip"] == "esp32s2"
+
+def test_corrupt_bootloader_at_0x0():
+    image = bytearray(bootloader(9, 0x403C9000))
+    image[0x100] ^= 0xFF
+    record = verify_bootloader(with_bootloaders((0x0, bytes(image))))
+    assert record["offset"] == 0x0
+    assert not record["ok"] and record["checks"]["checksum_ok"] is False
+
+def test_no_bootloader():
+    assert verify_bootloader(with_bootloaders()) is None